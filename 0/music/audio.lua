@@ -1,6 +1,7 @@
 local config = require("/music/config")
 local State = require("/music/state")
 local theme = require("/music/theme")
+local utils = require("/music/utils")
 
 -- Initialize speaker
 local speaker = peripheral.find("speaker")
@@ -11,6 +12,7 @@ end
 -- Playback position tracking
 local function reset_playback_timing()
     State.playback_position = 0
+    State.position_offset = 0
     State.chunks_played = 0
     State.buffer_size_on_pause = 0
     State.downloaded_chunks = {}
@@ -22,7 +24,7 @@ local function calculate_playback_position()
         chunks_total = chunks_total - State.buffer_size_on_pause
     end
     local samples_played = chunks_total * State.samples_per_chunk
-    State.playback_position = samples_played / State.sample_rate
+    State.playback_position = State.position_offset + samples_played / State.sample_rate
     if State.total_duration > 0 then
         State.playback_position = math.min(State.playback_position, State.total_duration)
     end
@@ -32,23 +34,29 @@ local function update_playback_position()
     calculate_playback_position()
 end
 
--- PCM chunk conversion
-local function convert_pcm_chunk(chunk_data)
-    local pcm_samples = {}
-    for i = 1, #chunk_data do
-        local signed_byte = string.byte(chunk_data, i)
-        if signed_byte > 127 then
-            signed_byte = signed_byte - 256
-        end
-        pcm_samples[i] = signed_byte
-    end
-    return pcm_samples
+-- PCM chunk conversion, into out when given (a table being reused)
+local function convert_pcm_chunk(chunk_data, out)
+    return utils.decode_pcm(chunk_data, out or {})
 end
 
 -- Visualization
 local function update_visualization_data(chunk)
     if not State.settings.show_visualization or not chunk then return end
 
+    local vis = chunk.vis
+    if vis then
+        -- Measured by the server; the stream is mono, so both meters show its level
+        State.current_chunk_rms = vis.rms
+        State.vu_left = vis.rms
+        State.vu_right = vis.rms
+        State.spectrum_data = vis.bands
+        table.insert(State.visualization_data, vis.rms)
+        if #State.visualization_data > 20 then
+            table.remove(State.visualization_data, 1)
+        end
+        return
+    end
+
     -- Calculate RMS (root mean square) for volume level
     local sum = 0
     local sum_left = 0
@@ -183,34 +191,49 @@ local function update_sleep_timer()
     end
 end
 
+-- Chunks played below full volume are scaled into this one table
+local scaled = {}
+
+local function scale_chunk(chunk, volume)
+    -- Samples lie in [-128, 127] and volume in [0, 1], so the result needs no clamping
+    local floor, n = math.floor, #chunk
+    for i = 1, n do
+        scaled[i] = floor(chunk[i] * volume)
+    end
+    for i = #scaled, n + 1, -1 do
+        scaled[i] = nil
+    end
+    return scaled
+end
+
 -- Main audio playback loop
 local function audio_loop()
     while true do
         os.pullEvent("playback")
 
         while State.is_playing do
-            if #State.buffer > 0 then
-                local chunk = table.remove(State.buffer, 1)
+            if State.buffer.count > 0 then
+                -- The chunk's table goes back to the buffer for reuse, so finish with it before yielding
+                local chunk = utils.ring_pop(State.buffer)
                 if chunk then
                     -- Update visualization
                     update_visualization_data(chunk)
 
-                    local scaled = {}
-                    for i = 1, #chunk do
-                        local s = math.floor(chunk[i] * State.volume)
-                        s = math.max(-128, math.min(127, s))
-                        scaled[i] = s
+                    local samples = chunk
+                    if State.volume ~= 1 then
+                        samples = scale_chunk(chunk, State.volume)
                     end
 
-                    while not speaker.playAudio(scaled, State.volume) do
+                    while not speaker.playAudio(samples, State.volume) do
                         if not State.is_playing then break end
                     end
 
                     if State.is_playing then
-                        State.chunks_played = State.chunks_played + 1
+                        -- Chunks sent at a lower rate or size cover more or less of the track
+                        State.chunks_played = State.chunks_played + chunk.duration * State.sample_rate / State.samples_per_chunk
                         -- Note: We can't directly call network functions from here
                         -- Instead, we queue an event that the network module can handle
-                        if #State.buffer < config.CONFIG.buffer_threshold and not State.chunk_request_pending then
+                        if State.buffer.count < config.CONFIG.buffer_threshold and not State.chunk_request_pending then
                             os.queueEvent("request_chunk")
                         end
 
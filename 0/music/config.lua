@@ -4,9 +4,15 @@ local CONFIG = {
     buffer_max = 40,
     retry_delay = 2,
     chunk_request_ahead = 10,
+    chunk_batch_max = 16,
+    use_websocket = true, -- Have the server push chunks over /ws/<session>; polling is the fallback
+    adaptive_profile = true, -- Let the server lower the sample rate or enlarge chunks when we fall behind
+    prefetch_count = 2,
+    seek_step = 10, -- Seconds moved by the seek hotkeys
     update_interval = 0.25,
     audio_sample_rate = 48000,
     audio_chunk_size = 2^12,
+    audio_format = "pcm", -- "pcm" or "dfpwm" (8x less bandwidth, decoded by cc.audio.dfpwm)
     version = "4.0",
 
     -- File paths
@@ -52,6 +58,8 @@ local HOTKEYS = {
     mini_mode = keys.m,
     search = keys.s,
     queue = keys.q,
+    seek_back = keys.leftBracket,
+    seek_forward = keys.rightBracket,
     help = keys.h
 }
 
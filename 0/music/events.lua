@@ -141,7 +141,13 @@ local function handle_input(char, key)
 
         if context == "main_search" then
             State.last_query = State.input_text
-            if State.last_query ~= "" and network then
+            if State.last_query:find("list=") and network then
+                -- A playlist URL: import its tracks instead of searching
+                State.search_results = nil
+                State.search_error = nil
+                set_status("Importing playlist...", theme.current_colors().status.loading)
+                network.resolve_tracks(nil, State.last_query)
+            elseif State.last_query ~= "" and network then
                 State.last_search_url = State.settings.api_url .. "/?search=" .. textutils.urlEncode(State.last_query)
                 State.search_results = nil
                 State.search_error = nil
@@ -404,6 +410,10 @@ local function ui_loop()
             elseif param1 == config.HOTKEYS.queue then
                 State.current_tab = config.TABS.QUEUE
                 if ui then ui.redraw() end
+            elseif param1 == config.HOTKEYS.seek_back and network then
+                network.seek(State.playback_position - config.CONFIG.seek_step)
+            elseif param1 == config.HOTKEYS.seek_forward and network then
+                network.seek(State.playback_position + config.CONFIG.seek_step)
             elseif param1 == config.HOTKEYS.help then
                 if ui and ui.show_help_popup then ui.show_help_popup() end
             elseif param1 == keys.space and State.current_tab == config.TABS.NOW_PLAYING then
@@ -448,6 +458,8 @@ local function ui_loop()
                 State.status_message = nil
                 State.status_timer = nil
                 if ui then ui.redraw() end
+            elseif param1 == State.start_retry_timer and network then
+                network.retry_start()
             end
         elseif event == "playback_update" then
             if audio then audio.update_sleep_timer() end
@@ -461,11 +473,19 @@ end
 -- HTTP event loop
 local function http_loop()
     while true do
-        local event, url, handle = os.pullEvent()
+        local event, url, handle, binary = os.pullEvent()
         if event == "http_success" then
             if network then network.handle_http_success(url, handle) end
         elseif event == "http_failure" then
             if network then network.handle_http_failure(url, handle) end
+        elseif event == "websocket_success" then
+            if network then network.handle_websocket_success(url, handle) end
+        elseif event == "websocket_failure" then
+            if network then network.handle_websocket_failure(url) end
+        elseif event == "websocket_message" then
+            if network then network.handle_websocket_message(url, handle, binary) end
+        elseif event == "websocket_closed" then
+            if network then network.handle_websocket_closed(url) end
         end
     end
 end
@@ -97,6 +97,8 @@ local function initialize_state()
 
     print("✓ Loading saved state...")
     storage.load_state()
+    -- Resolve the restored queue in one request while the UI comes up
+    network.resolve_tracks(State.queue)
 
     print("✓ Applying theme: " .. State.settings.theme)
     theme.apply_theme(State.settings.theme, State)
@@ -321,7 +323,7 @@ local function main()
         print("Current Song: " .. (State.current_song and State.current_song.title or "None"))
         print("Queue Length: " .. #State.queue)
         print("Is Playing: " .. tostring(State.is_playing))
-        print("Buffer Size: " .. #State.buffer)
+        print("Buffer Size: " .. State.buffer.count)
         print("")
         term.setTextColor(colors.white)
         print("The application will attempt to save your data...")
@@ -349,7 +351,7 @@ local function monitor_performance()
     local function get_performance_stats()
         return {
             uptime = os.clock() - start_time,
-            buffer_efficiency = State.is_streaming and (#State.buffer / (State.settings.buffer_size or 20)) or 0,
+            buffer_efficiency = State.is_streaming and (State.buffer.count / (State.settings.buffer_size or 20)) or 0,
             connection_quality = State.connection_errors == 0 and "Good" or "Poor",
             songs_processed = #State.history
         }
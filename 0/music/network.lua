@@ -7,6 +7,15 @@ local utils = require("/music/utils")
 -- Forward declarations for modules to avoid circular dependencies
 local audio, events
 
+-- DFPWM decoder for the current stream (decoder state must not cross tracks)
+local dfpwm_decoder
+
+-- Retries of a /start_stream the server refused with 503 (busy)
+local start_retries = 0
+
+-- Speakers always play at this rate, whatever the stream was encoded at
+local SPEAKER_RATE = 48000
+
 -- Helper functions for status and notifications
 local function set_status(message, color, duration)
     State.status_message = message
@@ -34,34 +43,39 @@ local function show_notification(message, duration)
     end
 end
 
--- PCM chunk conversion
-local function convert_pcm_chunk(chunk_data)
-    local pcm_samples = {}
-    for i = 1, #chunk_data do
-        local signed_byte = string.byte(chunk_data, i)
-        if signed_byte > 127 then
-            signed_byte = signed_byte - 256
-        end
-        pcm_samples[i] = signed_byte
+-- PCM chunk conversion, into out when given (a table being reused)
+local function convert_pcm_chunk(chunk_data, out)
+    return utils.decode_pcm(chunk_data, out or {})
+end
+
+local function convert_chunk(chunk_data, out)
+    if State.stream_format == "dfpwm" and dfpwm_decoder then
+        return dfpwm_decoder(chunk_data) -- The decoder returns a table of its own
     end
-    return pcm_samples
+    return convert_pcm_chunk(chunk_data, out)
 end
 
 -- Stream management
 local function stop_current_stream()
-    if State.session_id then
+    if State.push_socket then
+        State.push_socket.send(textutils.serializeJSON({ type = "stop" }))
+        State.push_socket.close()
+    elseif State.session_id then
         http.post(State.settings.api_url .. "/stop_stream/" .. State.session_id, "")
-        State.session_id = nil
     end
+    State.session_id = nil
+    State.push_socket = nil
+    State.push_url = nil
     State.is_streaming = false
     State.is_playing = false
-    State.buffer = {}
+    utils.ring_clear(State.buffer)
 
     -- Reset playback timing
     if audio then
         audio.reset_playback_timing()
     else
         State.playback_position = 0
+        State.position_offset = 0
         State.chunks_played = 0
         State.buffer_size_on_pause = 0
         State.downloaded_chunks = {}
@@ -69,10 +83,28 @@ local function stop_current_stream()
 
     State.connection_errors = 0
     State.chunk_request_pending = false
+    if State.start_retry_timer then
+        os.cancelTimer(State.start_retry_timer)
+        State.start_retry_timer = nil
+    end
+    State.next_chunk_seq = 0
     State.visualization_data = {}
 end
 
-local function start_stream(id, song)
+-- Ids of the songs that will play next, so the server can warm them up
+local function upcoming_ids()
+    local ids = {}
+    if State.shuffle then
+        return ids
+    end
+    for i = 1, math.min(config.CONFIG.prefetch_count, #State.queue) do
+        table.insert(ids, State.queue[i].id)
+    end
+    return ids
+end
+
+-- start_seconds (optional) starts mid-track, e.g. to resume after the session was lost
+local function start_stream(id, song, start_seconds)
     stop_current_stream()
 
     State.current_song = song
@@ -90,18 +122,25 @@ local function start_stream(id, song)
         State.buffer_size_on_pause = 0
         State.downloaded_chunks = {}
     end
+    State.position_offset = start_seconds or 0
 
-    if State.current_song then
+    if State.current_song and not start_seconds then
         show_notification("Now playing: " .. (song.title or "Unknown"), 3)
     end
 
     local payload = textutils.serializeJSON({
         id = id,
         audio_config = {
-            format = "pcm",
+            format = State.settings.audio_format,
             sample_rate = State.settings.sample_rate,
-            chunk_size = State.settings.chunk_size
-        }
+            chunk_size = State.settings.chunk_size,
+            fast_start = true, -- Short first chunk and a quick lead-in; the server starts playback sooner
+            adaptive = config.CONFIG.adaptive_profile,
+            -- The server measures each chunk's level and spectrum, so we only draw them
+            visualization = State.settings.show_visualization and 8 or 0
+        },
+        next_ids = upcoming_ids(),
+        start_seconds = start_seconds
     })
 
     http.request({
@@ -113,10 +152,85 @@ local function start_stream(id, song)
 end
 
 local function request_chunk()
-    if State.session_id and not State.ended and not State.chunk_request_pending and #State.buffer < State.settings.buffer_size then
+    if State.push_socket then
+        -- Pushed: top up the server's credit so buffered plus in-flight chunks fill the buffer
+        local wanted = State.settings.buffer_size - State.buffer.count - State.push_credit
+        if wanted > 0 and not State.ended then
+            State.push_socket.send(textutils.serializeJSON({ type = "credit", chunks = wanted }))
+            State.push_credit = State.push_credit + wanted
+        end
+        return
+    end
+    if State.push_url then
+        return -- Socket still connecting; it opens with credit for a full buffer
+    end
+
+    if State.session_id and not State.ended and not State.chunk_request_pending and State.buffer.count < State.settings.buffer_size then
         State.chunk_request_pending = true
         State.last_chunk_time = os.clock()
-        http.request(State.settings.api_url .. "/chunk/" .. State.session_id)
+
+        -- Fetch as many chunks as the buffer has room for in one round trip
+        local wanted = math.min(config.CONFIG.chunk_batch_max, State.settings.buffer_size - State.buffer.count)
+        -- from= acknowledges what we have, so chunks lost with a failed response are sent again
+        http.request(State.settings.api_url .. "/chunks/" .. State.session_id ..
+            "?max=" .. wanted .. "&from=" .. State.next_chunk_seq)
+    end
+end
+
+-- Jump to a position in the current track; the server moves its read offset when it can
+local function seek(seconds)
+    if not State.session_id or not State.current_song then
+        return
+    end
+    seconds = math.max(0, seconds)
+    if State.total_duration > 0 then
+        seconds = math.min(seconds, State.total_duration)
+    end
+
+    if State.push_socket then
+        -- The reply arrives on the socket, in the same shape as the HTTP one
+        State.push_socket.send(textutils.serializeJSON({ type = "seek", seconds = seconds }))
+        return
+    end
+
+    http.request({
+        url = State.settings.api_url .. "/seek/" .. State.session_id,
+        body = textutils.serializeJSON({ seconds = seconds }),
+        headers = { ["Content-Type"] = "application/json" },
+        method = "POST"
+    })
+end
+
+-- Have the server resolve many tracks at once (NDJSON, a line per track), filling its cache
+-- so they start without a lookup; with a playlist URL it imports that playlist
+local function resolve_tracks(songs, playlist_url)
+    local ids = {}
+    for _, song in ipairs(songs or {}) do
+        table.insert(ids, song.id)
+    end
+    if #ids == 0 and not playlist_url then
+        return
+    end
+
+    local url = State.settings.api_url .. "/resolve_batch"
+    if playlist_url then
+        -- Tagged so its response is told apart from a warm-up's
+        url = url .. "?import=" .. textutils.urlEncode(playlist_url)
+        State.last_search_url = url
+    end
+    http.request({
+        url = url,
+        body = textutils.serializeJSON(playlist_url and { playlist = playlist_url } or { ids = ids }),
+        headers = { ["Content-Type"] = "application/json" },
+        method = "POST"
+    })
+end
+
+-- The server lost our session (restart or expiry): start again where playback is
+local function resume_stream()
+    if State.current_song then
+        set_status("Reconnecting...", theme.current_colors().status.loading, 2)
+        start_stream(State.current_song.id, State.current_song, State.playback_position)
     end
 end
 
@@ -124,12 +238,28 @@ end
 local function handle_stream_start_response(response_text)
     local success, response = pcall(textutils.unserializeJSON, response_text)
     if success and response and response.session_id then
+        start_retries = 0
         State.session_id = response.session_id
+        State.stream_format = response.audio_config and response.audio_config.format or "pcm"
+        State.vis_bands = response.audio_config and response.audio_config.visualization or 0
+        State.stream_rate = response.audio_config and response.audio_config.sample_rate or State.settings.sample_rate
+        if State.stream_format == "dfpwm" then
+            dfpwm_decoder = require("cc.audio.dfpwm").make_decoder()
+        end
         State.is_streaming = true
         State.loading = false
         State.connection_errors = 0
         set_status("Stream started", theme.current_colors().status.playing, 2)
 
+        if config.CONFIG.use_websocket and State.push_supported and http.websocketAsync then
+            -- Chunks arrive as the server produces them, no request per batch
+            State.push_url = State.settings.api_url:gsub("^http", "ws") .. "/ws/" .. State.session_id ..
+                "?credit=" .. State.settings.buffer_size .. "&from=" .. State.next_chunk_seq
+            State.push_credit = State.settings.buffer_size
+            http.websocketAsync(State.push_url)
+            return
+        end
+
         -- Request initial chunks
         for i = 1, config.CONFIG.chunk_request_ahead do
             request_chunk()
@@ -142,8 +272,84 @@ local function handle_stream_start_response(response_text)
     end
 end
 
-local function handle_chunk_response(data, response_code)
+-- Split off the server's frame: RMS, peak, then one level per band, a byte each
+local function read_vis_frame(data)
+    local bands = State.vis_bands
+    local bytes = { string.byte(data, 1, 2 + bands) }
+    local vis = { rms = bytes[1] / 255, peak = bytes[2] / 255, bands = {} }
+    for i = 1, bands do
+        vis.bands[i] = bytes[2 + i] / 255
+    end
+    return vis, string.sub(data, 3 + bands)
+end
+
+-- Stretch audio sent at a lower rate to the speaker's into out by repeating the nearest sample
+local function upsample(samples, rate, out)
+    local floor, step = math.floor, rate / SPEAKER_RATE
+    local n = floor(#samples / step)
+    for i = 1, n do
+        out[i] = samples[floor((i - 1) * step) + 1]
+    end
+    for i = #out, n + 1, -1 do
+        out[i] = nil
+    end
+    return out
+end
+
+-- Lower-rate chunks are decoded here before being stretched into their buffer slot
+local decoded = {}
+
+local function buffer_chunk(data)
+    local vis
+    if State.vis_bands > 0 then
+        vis, data = read_vis_frame(data)
+    end
+
+    -- Decode straight into the table of the buffer slot the chunk goes to
+    local slot = utils.ring_slot(State.buffer)
+    local pcm_samples = convert_chunk(data, State.stream_rate < SPEAKER_RATE and decoded or slot)
+    local duration = #pcm_samples / State.stream_rate
+    if State.stream_rate < SPEAKER_RATE then
+        pcm_samples = upsample(pcm_samples, State.stream_rate, slot)
+    end
+    pcm_samples.duration = duration -- Seconds of the track, counted by the audio loop as it plays
+    pcm_samples.vis = vis -- Drawn by the audio loop when the chunk plays
+    utils.ring_push(State.buffer, pcm_samples)
+    -- Kept as received, a byte per sample rather than a table entry, for download_song
+    table.insert(State.downloaded_chunks, data)
+end
+
+local function after_chunks_buffered()
+    State.connection_errors = 0
+
+    -- Request next chunk if buffer not full
+    if State.buffer.count < config.CONFIG.buffer_threshold then
+        request_chunk()
+    end
+
+    -- Start playing if we have enough buffer
+    if not State.is_playing and State.buffer.count >= config.CONFIG.buffer_threshold then
+        State.is_playing = true
+        State.buffer_size_on_pause = 0
+        os.queueEvent("playback")
+    end
+end
+
+local function mark_stream_ended()
+    State.ended = true
+    if State.is_playing then
+        os.queueEvent("stream_ended")
+    end
+end
+
+-- The server names the profile of the chunks in each response; it changes when it adapts to us
+local function note_profile(headers)
+    State.stream_rate = tonumber(headers["X-Profile-Sample-Rate"]) or State.stream_rate
+end
+
+local function handle_chunk_response(data, response_code, headers)
     State.chunk_request_pending = false
+    note_profile(headers)
 
     -- Update latency
     local latency = os.clock() - State.last_chunk_time
@@ -151,32 +357,140 @@ local function handle_chunk_response(data, response_code)
     State.total_bytes_received = State.total_bytes_received + #data
 
     if response_code == 204 or #data == 0 then
-        State.ended = true
-        if State.is_playing then
-            os.queueEvent("stream_ended")
-        end
+        mark_stream_ended()
     else
-        local pcm_samples = convert_pcm_chunk(data)
-        table.insert(State.buffer, pcm_samples)
-        table.insert(State.downloaded_chunks, pcm_samples)
-        State.connection_errors = 0
+        buffer_chunk(data)
+        after_chunks_buffered()
+    end
+end
 
-        -- Update visualization if audio module is available
-        if audio and audio.update_visualization_data then
-            audio.update_visualization_data(pcm_samples)
-        end
+-- Batched responses: each chunk is prefixed by its length as a 4-byte big-endian integer
+local function handle_chunks_response(data, response_code, headers)
+    State.chunk_request_pending = false
+    note_profile(headers)
 
-        -- Request next chunk if buffer not full
-        if #State.buffer < config.CONFIG.buffer_threshold then
-            request_chunk()
-        end
+    local first_seq = tonumber(headers["X-First-Chunk"])
+    if first_seq and first_seq < State.next_chunk_seq then
+        -- Sent before a seek; the audio belongs to the old position
+        request_chunk()
+        return
+    end
+
+    local latency = os.clock() - State.last_chunk_time
+    State.avg_chunk_latency = (State.avg_chunk_latency * 0.9) + (latency * 0.1)
+    State.total_bytes_received = State.total_bytes_received + #data
+
+    if response_code == 204 then
+        mark_stream_ended()
+        return
+    end
+
+    if #data == 0 then
+        -- Keep-alive: the server had nothing buffered yet, so ask again
+        request_chunk()
+        return
+    end
+
+    local pos, size = 1, #data
+    while pos + 3 <= size do
+        local b1, b2, b3, b4 = string.byte(data, pos, pos + 3)
+        local length = ((b1 * 256 + b2) * 256 + b3) * 256 + b4
+        buffer_chunk(string.sub(data, pos + 4, pos + 3 + length))
+        pos = pos + 4 + length
+        State.next_chunk_seq = State.next_chunk_seq + 1
+    end
+
+    after_chunks_buffered()
+end
+
+local function handle_seek_response(response_text)
+    local success, response = pcall(textutils.unserializeJSON, response_text)
+    if not success or not response or not response.next_chunk then
+        set_status("Seek failed", theme.current_colors().status.error, 2)
+        return
+    end
+
+    -- Drop audio from before the seek and count from the new position
+    utils.ring_clear(State.buffer)
+    State.chunks_played = 0
+    State.buffer_size_on_pause = 0
+    State.position_offset = response.position_seconds
+    State.playback_position = response.position_seconds
+    State.next_chunk_seq = response.next_chunk
+    State.ended = false
+    if State.stream_format == "dfpwm" then
+        dfpwm_decoder = require("cc.audio.dfpwm").make_decoder()
+    end
+
+    request_chunk()
+end
 
-        -- Start playing if we have enough buffer
-        if not State.is_playing and #State.buffer >= config.CONFIG.buffer_threshold then
-            State.is_playing = true
-            State.buffer_size_on_pause = 0
-            os.queueEvent("playback")
+-- Push streaming: binary messages are a 4-byte big-endian sequence number and one chunk,
+-- text messages are JSON replies and notices
+local function handle_websocket_success(url, socket)
+    if url ~= State.push_url then
+        socket.close() -- Opened for a stream we have since left
+        return
+    end
+    State.push_socket = socket
+end
+
+local function handle_websocket_failure(url)
+    if url ~= State.push_url then
+        return
+    end
+    -- Server without push support (or in scale-out mode): poll from here on
+    State.push_url = nil
+    State.push_supported = false
+    request_chunk()
+end
+
+local function handle_websocket_closed(url)
+    if url ~= State.push_url then
+        return
+    end
+    State.push_url = nil
+    State.push_socket = nil
+    if State.session_id and not State.ended then
+        -- Dropped mid-stream: polling with from= picks up whatever did not arrive
+        request_chunk()
+    end
+end
+
+local function handle_websocket_message(url, message, binary)
+    if url ~= State.push_url then
+        return
+    end
+
+    if binary then
+        local b1, b2, b3, b4 = string.byte(message, 1, 4)
+        local seq = ((b1 * 256 + b2) * 256 + b3) * 256 + b4
+        State.push_credit = math.max(0, State.push_credit - 1)
+        State.total_bytes_received = State.total_bytes_received + #message
+        if seq >= State.next_chunk_seq then -- Older ones were sent before a seek
+            buffer_chunk(string.sub(message, 5))
+            State.next_chunk_seq = seq + 1
+            after_chunks_buffered()
         end
+        return
+    end
+
+    local success, notice = pcall(textutils.unserializeJSON, message)
+    if not success or not notice then
+        return
+    end
+    if notice.type == "end" then
+        mark_stream_ended()
+    elseif notice.type == "seek" then
+        handle_seek_response(message)
+    elseif notice.type == "profile" and notice.switched then
+        -- Chunks from here on come in the new profile
+        State.stream_rate = notice.sample_rate
+    elseif notice.type == "error" and (notice.status == 404 or notice.status == 410) then
+        State.push_socket.close()
+        State.push_socket = nil
+        State.push_url = nil
+        resume_stream()
     end
 end
 
@@ -196,27 +510,96 @@ local function handle_search_response(response_text)
     end
 end
 
+-- Playlist import: list the tracks that resolved, in playlist order, as search results
+local function handle_import_response(response_text)
+    State.last_search_url = nil
+    local title, tracks, last = nil, {}, 0
+    for line in response_text:gmatch("[^\n]+") do
+        local success, message = pcall(textutils.unserializeJSON, line)
+        if success and message and message.type == "playlist" then
+            title = message.title
+        elseif success and message and message.type == "track" then
+            tracks[message.index + 1] = {
+                id = message.id,
+                title = message.title or "Unknown",
+                artist = message.artist or "Unknown",
+                duration = message.duration or 0
+            }
+            last = math.max(last, message.index + 1)
+        end
+    end
+
+    local results = {}
+    for i = 1, last do
+        if tracks[i] then
+            table.insert(results, tracks[i])
+        end
+    end
+    State.search_results = results
+    State.search_scroll = 0
+    State.selected_index[config.TABS.SEARCH] = 1
+    set_status("Imported " .. #results .. " tracks from " .. (title or "playlist"), colors.white, 3)
+end
+
 local function handle_http_success(url, handle)
     local response_text = handle.readAll()
     local response_code = handle.getResponseCode()
+    local headers = handle.getResponseHeaders and handle.getResponseHeaders() or {}
     handle.close()
 
     if url:find("/start_stream") then
         handle_stream_start_response(response_text)
+    elseif url:find("/seek/") then
+        handle_seek_response(response_text)
+    elseif url:find("/chunks/") then
+        handle_chunks_response(response_text, response_code, headers)
     elseif url:find("/chunk/") then
-        handle_chunk_response(response_text, response_code)
+        handle_chunk_response(response_text, response_code, headers)
     elseif url:find("search=") then
         handle_search_response(response_text)
+    elseif url == State.last_search_url and url:find("/resolve_batch") then
+        handle_import_response(response_text)
     -- REMOVED: Update check handling - now handled by update.lua
     end
 end
 
+-- The wait a busy server asked for is over (State.start_retry_timer fired): ask again
+local function retry_start()
+    State.start_retry_timer = nil
+    if State.current_song then
+        start_stream(State.current_song.id, State.current_song,
+            State.position_offset > 0 and State.position_offset or nil)
+    end
+end
+
 local function handle_http_failure(url, handle)
     if State.last_search_url and url == State.last_search_url then
         State.search_error = "Connection failed"
         State.last_search_url = nil
         set_status("Search connection failed", theme.current_colors().status.error, 3)
-    elseif State.session_id and url:find("/chunk/") then
+    elseif url:find("/start_stream") and handle and handle.getResponseCode() == 503 and
+           State.current_song and start_retries < 3 then
+        -- Server is at capacity: wait as long as it asks, then try again
+        local headers = handle.getResponseHeaders and handle.getResponseHeaders() or {}
+        local wait = math.min(tonumber(headers["Retry-After"]) or config.CONFIG.retry_delay, 10)
+        handle.close()
+        start_retries = start_retries + 1
+        set_status("Server busy, retrying in " .. wait .. "s", theme.current_colors().status.loading, wait)
+        -- Not sleep(): that would swallow every other event until it returns (see retry_start)
+        State.start_retry_timer = os.startTimer(wait)
+    elseif url:find("/start_stream") then
+        start_retries = 0
+        State.loading = false
+        set_status("Failed to start stream", theme.current_colors().status.error, 3)
+    elseif State.session_id and url:find("/chunks/") and handle and
+           (handle.getResponseCode() == 404 or handle.getResponseCode() == 410) then
+        -- Session gone or the chunks we missed were dropped: restart where we are
+        State.chunk_request_pending = false
+        handle.close()
+        resume_stream()
+    elseif url:find("/seek/") then
+        set_status("Seek failed", theme.current_colors().status.error, 2)
+    elseif State.session_id and (url:find("/chunks/") or url:find("/chunk/")) then
         State.chunk_request_pending = false
         State.connection_errors = State.connection_errors + 1
         if State.connection_errors < 5 then
@@ -233,7 +616,7 @@ end
 local function calculate_network_stats()
     local stats = {
         session_active = State.session_id ~= nil,
-        buffer_fill = math.floor((#State.buffer / (State.settings.buffer_size or config.CONFIG.buffer_max)) * 100),
+        buffer_fill = math.floor((State.buffer.count / (State.settings.buffer_size or config.CONFIG.buffer_max)) * 100),
         connection_errors = State.connection_errors or 0,
         avg_latency = State.avg_chunk_latency or 0,
         bytes_received = State.total_bytes_received or 0,
@@ -250,14 +633,12 @@ local function download_song()
         return
     end
 
-    local filename = "song_" .. State.current_song.id .. ".pcm"
+    local filename = "song_" .. State.current_song.id .. "." .. State.stream_format
     local file = fs.open(filename, "wb")
 
     if file then
         for _, chunk in ipairs(State.downloaded_chunks) do
-            for _, sample in ipairs(chunk) do
-                file.write(sample)
-            end
+            file.write(chunk)
         end
         file.close()
         set_status("Downloaded to " .. filename, theme.current_colors().status.playing, 3)
@@ -288,11 +669,19 @@ local function http_loop()
     init_dependencies()
 
     while true do
-        local event, url, handle = os.pullEvent()
+        local event, url, handle, binary = os.pullEvent()
         if event == "http_success" then
             handle_http_success(url, handle)
         elseif event == "http_failure" then
             handle_http_failure(url, handle)
+        elseif event == "websocket_success" then
+            handle_websocket_success(url, handle)
+        elseif event == "websocket_failure" then
+            handle_websocket_failure(url)
+        elseif event == "websocket_message" then
+            handle_websocket_message(url, handle, binary)
+        elseif event == "websocket_closed" then
+            handle_websocket_closed(url)
         end
     end
 end
@@ -301,9 +690,16 @@ return {
     start_stream = start_stream,
     stop_current_stream = stop_current_stream,
     request_chunk = request_chunk,
+    seek = seek,
+    resolve_tracks = resolve_tracks,
     -- REMOVED: check_for_updates - moved to update.lua
     handle_http_success = handle_http_success,
     handle_http_failure = handle_http_failure,
+    retry_start = retry_start,
+    handle_websocket_success = handle_websocket_success,
+    handle_websocket_failure = handle_websocket_failure,
+    handle_websocket_message = handle_websocket_message,
+    handle_websocket_closed = handle_websocket_closed,
     calculate_network_stats = calculate_network_stats,
     download_song = download_song,
     convert_pcm_chunk = convert_pcm_chunk,
@@ -312,5 +708,6 @@ return {
     -- Response handlers (exported for testing/debugging)
     handle_stream_start_response = handle_stream_start_response,
     handle_chunk_response = handle_chunk_response,
+    handle_chunks_response = handle_chunks_response,
     handle_search_response = handle_search_response
 }
\ No newline at end of file
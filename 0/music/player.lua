@@ -229,9 +229,9 @@ end
 local function toggle_play_pause()
     if State.is_playing then
         State.is_playing = false
-        State.buffer_size_on_pause = #State.buffer
+        State.buffer_size_on_pause = State.buffer.count
         set_status("Paused", theme.current_colors().status.paused, 2)
-    elseif State.current_song and (#State.buffer > 0 or State.ended) then
+    elseif State.current_song and (State.buffer.count > 0 or State.ended) then
         State.is_playing = true
         State.buffer_size_on_pause = 0
         os.queueEvent("playback")
@@ -253,7 +253,7 @@ local function stop_playback()
     else
         State.is_playing = false
         State.is_streaming = false
-        State.buffer = {}
+        utils.ring_clear(State.buffer)
         State.playback_position = 0
         State.chunks_played = 0
         State.buffer_size_on_pause = 0
@@ -382,6 +382,9 @@ local function load_playlist_to_queue(playlist_name, replace_queue)
     for _, song in ipairs(State.playlists[playlist_name].songs) do
         table.insert(State.queue, song)
     end
+    if network and network.resolve_tracks then
+        network.resolve_tracks(State.playlists[playlist_name].songs)
+    end
 
     storage.save_state()
     set_status("Loaded playlist: " .. playlist_name, colors.white, 2)
@@ -1,5 +1,6 @@
 local config = require("/music/config")
 local theme = require("/music/theme")
+local utils = require("/music/utils")
 
 local State = {
     -- UI State
@@ -83,13 +84,17 @@ local State = {
     ended = false,
 
     -- Audio State
-    buffer = {},
+    stream_format = "pcm",
+    vis_bands = 0, -- Spectrum bands of the frame the server puts in front of each chunk (0: none)
+    buffer = utils.ring_new(config.CONFIG.buffer_max), -- Decoded chunks waiting to play (see utils.ring_new)
     volume = 1.0,
     playback_position = 0,
+    position_offset = 0, -- Track position the current stream started at (start_seconds / seek)
     total_duration = 0,
     chunks_played = 0,
     samples_per_chunk = config.CONFIG.audio_chunk_size,
     sample_rate = config.CONFIG.audio_sample_rate,
+    stream_rate = config.CONFIG.audio_sample_rate, -- Rate the server encodes at now; may drop mid-stream
     buffer_size_on_pause = 0,
     downloaded_chunks = {},
 
@@ -104,6 +109,12 @@ local State = {
     -- Connection State
     connection_errors = 0,
     chunk_request_pending = false,
+    start_retry_timer = nil, -- Timer after which a /start_stream the server was too busy for is retried
+    next_chunk_seq = 0, -- Sequence number of the next chunk we expect (sent as ?from=)
+    push_url = nil, -- WebSocket the server pushes chunks over, while it connects or is open
+    push_socket = nil,
+    push_credit = 0, -- Chunks we allowed the server to push that have not arrived yet
+    push_supported = true, -- Cleared when the server turns the WebSocket down; we poll from then on
     last_chunk_time = 0,
     avg_chunk_latency = 0,
     total_bytes_received = 0,
@@ -114,6 +125,7 @@ local State = {
         buffer_size = config.CONFIG.buffer_max,
         sample_rate = config.CONFIG.audio_sample_rate,
         chunk_size = config.CONFIG.audio_chunk_size,
+        audio_format = config.CONFIG.audio_format,
         auto_play_next = true,
         show_visualization = true,
         theme = "default",
@@ -49,6 +49,7 @@ local function load_state()
         s.buffer_size         = tonumber(loaded_settings.buffer_size) or config.CONFIG.buffer_max
         s.sample_rate         = tonumber(loaded_settings.sample_rate) or config.CONFIG.audio_sample_rate
         s.chunk_size          = tonumber(loaded_settings.chunk_size) or config.CONFIG.audio_chunk_size
+        s.audio_format        = loaded_settings.audio_format == "dfpwm" and "dfpwm" or "pcm"
         s.auto_play_next      = type(loaded_settings.auto_play_next) == "boolean" and loaded_settings.auto_play_next or true
         s.show_visualization  = type(loaded_settings.show_visualization) == "boolean" and loaded_settings.show_visualization or true
         s.theme               = loaded_settings.theme or "default"
@@ -171,6 +171,7 @@ local function show_help_popup()
     help = help .. "M - Mini Mode\n"
     help = help .. "S - Go to Search\n"
     help = help .. "Q - Go to Queue\n"
+    help = help .. "[ ] - Seek -/+ 10s\n"
     help = help .. "Tab - Next Tab\n"
     help = help .. "Space - Play/Pause\n"
     help = help .. "Arrows - Navigate\n"
@@ -509,8 +510,8 @@ local function draw_buffer_status(width)
     term.setCursorPos(2, 15)
     term.setBackgroundColor(colors.black)
     term.setTextColor(colors.cyan)
-    local buffer_percent = math.min(100, math.floor((#State.buffer / config.CONFIG.buffer_max) * 100))
-    term.write("Buffer: " .. #State.buffer .. " chunks (" .. buffer_percent .. "%)")
+    local buffer_percent = math.min(100, math.floor((State.buffer.count / config.CONFIG.buffer_max) * 100))
+    term.write("Buffer: " .. State.buffer.count .. " chunks (" .. buffer_percent .. "%)")
 end
 
 local function draw_control_buttons(width)
@@ -1041,6 +1042,7 @@ local function draw_settings(width)
         {key = "buffer_size", label = "Buffer Size", value = tostring(State.settings.buffer_size), type = "number"},
         {key = "sample_rate", label = "Sample Rate", value = tostring(State.settings.sample_rate), type = "number"},
         {key = "chunk_size", label = "Chunk Size", value = tostring(State.settings.chunk_size), type = "number"},
+        {key = "audio_format", label = "Audio Format", value = State.settings.audio_format, type = "select", options = {"pcm", "dfpwm"}},
         {key = "auto_play_next", label = "Auto Play Next", value = State.settings.auto_play_next and "Yes" or "No", type = "boolean"},
         {key = "show_visualization", label = "Show Visualization", value = State.settings.show_visualization and "Yes" or "No", type = "boolean"},
         {key = "theme", label = "Theme", value = State.settings.theme, type = "select", options = {"default", "dark", "ocean"}},
@@ -1129,7 +1131,7 @@ local function draw_diagnostics(width)
     -- Calculate network stats
     local stats = {
         session_active = State.session_id ~= nil,
-        buffer_fill = math.floor((#State.buffer / (State.settings.buffer_size or config.CONFIG.buffer_max)) * 100),
+        buffer_fill = math.floor((State.buffer.count / (State.settings.buffer_size or config.CONFIG.buffer_max)) * 100),
         connection_errors = State.connection_errors or 0,
         avg_latency = State.avg_chunk_latency or 0,
         bytes_received = State.total_bytes_received or 0,
@@ -1287,9 +1289,9 @@ local function handle_now_playing_click(x, y, width)
         if x >= 2 and x <= 8 then -- Play/Pause
             if State.is_playing then
                 State.is_playing = false
-                State.buffer_size_on_pause = #State.buffer
+                State.buffer_size_on_pause = State.buffer.count
                 if audio then audio.calculate_playback_position() end
-            elseif State.current_song and (#State.buffer > 0 or State.ended) then
+            elseif State.current_song and (State.buffer.count > 0 or State.ended) then
                 State.is_playing = true
                 State.buffer_size_on_pause = 0
                 os.queueEvent("playback")
@@ -1347,9 +1349,9 @@ local function handle_mini_mode_click(x, y)
     if y == 9 and x >= 2 and x <= 8 then
         if State.is_playing then
             State.is_playing = false
-            State.buffer_size_on_pause = #State.buffer
+            State.buffer_size_on_pause = State.buffer.count
             if audio then audio.calculate_playback_position() end
-        elseif State.current_song and (#State.buffer > 0 or State.ended) then
+        elseif State.current_song and (State.buffer.count > 0 or State.ended) then
             State.is_playing = true
             State.buffer_size_on_pause = 0
             os.queueEvent("playback")
@@ -1658,6 +1660,7 @@ local function handle_settings_click(x, y, width)
         {key = "buffer_size", type = "number"},
         {key = "sample_rate", type = "number"},
         {key = "chunk_size", type = "number"},
+        {key = "audio_format", type = "select"},
         {key = "auto_play_next", type = "boolean"},
         {key = "show_visualization", type = "boolean"},
         {key = "theme", type = "select"},
@@ -1690,6 +1693,9 @@ local function handle_settings_click(x, y, width)
                 end
                 State.settings.theme = themes[current_idx % #themes + 1]
                 redraw()
+            elseif setting.type == "select" and setting.key == "audio_format" then
+                State.settings.audio_format = State.settings.audio_format == "dfpwm" and "pcm" or "dfpwm"
+                redraw()
             else
                 State.editing_setting = setting.key
                 State.waiting_input = true
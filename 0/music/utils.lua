@@ -60,6 +60,92 @@ function utils.shuffle(tbl)
     return shuffled
 end
 
+-- Fixed-capacity FIFO of sample tables, used as the playback buffer. A slot keeps its
+-- table after the chunk in it has played and the next chunk is decoded into that table,
+-- so steady playback allocates none. # does not work on a ring: use ring.count
+function utils.ring_new(capacity)
+    return { slots = {}, capacity = capacity, head = 1, count = 0 }
+end
+
+-- Double the capacity, keeping order; only needed when more arrives than was asked for
+local function ring_grow(ring)
+    local slots = {}
+    for i = 1, ring.capacity do
+        slots[i] = ring.slots[(ring.head + i - 2) % ring.capacity + 1]
+    end
+    ring.slots = slots
+    ring.head = 1
+    ring.capacity = ring.capacity * 2
+end
+
+-- Table to decode the next chunk into: the one the tail slot held before, or a new one
+function utils.ring_slot(ring)
+    if ring.count == ring.capacity then
+        ring_grow(ring)
+    end
+    local index = (ring.head + ring.count - 1) % ring.capacity + 1
+    local slot = ring.slots[index]
+    if not slot then
+        slot = {}
+        ring.slots[index] = slot
+    end
+    return slot
+end
+
+-- Append a chunk, normally the table ring_slot returned
+function utils.ring_push(ring, chunk)
+    if ring.count == ring.capacity then
+        ring_grow(ring)
+    end
+    ring.slots[(ring.head + ring.count - 1) % ring.capacity + 1] = chunk
+    ring.count = ring.count + 1
+end
+
+-- Oldest chunk, or nil. Its table is only reused once the ring fills up again,
+-- so it stays valid until the caller next yields
+function utils.ring_pop(ring)
+    if ring.count == 0 then
+        return nil
+    end
+    local chunk = ring.slots[ring.head]
+    ring.head = ring.head % ring.capacity + 1
+    ring.count = ring.count - 1
+    return chunk
+end
+
+-- Drop every chunk, keeping the tables for reuse
+function utils.ring_clear(ring)
+    ring.head = 1
+    ring.count = 0
+end
+
+-- Decode signed 8-bit PCM into out (reused: entries past the new length are cleared).
+-- string.byte takes eight bytes per call; one call per byte dominated decoding
+function utils.decode_pcm(data, out)
+    local byte = string.byte
+    local n = #data
+    local i = 1
+    while i + 7 <= n do
+        local b1, b2, b3, b4, b5, b6, b7, b8 = byte(data, i, i + 7)
+        out[i] = (b1 + 128) % 256 - 128
+        out[i + 1] = (b2 + 128) % 256 - 128
+        out[i + 2] = (b3 + 128) % 256 - 128
+        out[i + 3] = (b4 + 128) % 256 - 128
+        out[i + 4] = (b5 + 128) % 256 - 128
+        out[i + 5] = (b6 + 128) % 256 - 128
+        out[i + 6] = (b7 + 128) % 256 - 128
+        out[i + 7] = (b8 + 128) % 256 - 128
+        i = i + 8
+    end
+    for j = i, n do
+        out[j] = (byte(data, j) + 128) % 256 - 128
+    end
+    for j = #out, n + 1, -1 do
+        out[j] = nil
+    end
+    return out
+end
+
 -- NEW: Version comparison functions (moved from network.lua)
 function utils.parse_version(version_str)
     if not version_str then return {0, 0, 0} end
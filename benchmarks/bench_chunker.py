@@ -0,0 +1,114 @@
+"""Microbenchmark: legacy bytes-concatenation chunking vs PCMChunker.
+
+Feeds a synthetic PCM stream through both implementations with a source
+that, like an FFmpeg pipe, returns at most --pipe-read bytes per read (the
+legacy loop always asks for 4 KiB). Reports throughput and the number of
+objects created and bytes copied per chunk.
+
+    python benchmarks/bench_chunker.py [--megabytes 64] [--repeat 3] [--pipe-read 65536]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server import PCMChunker
+
+CHUNK_SIZES = [1024, 2048, 4096, 8192, 16384, 32768]
+
+
+class PipeLikeSource:
+    """In-memory stream that hands out at most pipe_read bytes per call"""
+
+    def __init__(self, data, pipe_read):
+        self.data = memoryview(data)
+        self.pipe_read = pipe_read
+        self.pos = 0
+
+    def read(self, n):
+        n = min(n, self.pipe_read, len(self.data) - self.pos)
+        out = bytes(self.data[self.pos:self.pos + n])
+        self.pos += n
+        return out
+
+    def readinto(self, buf):
+        n = min(len(buf), self.pipe_read, len(self.data) - self.pos)
+        buf[:n] = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+def legacy_chunks(source, chunk_size, stats=None):
+    """The stream_worker loop before PCMChunker"""
+    buffer = b''
+    while True:
+        raw_data = source.read(4096)
+        if not raw_data:
+            break
+        buffer += raw_data
+        if stats:
+            stats['objects'] += 2  # raw_data, concatenated buffer
+            stats['copied'] += len(buffer)
+        while len(buffer) >= chunk_size:
+            chunk_data = buffer[:chunk_size]
+            buffer = buffer[chunk_size:]
+            if stats:
+                stats['objects'] += 2  # chunk slice, leftover slice
+                stats['copied'] += chunk_size + len(buffer)
+            yield chunk_data
+    if buffer:
+        yield buffer
+
+
+def ring_chunks(source, chunk_size, stats=None):
+    """The PCMChunker loop used by _iter_chunks"""
+    chunker = PCMChunker(source, chunk_size)
+    while chunker.fill():
+        if stats:
+            stats['objects'] += 1  # memoryview over the free part of the ring
+        while True:
+            chunk = chunker.pop()
+            if chunk is None:
+                break
+            if stats:
+                stats['objects'] += 1  # memoryview handed to the consumer
+            yield chunk
+    rest = chunker.remainder()
+    if rest is not None:
+        yield rest
+
+
+def measure(impl, data, chunk_size, repeat, pipe_read):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _chunk in impl(PipeLikeSource(data, pipe_read), chunk_size):
+            pass
+        best = min(best, time.perf_counter() - start)
+
+    stats = {'objects': 0, 'copied': 0}
+    chunks = sum(1 for _ in impl(PipeLikeSource(data, pipe_read), chunk_size, stats))
+    return len(data) / best, stats['objects'] / chunks, stats['copied'] / chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megabytes', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--pipe-read', type=int, default=65536,
+                        help="Largest read the simulated pipe returns (Linux pipes default to 64 KiB)")
+    args = parser.parse_args()
+
+    data = os.urandom(args.megabytes * 1024 * 1024)
+
+    print(f"{'chunk':>6}  {'impl':<7} {'MB/s':>9} {'objs/chunk':>11} {'copied/chunk':>13}")
+    for chunk_size in CHUNK_SIZES:
+        for name, impl in (('legacy', legacy_chunks), ('ring', ring_chunks)):
+            rate, objects, copied = measure(impl, data, chunk_size, args.repeat, args.pipe_read)
+            print(f"{chunk_size:>6}  {name:<7} {rate / 1e6:>9.1f} {objects:>11.2f} {copied:>13.0f}")
+
+
+if __name__ == '__main__':
+    main()
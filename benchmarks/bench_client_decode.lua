@@ -0,0 +1,147 @@
+--[[
+Benchmark: the client's playback path before and after the ring buffer.
+
+Legacy decodes each chunk with one string.byte call per byte into a new
+table, queues it with table.insert / table.remove(buffer, 1) and scales
+every sample into another new table. The current path decodes eight bytes
+per string.byte call into a reused ring slot and only scales below full
+volume. Each path runs for a number of 50 ms ticks (a Minecraft tick) with
+the buffer held at its usual depth; reported is how many samples it gets
+through per tick.
+
+On a ComputerCraft computer with the player installed:
+    bench_client_decode [chunk_size] [ticks] [depth]
+With a stock Lua, from the repository root:
+    lua benchmarks/bench_client_decode.lua [chunk_size] [ticks] [depth]
+]]
+
+local args = { ... }
+local chunk_size = tonumber(args[1]) or 4096
+local ticks = tonumber(args[2]) or 40
+local depth = tonumber(args[3]) or 40
+local TICK = 0.05
+
+local ok, utils = pcall(require, "/music/utils")
+if not ok then
+    local dir = arg and arg[0] and arg[0]:match("^(.*)[/\\]") or "."
+    package.path = dir .. "/../0/music/?.lua;" .. package.path
+    utils = require("utils")
+end
+
+-- Lets the computer run other work between ticks (CC kills code that never yields)
+local function yield()
+    if os.pullEvent then
+        os.queueEvent("bench_tick")
+        os.pullEvent("bench_tick")
+    end
+end
+
+local bytes = {}
+for i = 1, chunk_size do
+    bytes[i] = string.char(math.random(0, 255))
+end
+local chunk_data = table.concat(bytes)
+
+-- The client before the ring buffer
+local function legacy_decode(data)
+    local pcm_samples = {}
+    for i = 1, #data do
+        local signed_byte = string.byte(data, i)
+        if signed_byte > 127 then
+            signed_byte = signed_byte - 256
+        end
+        pcm_samples[i] = signed_byte
+    end
+    return pcm_samples
+end
+
+local function legacy_scale(chunk, volume)
+    local scaled = {}
+    for i = 1, #chunk do
+        local s = math.floor(chunk[i] * volume)
+        s = math.max(-128, math.min(127, s))
+        scaled[i] = s
+    end
+    return scaled
+end
+
+local function legacy_path(volume)
+    local buffer = {}
+    for _ = 1, depth do
+        table.insert(buffer, legacy_decode(chunk_data))
+    end
+    return function()
+        table.insert(buffer, legacy_decode(chunk_data))
+        local chunk = table.remove(buffer, 1)
+        return #legacy_scale(chunk, volume)
+    end
+end
+
+-- The client now (audio.lua scale_chunk, network.lua buffer_chunk)
+local scaled = {}
+
+local function ring_path(volume)
+    local ring = utils.ring_new(depth)
+    for _ = 1, depth - 1 do
+        utils.ring_push(ring, utils.decode_pcm(chunk_data, utils.ring_slot(ring)))
+    end
+    return function()
+        utils.ring_push(ring, utils.decode_pcm(chunk_data, utils.ring_slot(ring)))
+        local chunk = utils.ring_pop(ring)
+        if volume == 1 then
+            return #chunk
+        end
+        local floor, n = math.floor, #chunk
+        for i = 1, n do
+            scaled[i] = floor(chunk[i] * volume)
+        end
+        return n
+    end
+end
+
+-- Samples a path gets through per tick
+local function measure(step)
+    local samples = 0
+    for _ = 1, ticks do
+        local started = os.clock()
+        repeat
+            samples = samples + step()
+        until os.clock() - started >= TICK
+        yield()
+    end
+    return samples / ticks
+end
+
+-- KB a path allocates per chunk once its buffer has cycled, or nil where the runtime does not say
+local function kilobytes_per_chunk(step)
+    local counted, before = pcall(collectgarbage, "count")
+    if not counted or not before or before == 0 then
+        return nil
+    end
+    for _ = 1, depth do
+        step()
+    end
+    collectgarbage("collect")
+    collectgarbage("stop")
+    before = collectgarbage("count")
+    for _ = 1, 20 do
+        step()
+    end
+    local after = collectgarbage("count")
+    collectgarbage("restart")
+    return (after - before) / 20
+end
+
+print(string.format("%d-byte chunks, buffer depth %d, %d ticks of %d ms", chunk_size, depth, ticks, TICK * 1000))
+for _, volume in ipairs({ 1, 0.7 }) do
+    local results = {}
+    for _, case in ipairs({ { "legacy", legacy_path }, { "ring", ring_path } }) do
+        local name, make = case[1], case[2]
+        local per_tick = measure(make(volume))
+        local kb = kilobytes_per_chunk(make(volume))
+        results[name] = per_tick
+        print(string.format("  volume %.1f %-7s %10.0f samples/tick %6.2f chunks/tick %s", volume, name, per_tick,
+            per_tick / chunk_size, kb and string.format("%7.1f KB allocated/chunk", kb) or ""))
+    end
+    print(string.format("  volume %.1f speedup %.2fx", volume, results.ring / results.legacy))
+end
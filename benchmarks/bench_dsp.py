@@ -0,0 +1,99 @@
+"""Benchmark: FFmpeg filter graph vs FFmpeg decode + DSPChain.
+
+Renders a synthetic 44.1 kHz stereo WAV, then transcodes it with both
+engines using the commands the server would run and reports CPU time per
+second of audio: FFmpeg's own CPU (child rusage) plus, for the numpy engine,
+the time spent in DSPChain.process.
+
+    python benchmarks/bench_dsp.py [--seconds 60] [--rates 22050 48000] [--chunk-size 8192]
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server import DSPChain, music_server
+
+SOURCE_RATE = 44100
+
+
+def write_source(path, seconds):
+    """Chords plus noise with a slow swell, so the dynamics stages have work to do"""
+    t = np.arange(int(seconds * SOURCE_RATE)) / SOURCE_RATE
+    tone = sum(np.sin(2 * np.pi * f * t) for f in (110, 220, 330, 1760, 5000)) / 5
+    noise = np.random.default_rng(0).standard_normal(len(t)) * 0.05
+    swell = 0.3 + 0.7 * (0.5 + 0.5 * np.sin(2 * np.pi * t / 7))
+    mono = np.clip((tone + noise) * swell, -1, 1)
+    frames = (np.repeat(mono[:, None], 2, axis=1) * 32767).astype('<i2')
+
+    with wave.open(path, 'wb') as out:
+        out.setnchannels(2)
+        out.setsampwidth(2)
+        out.setframerate(SOURCE_RATE)
+        out.writeframes(frames.tobytes())
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(path, config):
+    """Returns (ffmpeg cpu seconds, in-process dsp cpu seconds, output bytes)"""
+    dsp = DSPChain(config) if config['dsp_engine'] == 'numpy' else None
+    read_size = config['chunk_size'] * (4 if dsp else 1)
+    before = children_cpu()
+    dsp_cpu = 0.0
+    total = 0
+
+    process = subprocess.Popen(music_server.ffmpeg_command(path, config), stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    while True:
+        data = process.stdout.read(read_size)
+        if not data:
+            break
+        if dsp:
+            start = time.process_time()
+            data = dsp.process(data)
+            dsp_cpu += time.process_time() - start
+        total += len(data)
+    process.wait()
+
+    return children_cpu() - before, dsp_cpu, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=int, default=60)
+    parser.add_argument('--rates', type=int, nargs='+', default=[22050, 48000])
+    parser.add_argument('--chunk-size', type=int, default=8192)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'source.wav')
+        write_source(path, args.seconds)
+
+        print(f"{'rate':>6}  {'engine':<7} {'ffmpeg ms/s':>12} {'dsp ms/s':>9} {'total ms/s':>11} {'out s':>7}")
+        for rate in args.rates:
+            for engine in ('ffmpeg', 'numpy'):
+                config = music_server.validate_audio_config({
+                    'sample_rate': rate,
+                    'chunk_size': args.chunk_size,
+                    'dsp_engine': engine
+                })
+                ffmpeg_cpu, dsp_cpu, total = run(path, config)
+                per_second = 1000 / args.seconds
+                print(f"{rate:>6}  {engine:<7} {ffmpeg_cpu * per_second:>12.2f} {dsp_cpu * per_second:>9.2f} "
+                      f"{(ffmpeg_cpu + dsp_cpu) * per_second:>11.2f} {total / rate:>7.1f}")
+
+
+if __name__ == '__main__':
+    main()
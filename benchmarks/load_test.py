@@ -0,0 +1,402 @@
+"""Load test: simulated ComputerCraft clients against a local server, no network needed.
+
+Renders a synthetic WAV (or takes --source), serves it over a local HTTP
+server in place of the YouTube stream URL, and starts the music server in a
+child process with a stub extractor instead of yt_dlp. Each step then runs
+N simulated clients that poll /chunks the way the Lua client does (one
+request in flight, refill below buffer_threshold, at most chunk_batch_max
+per request) and play the audio back in real time, or --speed times faster.
+
+Per step it reports delivered chunks/s, p50/p99 request latency, p50/p99
+time to first chunk, underruns, keep-alive responses, starts turned away
+by admission control, and the server's CPU (its own plus reaped FFmpeg
+children) and RSS. CPU and RSS come from /proc, so those columns need Linux.
+
+    python benchmarks/load_test.py [--sessions 10 50 100] [--duration 30] [--tracks 4]
+                                   [--speed 1.0] [--format pcm] [--no-fast-start]
+                                   [--async | --workers N]
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+SOURCE_RATE = 44100
+
+# Defaults of the Lua client (0/music/config.lua)
+CLIENT_CONFIG = {
+    'buffer_threshold': 20,
+    'buffer_max': 40,
+    'chunk_batch_max': 16,
+    'sample_rate': 48000,
+    'chunk_size': 4096,
+}
+
+
+class StubExtractor:
+    """Stands in for yt_dlp: every video id resolves to the local test source"""
+
+    def __init__(self, url, duration):
+        self.url = url
+        self.duration = duration
+
+    def search(self, query):
+        return [{'id': f'bench-{i}', 'title': f'{query} {i}', 'artist': 'bench',
+                 'duration': self.duration, 'thumbnail': None, 'view_count': 0} for i in range(20)]
+
+    def stream_info(self, video_id):
+        return {'url': self.url, 'title': video_id, 'artist': 'bench', 'duration': self.duration}
+
+
+if os.environ.get('LOAD_TEST_SOURCE_URL'):
+    # Server child (and, with --workers, each spawned worker, which re-imports this
+    # module): swap yt_dlp for the stub before any request arrives
+    import server
+
+    server.music_server.resolver = server.MetadataResolver(
+        StubExtractor(os.environ['LOAD_TEST_SOURCE_URL'], float(os.environ['LOAD_TEST_DURATION'])),
+        os.path.join(server.music_server.pcm_cache.cache_dir, 'stub.sqlite3'))
+
+
+def write_source(path, seconds):
+    """A chord with a slow swell, long enough to outlast the test"""
+    t = np.arange(int(seconds * SOURCE_RATE)) / SOURCE_RATE
+    tone = sum(np.sin(2 * np.pi * f * t) for f in (110, 220, 330, 1760)) / 4
+    swell = 0.3 + 0.7 * (0.5 + 0.5 * np.sin(2 * np.pi * t / 7))
+    frames = (np.repeat((tone * swell)[:, None], 2, axis=1) * 32767).astype('<i2')
+
+    with wave.open(path, 'wb') as out:
+        out.setnchannels(2)
+        out.setsampwidth(2)
+        out.setframerate(SOURCE_RATE)
+        out.writeframes(frames.tobytes())
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_directory(directory):
+    """Background HTTP server for the source file; returns its base URL"""
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+    httpd.handle_error = lambda *args: None  # FFmpeg hanging up mid-file is expected
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{httpd.server_address[1]}"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_server(args):
+    """Serve mode: the child process started by start_server"""
+    import server
+
+    server.music_server.profiling_enabled = False
+    if args.workers != 1:
+        server.worker_pool = server.WorkerPool(args.workers or os.cpu_count() or 1,
+                                               server.music_server.pcm_cache.cache_dir)
+    if args.use_async:
+        import asyncio
+        asyncio.run(server.AsyncStreamServer(server.music_server, server.app).serve('127.0.0.1', args.port))
+    else:
+        server.app.run(host='127.0.0.1', port=args.port, debug=False, threaded=True)
+
+
+def start_server(args, source_url, duration, cache_dir):
+    env = dict(os.environ, LOAD_TEST_SOURCE_URL=source_url, LOAD_TEST_DURATION=str(duration),
+               MUSIC_CACHE_ROOT=cache_dir)
+    cmd = [sys.executable, os.path.abspath(__file__), '--serve', '--port', str(args.port),
+           '--workers', str(args.workers)] + (['--async'] if args.use_async else [])
+    process = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', args.port, timeout=2)
+            conn.request('GET', '/health')
+            if conn.getresponse().status == 200:
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Server did not come up")
+
+
+def process_tree(pid):
+    """pid plus every live descendant, from /proc"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def server_usage(pid):
+    """(CPU seconds incl. reaped children, RSS bytes) of the server and its live descendants"""
+    tick = os.sysconf('SC_CLK_TCK')
+    page = os.sysconf('SC_PAGE_SIZE')
+    cpu = 0.0
+    rss = 0
+    for index, member in enumerate(process_tree(pid)):
+        try:
+            with open(f'/proc/{member}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{member}/statm') as f:
+                rss += int(f.read().split()[1]) * page
+        except OSError:
+            continue
+        # utime, stime, and for the server itself cutime/cstime of children it has reaped
+        cpu += (int(fields[11]) + int(fields[12]) + (int(fields[13]) + int(fields[14]) if index == 0 else 0)) / tick
+    return cpu, rss
+
+
+class SimClient(threading.Thread):
+    """One ComputerCraft player: starts a stream, polls /chunks and plays it back"""
+
+    def __init__(self, port, video_id, audio_config, speed, stop):
+        super().__init__(daemon=True)
+        self.port = port
+        self.video_id = video_id
+        self.audio_config = audio_config
+        rate = audio_config['sample_rate'] * speed
+        self.bytes_per_second = rate / 8 if audio_config['format'] == 'dfpwm' else rate
+        self.stop = stop
+
+        self.latencies = []
+        self.first_chunk = None
+        self.chunks = 0
+        self.underruns = 0
+        self.keepalives = 0
+        self.errors = 0
+        self.rejected = False
+        self.session_id = None
+
+    def request(self, conn, method, path, body=None):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+        response = conn.getresponse()
+        return response, response.read()
+
+    def run(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        started = time.time()
+        try:
+            response, data = self.request(conn, 'POST', '/start_stream',
+                                          {'id': self.video_id, 'audio_config': self.audio_config})
+            if response.status == 503:
+                self.rejected = True  # Turned away by admission control
+                return
+            if response.status != 200:
+                self.errors += 1
+                return
+            self.session_id = json.loads(data)['session_id']
+            self.play(conn, started)
+        except (OSError, http.client.HTTPException, ValueError):
+            self.errors += 1
+        finally:
+            if self.session_id:
+                try:
+                    self.request(conn, 'POST', f'/stop_stream/{self.session_id}')
+                except (OSError, http.client.HTTPException):
+                    pass
+            conn.close()
+
+    def play(self, conn, started):
+        buffered = []  # Byte lengths of chunks waiting to be played
+        head_left = 0  # Unplayed bytes of buffered[0]
+        next_seq = 0
+        playing = False
+        ended = False
+        last = time.time()
+
+        while not self.stop.is_set():
+            now = time.time()
+            if playing:
+                budget = (now - last) * self.bytes_per_second
+                while budget > 0 and buffered:
+                    take = min(budget, head_left)
+                    budget -= take
+                    head_left -= take
+                    if head_left <= 0:
+                        buffered.pop(0)
+                        head_left = buffered[0] if buffered else 0
+                if budget > 0:
+                    if ended:
+                        return
+                    # Ran dry mid-stream: pause until the buffer refills, like the Lua player
+                    self.underruns += 1
+                    playing = False
+            last = now
+
+            if ended or len(buffered) >= CLIENT_CONFIG['buffer_threshold']:
+                time.sleep(0.05)
+                continue
+
+            wanted = min(CLIENT_CONFIG['chunk_batch_max'], CLIENT_CONFIG['buffer_max'] - len(buffered))
+            sent = time.time()
+            response, data = self.request(conn, 'GET', f'/chunks/{self.session_id}?max={wanted}&from={next_seq}')
+            self.latencies.append(time.time() - sent)
+
+            if response.status == 204:
+                ended = True
+                playing = True  # Play out whatever is left
+                continue
+            if response.status != 200:
+                self.errors += 1
+                return
+            if not data:
+                self.keepalives += 1
+                continue
+
+            pos = 0
+            while pos + 4 <= len(data):
+                length = int.from_bytes(data[pos:pos + 4], 'big')
+                if not buffered:
+                    head_left = length
+                buffered.append(length)
+                pos += 4 + length
+                next_seq += 1
+                self.chunks += 1
+            if self.first_chunk is None:
+                self.first_chunk = time.time() - started
+
+            if not playing and len(buffered) >= CLIENT_CONFIG['buffer_threshold']:
+                playing = True
+                last = time.time()
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) * 1000 if values else float('nan')
+
+
+def run_step(args, server_pid, sessions, step):
+    audio_config = {
+        'sample_rate': CLIENT_CONFIG['sample_rate'],
+        'chunk_size': CLIENT_CONFIG['chunk_size'],
+        'format': args.format,
+        'fast_start': not args.no_fast_start,
+        'dsp_engine': args.engine
+    }
+    stop = threading.Event()
+    # Distinct ids per step keep earlier steps' shared transcodes out of the picture
+    clients = [SimClient(args.port, f'bench-{step}-{i % args.tracks}', audio_config, args.speed, stop)
+               for i in range(sessions)]
+
+    cpu_before, _ = server_usage(server_pid)
+    started = time.time()
+    for client in clients:
+        client.start()
+        time.sleep(args.ramp / sessions)
+
+    peak_rss = 0
+    while time.time() - started < args.duration:
+        time.sleep(0.5)
+        peak_rss = max(peak_rss, server_usage(server_pid)[1])
+    stop.set()
+    elapsed = time.time() - started
+    for client in clients:
+        client.join(timeout=10)
+    cpu_after, _ = server_usage(server_pid)
+    time.sleep(1)  # Let stopped sessions release their FFmpeg processes
+
+    latencies = [latency for client in clients for latency in client.latencies]
+    first_chunks = [client.first_chunk for client in clients if client.first_chunk is not None]
+    return {
+        'sessions': sessions,
+        'chunks_per_s': sum(client.chunks for client in clients) / elapsed,
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+        'ttfc_p50_ms': percentile(first_chunks, 50),
+        'ttfc_p99_ms': percentile(first_chunks, 99),
+        'underruns': sum(client.underruns for client in clients),
+        'keepalives': sum(client.keepalives for client in clients),
+        'rejected': sum(client.rejected for client in clients),
+        'errors': sum(client.errors for client in clients),
+        'cpu_pct': (cpu_after - cpu_before) / elapsed * 100,
+        'rss_mb': peak_rss / 1024 ** 2
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, nargs='+', default=[10, 50, 100])
+    parser.add_argument('--duration', type=float, default=30, help="Seconds per step")
+    parser.add_argument('--ramp', type=float, default=5, help="Seconds over which a step's clients start")
+    parser.add_argument('--tracks', type=int, default=4, help="Distinct tracks the clients spread over")
+    parser.add_argument('--speed', type=float, default=1.0, help="Playback speed; >1 consumes faster than real time")
+    parser.add_argument('--format', choices=['pcm', 'dfpwm'], default='pcm')
+    parser.add_argument('--engine', choices=['ffmpeg', 'numpy'], default='ffmpeg')
+    parser.add_argument('--no-fast-start', action='store_true',
+                        help="Start streams without fast start, so clients on one track share a transcode")
+    parser.add_argument('--source', help="Audio file to stream instead of a synthetic tone")
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--async', dest='use_async', action='store_true')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="Print one JSON object per step")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        run_server(args)
+        return
+    if args.port is None:
+        args.port = free_port()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.source:
+            source_dir, name = os.path.split(os.path.abspath(args.source))
+        else:
+            source_dir, name = tmp, 'source.wav'
+            write_source(os.path.join(tmp, name), args.duration + args.ramp + 60)
+        source_url = f"{serve_directory(source_dir)}/{name}"
+
+        cache_dir = os.path.join(tmp, 'cache')
+        server_process = start_server(args, source_url, args.duration + args.ramp + 60, cache_dir)
+        try:
+            if not args.json:
+                print(f"{'sessions':>8} {'chunks/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'ttfc50':>7} "
+                      f"{'ttfc99':>7} {'underrun':>8} {'keepalv':>7} {'rejected':>8} {'errors':>6} {'cpu %':>6} {'rss MB':>7}")
+            for step, sessions in enumerate(args.sessions):
+                row = run_step(args, server_process.pid, sessions, step)
+                if args.json:
+                    print(json.dumps(row))
+                else:
+                    print(f"{row['sessions']:>8} {row['chunks_per_s']:>9.1f} {row['p50_ms']:>8.1f} "
+                          f"{row['p99_ms']:>8.1f} {row['ttfc_p50_ms']:>7.0f} {row['ttfc_p99_ms']:>7.0f} "
+                          f"{row['underruns']:>8} {row['keepalives']:>7} {row['rejected']:>8} {row['errors']:>6} "
+                          f"{row['cpu_pct']:>6.1f} {row['rss_mb']:>7.1f}")
+                sys.stdout.flush()
+        finally:
+            server_process.terminate()
+            server_process.wait(timeout=10)
+
+
+if __name__ == '__main__':
+    main()
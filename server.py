@@ -1,593 +1,3795 @@
 from flask import Flask, request, jsonify, Response
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+from werkzeug.http import HTTP_STATUS_CODES
 import yt_dlp
 import subprocess
-import tempfile
 import os
 import threading
 import time
 import uuid
 import queue
 import logging
-from urllib.parse import unquote
-from functools import lru_cache
+import collections
+from urllib.parse import unquote, parse_qs
 import json
+import mmap
+import asyncio
+import argparse
+import atexit
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeout, as_completed
+import hashlib
+import base64
+import heapq
+import bisect
+import sys
+import itertools
+import sqlite3
+import socket
+import re
+import unicodedata
 import numpy as np
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class OptimizedChunkedMusicServer:
-    def __init__(self):
-        self.temp_dir = tempfile.mkdtemp()
-        self.active_streams = {}
-        self.default_chunk_size = 8192
-        self.buffer_target = 10
-        self.cache_dir = os.path.join(self.temp_dir, "cache")
-        os.makedirs(self.cache_dir, exist_ok=True)
+# Byte value -> signed sample, for reading int8 statistics off a histogram
+SAMPLE_VALUES = np.arange(256, dtype=np.uint8).view(np.int8).astype(np.int64)
+SAMPLE_SQUARES = SAMPLE_VALUES ** 2
+CLIPPED_BINS = np.abs(SAMPLE_VALUES) >= 127
 
-        # Audio quality monitoring
-        self.quality_metrics = {}
+METRICS_DTYPE = np.dtype([
+    ('rms_level', np.float32),
+    ('dynamic_range', np.int16),
+    ('clipping_ratio', np.float32),
+    ('peak_level', np.int16),
+    ('zero_crossing_rate', np.float32),
+    ('timestamp', np.float64)
+])
 
-        # Cleanup old sessions periodically
-        self.cleanup_thread = threading.Thread(target=self._cleanup_loop, daemon=True)
-        self.cleanup_thread.start()
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
 
-    def _cleanup_loop(self):
-        """Periodically clean up inactive sessions"""
-        while True:
-            time.sleep(60)  # Check every minute
-            current_time = time.time()
-            to_remove = []
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
 
-            for session_id, session in self.active_streams.items():
-                if not session['is_active'] and current_time - session['last_activity'] > 300:
-                    to_remove.append(session_id)
+class Counter:
+    """Monotonic counter, optionally split by the value of one label"""
 
-            for session_id in to_remove:
-                self.cleanup_session(session_id)
-                logger.info(f"Cleaned up inactive session: {session_id}")
+    def __init__(self, name, help_text, label_name=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.values = {} if label_name else {'': 0}  # Unlabelled series are exported from zero
+        self.lock = threading.Lock()
 
-    def validate_audio_config(self, config):
-        # Accept any sample rate >= 8000
-        requested_rate = int(config.get('sample_rate', 22050))
-        # Optionally, check if it's in a supported list
-        supported_rates = [48000, 32000, 22050, 16000, 11025, 8000]
-        if requested_rate not in supported_rates:
-            requested_rate = 22050  # fallback
+    def inc(self, amount=1, label=''):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
 
-        return {
-            'sample_rate': requested_rate,
-            'channels': 1,
-            'bit_depth': 8,
-            'chunk_size': min(32768, max(1024, int(config.get('chunk_size', self.default_chunk_size)))),
-            'format': 'pcm',
-            'normalize': config.get('normalize', True),
-            'volume': min(0.9, max(0.1, float(config.get('volume', 0.7)))),  # Lower default for 8-bit
-            'enhance_8bit': config.get('enhance_8bit', True),
-            'dither_method': config.get('dither_method', 'triangular_hp'),
-            'eq_preset': config.get('eq_preset', 'psychoacoustic')
-        }
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help_text}")
+        lines.append(f"# TYPE {self.name} counter")
+        with self.lock:
+            values = sorted(self.values.items())
+        for label, value in values:
+            labels = {self.label_name: label} if self.label_name else {}
+            lines.append(f"{self.name}{format_labels(labels)} {value}")
 
-    @lru_cache(maxsize=100)
-    def search_youtube(self, query):
-        """Search YouTube with caching"""
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': True,
-            'playlist_items': '1:20',
-            'ignoreerrors': True
-        }
+class Histogram:
+    """Cumulative-bucket histogram, optionally split by the value of one label.
 
-        try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(f"ytsearch20:{query}", download=False)
-
-            results = []
-            for entry in info.get('entries', []):
-                if entry:
-                    results.append({
-                        'id': entry.get('id'),
-                        'title': entry.get('title', 'Unknown'),
-                        'artist': entry.get('uploader', 'Unknown'),
-                        'duration': entry.get('duration', 0),
-                        'thumbnail': entry.get('thumbnail'),
-                        'view_count': entry.get('view_count', 0)
-                    })
-
-            return results
-        except Exception as e:
-            logger.error(f"Search error: {e}")
-            return []
+    observe() is a bisect and a few additions under a lock; the buckets are
+    only made cumulative when /metrics renders them.
+    """
 
-    def get_stream_info(self, video_id):
-        """Get stream URL and metadata"""
-        cache_file = os.path.join(self.cache_dir, f"{video_id}.json")
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS, label_name=None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label_name = label_name
+        self.series = {}  # label -> [bucket counts (last is +Inf), sum, count]
+        if not label_name:
+            self.series[''] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        self.lock = threading.Lock()
 
-        # Check cache
-        if os.path.exists(cache_file):
-            try:
-                with open(cache_file, 'r') as f:
-                    cached = json.load(f)
-                if time.time() - cached['timestamp'] < 3600:  # 1 hour cache
-                    return cached['data']
-            except:
-                pass
+    def observe(self, value, label=''):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label)
+            if series is None:
+                series = self.series[label] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
 
-        ydl_opts = {
-            'format': 'bestaudio[ext=m4a]/bestaudio/best',
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'skip_download': True
-        }
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help_text}")
+        lines.append(f"# TYPE {self.name} histogram")
+        with self.lock:
+            series = sorted((label, (list(counts), total, count))
+                            for label, (counts, total, count) in self.series.items())
+        for label, (counts, total, count) in series:
+            labels = {self.label_name: label} if self.label_name else {}
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append(f"{self.name}_bucket{format_labels(dict(labels, le=bound))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {total:.6f}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {count}")
 
-        try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(f"https://youtube.com/watch?v={video_id}", download=False)
-
-            data = {
-                'url': info['url'],
-                'title': info.get('title', 'Unknown'),
-                'artist': info.get('uploader', 'Unknown'),
-                'duration': info.get('duration', 0)
-            }
+class MetricsRegistry:
+    """Process-wide counters and histograms exported in the Prometheus text format"""
 
-            # Cache the result
-            with open(cache_file, 'w') as f:
-                json.dump({'timestamp': time.time(), 'data': data}, f)
+    def __init__(self):
+        self.metrics = []
 
-            return data
-        except Exception as e:
-            logger.error(f"Failed to get stream info: {e}")
-            return None
+    def counter(self, name, help_text, label_name=None):
+        metric = Counter(name, help_text, label_name)
+        self.metrics.append(metric)
+        return metric
 
-    def get_8bit_optimized_filters(self, config):
-        """Generate filters optimized for 8-bit playback - using only common filters"""
-        filters = []
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, label_name=None):
+        metric = Histogram(name, help_text, buckets, label_name)
+        self.metrics.append(metric)
+        return metric
 
-        # Convert to mono if not already
-        filters.append('aformat=channel_layouts=mono')
+    def render(self, gauges=()):
+        """Exposition text; gauges are (name, help, [(labels, value)]) read at scrape time"""
+        lines = []
+        for metric in self.metrics:
+            metric.render(lines)
+        for name, help_text, samples in gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(f"{name}{format_labels(labels)} {value}" for labels, value in samples)
+        return '\n'.join(lines) + '\n'
 
-        # High-pass filter to remove DC and subsonic content
-        filters.append('highpass=f=20')
+METRICS = MetricsRegistry()
+RESOLVE_SECONDS = METRICS.histogram('music_resolve_seconds', 'Stream URL lookups, resolver cache hits included')
+SPAWN_SECONDS = METRICS.histogram('music_ffmpeg_spawn_seconds', 'Time to spawn an FFmpeg process')
+FIRST_CHUNK_SECONDS = METRICS.histogram('music_time_to_first_chunk_seconds',
+                                        'Session start to its first delivered chunk', label_name='source')
+CHUNK_WAIT_SECONDS = METRICS.histogram('music_chunk_wait_seconds',
+                                       'Time a chunk request spent waiting for audio', label_name='route')
+DROPPED_CHUNKS = METRICS.counter('music_dropped_chunks_total',
+                                 'Chunks discarded because a listener fell behind', label_name='policy')
+KEEPALIVE_RESPONSES = METRICS.counter('music_keepalive_responses_total',
+                                      'Empty chunk responses sent while no audio was ready', label_name='route')
+FFMPEG_ERRORS = METRICS.counter('music_ffmpeg_errors_total', 'Error lines reported on FFmpeg stderr')
+PROFILE_SWITCHES = METRICS.counter('music_profile_switches_total',
+                                   'Adaptive sessions moved to a lighter stream profile', label_name='reason')
+BATCH_RESOLVES = METRICS.counter('music_batch_resolves_total',
+                                 'Tracks looked up through /resolve_batch', label_name='result')
 
-        # Psychoacoustic EQ curve for 8-bit - using individual equalizer filters
-        if config.get('eq_preset') == 'psychoacoustic':
-            # Reduce sub-bass
-            filters.append('equalizer=f=80:t=h:g=-3:w=100')
-            # Slight reduction in low-mids
-            filters.append('equalizer=f=250:t=h:g=-1:w=200')
-            # Boost presence for clarity
-            filters.append('equalizer=f=3000:t=h:g=3:w=1000')
-            # Boost high frequencies
-            filters.append('equalizer=f=8000:t=h:g=2:w=2000')
+class SamplingProfiler:
+    """Samples one thread's Python stack at a fixed interval.
 
-        # Simple compression using compand
-        filters.append('compand=attacks=0.003:decays=0.05:points=-80/-80|-60/-60|-40/-30|-20/-15|-10/-10|-5/-8|0/-5:soft-knee=6:gain=5')
+    Results are folded stacks ("outer;...;inner count" per line), the input
+    format of flame graph tools. Sampling runs in the caller's thread, so the
+    profiled thread pays nothing beyond the interpreter's frame snapshot.
+    """
 
-        # Loudness normalization
-        if config['normalize']:
-            filters.append('loudnorm=I=-14:TP=-1:LRA=7')
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
 
-        # Volume adjustment
-        filters.append(f'volume={config["volume"]}')
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
 
-        # Limiter to prevent clipping
-        filters.append('alimiter=limit=0.95:attack=1:release=10')
+    def run(self, seconds):
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break  # Thread has exited
+            names = []
+            while frame is not None:
+                names.append(self._frame_name(frame))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(names))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        return self
 
-        # Resample to target rate
-        filters.append(f'aresample={config["sample_rate"]}')
+    def folded(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
 
-        # Final format conversion with dithering
-        # filters.append('aformat=sample_fmts=s8')
+class AudioMetrics:
+    """Quality metrics for one stream, kept in a fixed-size structured ring.
 
-        return ','.join(filters)
+    Running sums over the most recent ``window`` entries make the averages
+    served by /stream_quality O(1), so every chunk can be measured.
+    """
 
-    def calculate_audio_metrics(self, chunk_data, session_id):
-        """Calculate metrics for audio quality monitoring"""
-        try:
-            # Convert to numpy array
-            audio = np.frombuffer(chunk_data, dtype=np.int8)
-
-            # Calculate RMS level
-            rms = np.sqrt(np.mean(audio.astype(np.float32)**2))
-
-            # Calculate dynamic range usage
-            min_val = np.min(audio)
-            max_val = np.max(audio)
-            dynamic_range = max_val - min_val
-
-            # Detect clipping
-            clipping = np.sum(np.abs(audio) >= 127) / len(audio)
-
-            # Calculate frequency content (simple zero-crossing rate)
-            zero_crossings = np.sum(np.diff(np.sign(audio)) != 0)
-            zcr = zero_crossings / len(audio)
-
-            metrics = {
-                'rms_level': float(rms),
-                'dynamic_range': int(dynamic_range),
-                'clipping_ratio': float(clipping),
-                'peak_level': int(max(abs(min_val), abs(max_val))),
-                'zero_crossing_rate': float(zcr),
-                'timestamp': time.time()
-            }
+    def __init__(self, capacity=1000, window=100):
+        self.ring = np.zeros(capacity, dtype=METRICS_DTYPE)
+        self.capacity = capacity
+        self.window = min(window, capacity)
+        self.count = 0  # Chunks measured so far
+        self.sums = np.zeros(3, dtype=np.float64)  # rms_level, dynamic_range, clipping_ratio
+        self.lock = threading.Lock()
 
-            # Store metrics for monitoring
-            if session_id not in self.quality_metrics:
-                self.quality_metrics[session_id] = []
+    @staticmethod
+    def measure(chunk_data):
+        """All per-chunk statistics from one histogram pass plus a sign comparison; None if empty"""
+        audio = np.frombuffer(chunk_data, dtype=np.int8)
+        n = len(audio)
+        if not n:
+            return None
+        counts = np.bincount(audio.view(np.uint8), minlength=256)
 
-            self.quality_metrics[session_id].append(metrics)
+        present = SAMPLE_VALUES[counts > 0]
+        min_val = int(present.min())
+        max_val = int(present.max())
 
-            # Keep only recent metrics (last 100)
-            if len(self.quality_metrics[session_id]) > 100:
-                self.quality_metrics[session_id] = self.quality_metrics[session_id][-100:]
+        # Calculate frequency content (simple zero-crossing rate)
+        signs = np.sign(audio)
+        zero_crossings = np.count_nonzero(signs[1:] != signs[:-1])
 
-            return metrics
-        except Exception as e:
-            logger.error(f"Error calculating audio metrics: {e}")
-            return None
+        return (
+            float(np.sqrt(counts @ SAMPLE_SQUARES / n)),
+            max_val - min_val,
+            float(counts[CLIPPED_BINS].sum() / n),
+            max(abs(min_val), abs(max_val)),
+            float(zero_crossings / n),
+            time.time()
+        )
 
-    def create_stream_session(self, video_id, audio_config):
-        """Create a new streaming session"""
-        session_id = str(uuid.uuid4())
-        config = self.validate_audio_config(audio_config)
+    def record(self, chunk_data):
+        entry = self.measure(chunk_data)
+        if entry is None:
+            return None  # An empty chunk has nothing to measure and would skew the averages
+        with self.lock:
+            slot = self.count % self.capacity
+            if self.count >= self.window:
+                # Drop the entry leaving the averaging window from the running sums
+                old = self.ring[(self.count - self.window) % self.capacity]
+                self.sums -= (old['rms_level'], old['dynamic_range'], old['clipping_ratio'])
+            self.ring[slot] = entry
+            self.sums += entry[:3]
+            self.count += 1
+        return self._as_dict(entry)
 
-        session = {
-            'session_id': session_id,
-            'video_id': video_id,
-            'audio_config': config,
-            'chunk_queue': queue.Queue(maxsize=30),
-            'is_active': True,
-            'error': None,
-            'ready': threading.Event(),
-            'total_chunks_sent': 0,
-            'start_time': time.time(),
-            'last_activity': time.time(),
-            'metadata': None,
-            'process': None
+    @staticmethod
+    def _as_dict(entry):
+        return {
+            'rms_level': float(entry[0]),
+            'dynamic_range': int(entry[1]),
+            'clipping_ratio': float(entry[2]),
+            'peak_level': int(entry[3]),
+            'zero_crossing_rate': float(entry[4]),
+            'timestamp': float(entry[5])
         }
 
-        self.active_streams[session_id] = session
+    def latest(self):
+        with self.lock:
+            if not self.count:
+                return None
+            return self._as_dict(self.ring[(self.count - 1) % self.capacity].item())
 
-        thread = threading.Thread(
-            target=self.stream_worker,
-            args=(session,),
-            daemon=True
-        )
-        thread.start()
+    def averages(self):
+        """Aggregates over the recent window, in the shape calculate_quality_score expects"""
+        with self.lock:
+            recent = min(self.count, self.window)
+            if not recent:
+                return None
+            end = self.count % self.capacity
+            start = end - recent
+            if start >= 0:
+                peaks = self.ring['peak_level'][start:end]
+            else:
+                peaks = np.concatenate((self.ring['peak_level'][start:], self.ring['peak_level'][:end]))
 
-        return session_id, config
+            return {
+                'avg_rms_level': float(self.sums[0] / recent),
+                'avg_dynamic_range': float(self.sums[1] / recent),
+                'avg_clipping_ratio': float(self.sums[2] / recent),
+                'max_peak_level': int(peaks.max()),
+                'recent_samples': recent,
+                'total_samples': min(self.count, self.capacity)
+            }
 
-    def stream_worker(self, session):
-        """Worker thread for streaming audio with 8-bit optimizations"""
-        session_id = session['session_id']
-        video_id = session['video_id']
-        config = session['audio_config']
+class BroadcastChannel:
+    """Shared transcode output for every session playing the same track and config.
 
-        try:
-            # Get stream info
-            stream_info = self.get_stream_info(video_id)
-            if not stream_info:
-                raise Exception("Failed to get stream URL")
+    A single producer appends chunks to a bounded ring; each listening session
+    keeps its own cursor into it, so N listeners cost one FFmpeg process.
 
-            session['metadata'] = stream_info
-            stream_url = stream_info['url']
+    The producer follows the fastest listener, so one stalled or vanished
+    client never holds up the rest; slow listeners lose chunks instead
+    ("drop-oldest" once they fall off the ring, "skip-to-live" as soon as
+    they are lead chunks behind, "lossless" jumps to the live edge once off
+    the ring). Only a sole "lossless" listener holds the producer to its pace.
+    """
 
-            # Use optimized 8-bit filter chain
-            filter_str = self.get_8bit_optimized_filters(config)
+    def __init__(self, key, video_id, config, capacity=256, lead=30, prefetch=False):
+        self.channel_id = str(uuid.uuid4())
+        self.key = key
+        self.video_id = video_id
+        self.config = config
+        self.capacity = capacity  # Chunks retained for late joiners and slow listeners
+        self.lead = lead  # How far the producer may run ahead of the fastest listener
+        self.chunks = collections.deque()
+        self.base_index = 0  # Absolute index of self.chunks[0]
+        self.cond = threading.Condition()
+        self.listeners = {}  # session_id -> absolute read cursor
+        self.policy = config.get('backpressure', 'lossless')
+        self.dropped = {}  # session_id -> chunks skipped over
+        self.stalled = 0.0  # Seconds the producer spent waiting for listeners
+        self.ready = threading.Event()
+        self.is_active = True
+        self.finished = False
+        self.error = None
+        self.metadata = None
+        self.process = None
+        self.admission = 0  # Footprint reserved with the AdmissionController
+        # Prefetched channels run at low priority until someone listens
+        self.prefetch = prefetch
+        self.created = time.time()
+        self.timings = {}  # Startup stages of the shared transcode, ms after created
+        self.thread_id = None
 
-            cmd = [
-                'ffmpeg',
-                '-reconnect', '1',
-                '-reconnect_streamed', '1',
-                '-reconnect_delay_max', '5',
-                '-i', stream_url,
-                '-af', filter_str,
-                '-f', 's8',
-                '-acodec', 'pcm_s8',
-                '-ac', '1',
-                '-'
-            ]
+    @property
+    def head_index(self):
+        return self.base_index + len(self.chunks)
 
-            logger.info(f"Starting FFmpeg with command: {' '.join(cmd[:10])}...")  # Log first part of command
+    def has_start(self):
+        """True while the first chunk of the track is still in the ring"""
+        return self.base_index == 0
 
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                bufsize=0
-            )
+    def attach(self, session_id, join='start'):
+        """Register a listener, starting at the oldest retained chunk or at the live edge"""
+        with self.cond:
+            cursor = self.head_index if join == 'live' else self.base_index
+            self.listeners[session_id] = cursor
+            return cursor
 
-            session['process'] = process
+    def detach(self, session_id):
+        """Remove a listener and return how many remain"""
+        with self.cond:
+            self.listeners.pop(session_id, None)
+            self.dropped.pop(session_id, None)
+            self.cond.notify_all()
+            return len(self.listeners)
 
-            # Monitor stderr in separate thread for errors
-            def stderr_reader():
-                for line in process.stderr:
-                    decoded_line = line.decode('utf-8', errors='ignore').strip()
-                    if decoded_line:
-                        if 'error' in decoded_line.lower():
-                            logger.warning(f"FFmpeg error in session {session_id}: {decoded_line}")
-                        else:
-                            logger.debug(f"FFmpeg output: {decoded_line}")
+    def pending(self, session_id):
+        """Number of chunks buffered ahead of a listener's cursor"""
+        with self.cond:
+            cursor = self.listeners.get(session_id)
+            if cursor is None:
+                return 0
+            return self.head_index - max(cursor, self.base_index)
 
-            stderr_thread = threading.Thread(target=stderr_reader, daemon=True)
-            stderr_thread.start()
+    def publish(self, chunk):
+        """Append a chunk, running at most lead chunks ahead of the fastest listener.
 
-            chunk_size = config['chunk_size']
-            buffer = b''
-            first_chunk_sent = False
-            consecutive_errors = 0
-            chunks_processed = 0
+        A sole listener is also the fastest, so a lossless one holds the
+        producer to its own pace and loses nothing.
+        """
+        with self.cond:
+            # Without listeners (a prefetch) the buffer itself is capped at lead chunks
+            waited = time.time()
+            while self.is_active and self.head_index - max(self.listeners.values(), default=0) >= self.lead:
+                self.cond.wait(0.5)
+            self.stalled += time.time() - waited
 
-            while session['is_active'] and process.poll() is None:
-                try:
-                    raw_data = process.stdout.read(4096)
-                    if not raw_data:
-                        consecutive_errors += 1
-                        if consecutive_errors > 5:
-                            break
-                        time.sleep(0.1)
-                        continue
+            self.chunks.append(chunk)
+            if len(self.chunks) > self.capacity:
+                # Listeners still behind this point skip ahead on their next read
+                self.chunks.popleft()
+                self.base_index += 1
+            self.cond.notify_all()
 
-                    consecutive_errors = 0
-                    buffer += raw_data
-
-                    while len(buffer) >= chunk_size:
-                        chunk_data = buffer[:chunk_size]
-                        buffer = buffer[chunk_size:]
-
-                        # Calculate audio metrics periodically
-                        if chunks_processed % 10 == 0:  # Every 10th chunk
-                            metrics = self.calculate_audio_metrics(chunk_data, session_id)
-                            if metrics and metrics['clipping_ratio'] > 0.01:
-                                logger.warning(f"High clipping detected in session {session_id}: {metrics['clipping_ratio']:.2%}")
-
-                        try:
-                            session['chunk_queue'].put(chunk_data, timeout=0.5)
-                            session['total_chunks_sent'] += 1
-                            session['last_activity'] = time.time()
-                            chunks_processed += 1
-
-                            if not first_chunk_sent:
-                                session['ready'].set()
-                                first_chunk_sent = True
-                                logger.info(f"First chunk ready for session {session_id}")
-
-                        except queue.Full:
-                            # Client is slow, skip some chunks to catch up
-                            logger.debug(f"Buffer full for session {session_id}, dropping chunk")
-                            try:
-                                session['chunk_queue'].get_nowait()
-                            except:
-                                pass
+    def finish(self, error=None):
+        with self.cond:
+            self.finished = True
+            if error:
+                self.error = error
+            self.cond.notify_all()
+        self.ready.set()
 
-                except Exception as e:
-                    logger.error(f"Error reading stream data: {e}")
-                    consecutive_errors += 1
-                    if consecutive_errors > 10:
-                        break
-                    time.sleep(0.1)
+    def read(self, session_id, timeout=2.0):
+        """Next chunk for a listener, b'' on timeout, None once the stream is over"""
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                cursor = self.listeners.get(session_id)
+                if cursor is None:
+                    return None
 
-            # Send remaining buffer
-            if buffer and session['is_active']:
-                try:
-                    session['chunk_queue'].put(buffer, timeout=0.5)
-                except:
-                    pass
+                if self.policy == 'skip-to-live' and self.head_index - cursor > self.lead:
+                    skip_to = self.head_index - 1
+                elif self.policy == 'lossless' and cursor < self.base_index:
+                    # Others set the pace and this listener fell off the ring: rejoin at the live edge
+                    skip_to = self.head_index - 1
+                else:
+                    skip_to = max(cursor, self.base_index)
+                if skip_to > cursor:
+                    self.dropped[session_id] = self.dropped.get(session_id, 0) + skip_to - cursor
+                    DROPPED_CHUNKS.inc(skip_to - cursor, self.policy)
+                    cursor = skip_to
 
-            # Clean up process
-            if process.poll() is None:
-                process.terminate()
-                try:
-                    process.wait(timeout=5)
-                except:
-                    process.kill()
+                if cursor < self.head_index:
+                    chunk = self.chunks[cursor - self.base_index]
+                    self.listeners[session_id] = cursor + 1
+                    self.cond.notify_all()
+                    return chunk
 
-        except Exception as e:
-            logger.error(f"Stream worker error for session {session_id}: {e}")
-            session['error'] = str(e)
-        finally:
-            session['is_active'] = False
-            # Signal end of stream
-            try:
-                session['chunk_queue'].put(None, timeout=0.1)
-            except:
-                pass
-            session['ready'].set()
-            logger.info(f"Stream worker ended for session {session_id}")
+                if self.finished or not self.is_active:
+                    return None
 
-    def get_next_chunk(self, session_id):
-        """Get next audio chunk for session"""
-        session = self.active_streams.get(session_id)
-        if not session:
-            return None
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return b''
+                self.cond.wait(remaining)
 
-        session['last_activity'] = time.time()
+class PCMCache:
+    """Persistent cache of transcoded s8 PCM with a size budget.
 
-        # Wait for stream to be ready
-        if not session['ready'].wait(timeout=15):
-            logger.warning(f"Stream timeout for session {session_id}")
-            return None
+    Finished transcodes are stored as raw PCM files next to a JSON index that
+    survives restarts, and replayed through mmap without starting FFmpeg.
+    Inserts and evictions write the index at once; hits only update it in
+    memory, for flush() to write out (every cleanup pass, and at exit).
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3, policy='lru'):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.policy = policy  # 'lru' or 'lfu'
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock = threading.Lock()
+        self.dirty = False  # Hits not yet written to the index
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.entries = self._load_index()
+        self.total_bytes = sum(entry['size'] for entry in self.entries.values())
+        with self.lock:
+            self._evict_locked()
+            self._save_index_locked()
+        atexit.register(self.flush)
 
+    @staticmethod
+    def make_key(video_id, config):
+        """Cache key covering every setting that changes the transcoded output"""
+        key = (f"{video_id}|{config['sample_rate']}|{config['eq_preset']}|"
+               f"{int(bool(config['normalize']))}|{config['volume']:.2f}")
+        # The two engines approximate each other but are not byte-identical
+        return key + '|numpy' if config.get('dsp_engine') == 'numpy' else key
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pcm')
+
+    def _load_index(self):
+        entries = {}
         try:
-            chunk = session['chunk_queue'].get(timeout=2.0)
-            return chunk
-        except queue.Empty:
-            # Check if stream is still active
-            if session['is_active']:
-                return b''  # Return empty chunk to keep connection alive
-            return None
+            with open(self.index_path, 'r') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Discarding unreadable PCM cache index: {e}")
 
-    def cleanup_session(self, session_id):
-        """Clean up streaming session"""
-        session = self.active_streams.pop(session_id, None)
-        if session:
-            session['is_active'] = False
-            if session.get('process'):
+        # Drop entries whose file vanished, and partial files from interrupted transcodes
+        entries = {key: entry for key, entry in entries.items()
+                   if os.path.exists(self._path(key))}
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.part'):
                 try:
-                    session['process'].terminate()
-                    session['process'].wait(timeout=2)
-                except:
-                    try:
-                        session['process'].kill()
-                    except:
-                        pass
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+        return entries
 
-            # Clean up quality metrics
-            self.quality_metrics.pop(session_id, None)
+    def _save_index_locked(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.index_path)
+        self.dirty = False
 
-            logger.info(f"Cleaned up session {session_id}")
+    def flush(self):
+        """Write out access statistics that changed since the index was last saved"""
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                self._save_index_locked()
+            except OSError as e:
+                logger.warning(f"Could not save PCM cache index: {e}")
 
-# Initialize server
-music_server = OptimizedChunkedMusicServer()
+    def _evict_locked(self):
+        if self.policy == 'lfu':
+            rank = lambda key: (self.entries[key]['hits'], self.entries[key]['last_access'])
+        else:
+            rank = lambda key: self.entries[key]['last_access']
 
-# API Routes
-@app.route('/')
-def search_endpoint():
-    """Search for music"""
-    search_query = request.args.get('search')
-    if not search_query:
-        return jsonify({'error': 'No search query provided'}), 400
+        while self.total_bytes > self.max_bytes and self.entries:
+            victim = min(self.entries, key=rank)
+            entry = self.entries.pop(victim)
+            self.total_bytes -= entry['size']
+            try:
+                # Sessions already replaying it keep their mapping
+                os.remove(self._path(victim))
+            except OSError:
+                pass
+            logger.info(f"Evicted cached PCM for {victim}")
 
-    search_query = unquote(search_query)
-    results = music_server.search_youtube(search_query)
-    return jsonify(results)
+    def contains(self, key):
+        with self.lock:
+            return key in self.entries
 
-@app.route('/audio_capabilities')
-def audio_capabilities():
-    """Get server audio capabilities with 8-bit optimizations"""
-    return jsonify({
-        'supported_sample_rates': [32000, 22050, 16000, 11025, 8000],  # Lower rates for 8-bit
-        'supported_bit_depths': [8],
-        'supported_channels': [1],
-        'supported_formats': ['pcm'],
-        'features': [
-            'normalize',
-            'volume_control',
-            'compression',
-            'psychoacoustic_eq',
-            'quality_monitoring',
-            'dynamic_range_optimization'
-        ],
-        'eq_presets': [
-            'psychoacoustic',
-            'flat',
-            'voice',
-            'music'
-        ],
-        'default_config': {
-            'sample_rate': 22050,  # Optimal for 8-bit
-            'channels': 1,
-            'bit_depth': 8,
-            'chunk_size': 8192,
-            'format': 'pcm',
-            'normalize': True,
-            'volume': 0.7,
-            'enhance_8bit': True,
-            'eq_preset': 'psychoacoustic'
-        },
-        'max_buffer_size': 30,
-        'target_latency_ms': 200,
-        'version': '3.0'
-    })
+    def open(self, key):
+        """Map a cached transcode into memory, returning (mmap, entry) or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            try:
+                with open(self._path(key), 'rb') as f:
+                    view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Dropping broken PCM cache entry {key}: {e}")
+                self.entries.pop(key)
+                self.total_bytes -= entry['size']
+                self._save_index_locked()
+                return None
 
-@app.route('/start_stream', methods=['POST'])
-def start_stream():
-    """Start a new streaming session"""
-    data = request.get_json() or {}
-    video_id = data.get('id') or request.args.get('id')
+            # Replays are the hot path: no disk write for the statistics here
+            entry['hits'] += 1
+            entry['last_access'] = time.time()
+            self.dirty = True
+            return view, entry
 
-    if not video_id:
-        return jsonify({'error': 'No video ID provided'}), 400
+    def writer(self, key):
+        return PCMCacheWriter(self, key)
 
-    audio_config = data.get('audio_config', {})
+    def _commit(self, key, part_path, size, metadata):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.total_bytes -= old['size']
+            os.replace(part_path, self._path(key))
+            now = time.time()
+            self.entries[key] = {
+                'size': size,
+                'created': now,
+                'last_access': now,
+                'hits': 0,
+                'metadata': metadata
+            }
+            self.total_bytes += size
+            self._evict_locked()
+            self._save_index_locked()
+        logger.info(f"Cached {size} bytes of PCM for {key}")
 
-    try:
-        session_id, validated_config = music_server.create_stream_session(video_id, audio_config)
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'policy': self.policy
+            }
 
-        return jsonify({
-            'session_id': session_id,
-            'chunk_endpoint': f'/chunk/{session_id}',
-            'audio_config': validated_config,
-            'status': 'started',
-            'estimated_first_chunk_ms': 1000
-        })
-    except Exception as e:
-        logger.error(f"Failed to start stream: {e}")
-        return jsonify({'error': 'Failed to create stream session'}), 500
+class PCMCacheWriter:
+    """Tees a transcode into a partial cache file that is only published once complete"""
 
-@app.route('/chunk/<session_id>')
-def get_chunk(session_id):
-    """Get next audio chunk"""
-    chunk = music_server.get_next_chunk(session_id)
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.part_path = f"{cache._path(key)}.{uuid.uuid4().hex}.part"
+        self.size = 0
+        try:
+            self.file = open(self.part_path, 'wb')
+        except OSError as e:
+            logger.warning(f"PCM cache disabled for {key}: {e}")
+            self.file = None
 
-    if chunk is None:
-        music_server.cleanup_session(session_id)
-        return Response('', status=204)
+    def write(self, data):
+        if not self.file:
+            return
+        try:
+            self.file.write(data)
+            self.size += len(data)
+        except OSError as e:
+            logger.warning(f"PCM cache write failed for {self.key}: {e}")
+            self.abort()
 
-    return Response(
-        chunk,
-        content_type='application/octet-stream',
-        headers={
-            'Cache-Control': 'no-cache, no-store, must-revalidate',
-            'X-Chunk-Size': str(len(chunk)),
-            'X-Session-Active': 'true' if chunk else 'false'
-        }
-    )
+    def commit(self, metadata):
+        if not self.file:
+            return
+        self.file.close()
+        self.file = None
+        if self.size == 0:
+            self._remove_part()
+            return
+        try:
+            self.cache._commit(self.key, self.part_path, self.size, metadata)
+        except OSError as e:
+            logger.warning(f"PCM cache commit failed for {self.key}: {e}")
+            self._remove_part()
 
-@app.route('/stop_stream/<session_id>', methods=['POST'])
-def stop_stream(session_id):
-    """Stop streaming session"""
-    music_server.cleanup_session(session_id)
-    return jsonify({'status': 'stopped'})
+    def abort(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        self._remove_part()
 
-@app.route('/stream_info/<session_id>')
-def stream_info(session_id):
-    """Get streaming session info"""
-    session = music_server.active_streams.get(session_id)
-    if not session:
-        return jsonify({'error': 'Session not found'}), 404
+    def _remove_part(self):
+        try:
+            os.remove(self.part_path)
+        except OSError:
+            pass
 
-    return jsonify({
-        'session_id': session_id,
-        'is_active': session['is_active'],
-        'is_ready': session['ready'].is_set(),
-        'chunks_buffered': session['chunk_queue'].qsize(),
-        'total_chunks_sent': session['total_chunks_sent'],
-        'elapsed_seconds': round(time.time() - session['start_time'], 2),
-        'audio_config': session['audio_config'],
-        'metadata': session.get('metadata'),
-        'error': session.get('error')
-    })
+class SpectrumAnalyzer:
+    """Visualization frames for a stream: one byte each of RMS, peak and log-spaced band levels.
 
-@app.route('/stream_quality/<session_id>')
-def stream_quality(session_id):
-    """Get audio quality metrics for a session"""
-    metrics = music_server.quality_metrics.get(session_id, [])
+    A chunk is cut into fft_size frames (zero-padded when shorter) that go
+    through one batched rfft; band power is the Hann-windowed power summed
+    over each band's bins and averaged over the frames, mapped from
+    -60..0 dB of a full-scale sine onto 0..255. Bands run from 60 Hz to
+    Nyquist with at least one bin each.
+    """
 
-    if not metrics:
-        return jsonify({'error': 'No metrics available'}), 404
+    MIN_BANDS = 4
+    MAX_BANDS = 16
+    DEFAULT_BANDS = 8
+    FLOOR_DB = 60
 
-    # Calculate averages
-    recent_metrics = metrics[-10:] if len(metrics) > 10 else metrics
+    def __init__(self, bands, sample_rate):
+        self.bands = bands
+        # About 20 Hz per bin, so the lowest bands are not empty
+        self.fft_size = 1 << int(round(np.log2(sample_rate / 20)))
+        self.window = np.hanning(self.fft_size).astype(np.float32)
+        # One-sided power -> mean square of the windowed signal in that band
+        self.scale = 2 / (self.fft_size * float(np.sum(self.window ** 2)))
 
-    avg_metrics = {
-        'avg_rms_level': np.mean([m['rms_level'] for m in recent_metrics]),
-        'avg_dynamic_range': np.mean([m['dynamic_range'] for m in recent_metrics]),
-        'avg_clipping_ratio': np.mean([m['clipping_ratio'] for m in recent_metrics]),
-        'max_peak_level': max([m['peak_level'] for m in recent_metrics]),
-        'recent_samples': len(recent_metrics),
-        'total_samples': len(metrics)
-    }
+        bin_hz = sample_rate / self.fft_size
+        edges = np.geomspace(60, sample_rate / 2, bands + 1) / bin_hz
+        bounds = np.round(edges).astype(int)
+        for i in range(1, bands + 1):
+            bounds[i] = max(bounds[i], bounds[i - 1] + 1)
+        self.starts = bounds[:-1]
+        self.stop = min(bounds[-1], self.fft_size // 2 + 1)
 
-    return jsonify({
-        'session_id': session_id,
-        'current_metrics': metrics[-1] if metrics else None,
-        'average_metrics': avg_metrics,
-        'quality_score': calculate_quality_score(avg_metrics)
+    @classmethod
+    def band_count(cls, requested):
+        """Bands for a requested audio_config value: 0 for none, True for the default"""
+        if requested is True:
+            return cls.DEFAULT_BANDS
+        bands = int(requested or 0)
+        return min(cls.MAX_BANDS, max(cls.MIN_BANDS, bands)) if bands > 0 else 0
+
+    def frame(self, pcm):
+        samples = np.frombuffer(pcm, dtype=np.int8).astype(np.float32) / 128
+        if not len(samples):
+            return bytes(2 + self.bands)
+        rms = float(np.sqrt(np.mean(samples * samples)))
+        peak = float(np.max(np.abs(samples)))
+
+        whole = len(samples) // self.fft_size * self.fft_size
+        if whole:
+            frames, window, scale = samples[:whole].reshape(-1, self.fft_size), self.window, self.scale
+        else:
+            # Shorter than one frame (a fast start's first chunk): window what there is and zero-pad
+            frames = samples[None, :]
+            window = np.hanning(len(samples)).astype(np.float32)
+            scale = 2 / (self.fft_size * max(float(np.sum(window ** 2)), 1e-9))
+        spectrum = np.fft.rfft(frames * window, n=self.fft_size, axis=1)
+        power = (spectrum.real ** 2 + spectrum.imag ** 2).mean(axis=0)[:self.stop]
+        band_power = np.add.reduceat(power, self.starts) * scale
+        # A full-scale sine has a mean square of 0.5
+        levels = 10 * np.log10(np.maximum(band_power * 2, 1e-12))
+        levels = np.clip((levels + self.FLOOR_DB) * (255 / self.FLOOR_DB), 0, 255)
+
+        header = np.empty(2 + self.bands, dtype=np.uint8)
+        header[0] = min(255, round(rms * 255))
+        header[1] = min(255, round(peak * 255))
+        header[2:] = np.round(levels)
+        return header.tobytes()
+
+class DFPWMEncoder:
+    """Stateful DFPWM1a encoder producing the same bits as cc.audio.dfpwm.
+
+    Each bit depends on the charge/strength state left by the previous one, so
+    the decisions run as a tight loop over Python ints; NumPy converts the s8
+    input and packs the bits LSB-first. State carries over between chunks.
+    """
+
+    PREC = 10
+
+    def __init__(self):
+        self.charge = 0
+        self.strength = 0
+        self.previous_bit = False
+
+    def encode(self, pcm):
+        """Encode s8 PCM (8 samples per output byte, the last byte zero-padded)"""
+        samples = np.frombuffer(pcm, dtype=np.int8).tolist()
+        bits = bytearray(len(samples))
+        charge, strength, previous_bit = self.charge, self.strength, self.previous_bit
+        rounding = 1 << (self.PREC - 1)
+        max_strength = (1 << self.PREC) - 1
+        min_strength = 2 << (self.PREC - 8)
+
+        for i, sample in enumerate(samples):
+            current_bit = sample > charge or (sample == charge and charge == 127)
+            target = 127 if current_bit else -128
+
+            next_charge = charge + ((strength * (target - charge) + rounding) >> self.PREC)
+            if next_charge == charge and next_charge != target:
+                next_charge += 1 if current_bit else -1
+
+            if current_bit == previous_bit:
+                if strength != max_strength:
+                    strength += 1
+            elif strength != 0:
+                strength -= 1
+            if strength < min_strength:
+                strength = min_strength
+
+            charge = next_charge
+            previous_bit = current_bit
+            bits[i] = current_bit
+
+        self.charge, self.strength, self.previous_bit = charge, strength, previous_bit
+        return np.packbits(np.frombuffer(bits, dtype=np.uint8), bitorder='little').tobytes()
+
+# Psychoacoustic EQ for 8-bit playback: (centre Hz, gain dB, bandwidth Hz)
+PSYCHOACOUSTIC_EQ = [
+    (80, -3, 100),     # Reduce sub-bass
+    (250, -1, 200),    # Slight reduction in low-mids
+    (3000, 3, 1000),   # Boost presence for clarity
+    (8000, 2, 2000),   # Boost high frequencies
+]
+
+# Producer behaviour when a listener falls behind, see enqueue_chunk
+BACKPRESSURE_POLICIES = ('lossless', 'drop-oldest', 'skip-to-live')
+
+# Most chunks one /chunks response carries; a batch holds them all at once
+MAX_BATCH_CHUNKS = 64
+
+# Output rates a client may ask for, and the ladder adaptive sessions step down
+PROFILE_SAMPLE_RATES = [48000, 32000, 22050, 16000, 11025, 8000]
+
+# Compressor transfer curve (input dB, output dB) and make-up gain
+COMPAND_POINTS = [(-80, -80), (-60, -60), (-40, -30), (-20, -15), (-10, -10), (-5, -8), (0, -5)]
+COMPAND_GAIN_DB = 5
+
+def _pole_scan(x, pole, state):
+    """Run y[n] = x[n] + pole * y[n-1] over a whole array.
+
+    The recursion is solved in closed form inside blocks short enough that
+    pole**-block stays below 1e6, so each block is one cumsum; only the block
+    boundaries are carried in a Python loop. Returns (y, last output).
+    """
+    radius = abs(pole)
+    if radius < 1e-6:
+        return x, x[-1]
+    block = 256 if radius ** 256 >= 1e-6 else max(1, int(13.8 / -np.log(radius)))
+    nblocks = -(-len(x) // block)
+
+    padded = np.zeros(nblocks * block, dtype=np.complex128)
+    padded[:len(x)] = x
+    steps = np.arange(block)
+    local = np.cumsum(padded.reshape(nblocks, block) * pole ** -steps, axis=1) * pole ** steps
+
+    # Output of the previous block's last sample, fed into each block
+    carry = np.empty(nblocks, dtype=np.complex128)
+    decay = pole ** block
+    for j, end in enumerate(local[:, -1]):
+        carry[j] = state
+        state = end + decay * state
+
+    y = (local + np.outer(carry, pole ** (steps + 1))).reshape(-1)[:len(x)]
+    return y, y[-1]
+
+class Biquad:
+    """Second-order IIR section with state kept between chunks.
+
+    The feed-forward taps are plain array arithmetic; the two poles run as
+    complex first-order scans (see _pole_scan), which gives the same output as
+    a direct-form loop without iterating per sample in Python.
+    """
+
+    def __init__(self, b, a):
+        self.b = np.asarray(b, dtype=np.float64) / a[0]
+        a1, a2 = a[1] / a[0], a[2] / a[0]
+        root = np.sqrt(complex(a1 * a1 - 4 * a2))
+        self.poles = ((-a1 + root) / 2, (-a1 - root) / 2)
+        self.inputs = np.zeros(2)
+        self.states = [0j, 0j]
+
+    @classmethod
+    def highpass(cls, freq, rate, q=0.707):
+        w0 = 2 * np.pi * freq / rate
+        alpha = np.sin(w0) / (2 * q)
+        cos_w0 = np.cos(w0)
+        return cls([(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2],
+                   [1 + alpha, -2 * cos_w0, 1 - alpha])
+
+    @classmethod
+    def peaking(cls, freq, gain_db, width, rate):
+        """Peaking EQ with the bandwidth given in Hz, as FFmpeg's equalizer=t=h"""
+        w0 = 2 * np.pi * freq / rate
+        alpha = np.sin(w0) / (2 * freq / width)
+        amp = 10 ** (gain_db / 40)
+        cos_w0 = np.cos(w0)
+        return cls([1 + alpha * amp, -2 * cos_w0, 1 - alpha * amp],
+                   [1 + alpha / amp, -2 * cos_w0, 1 - alpha / amp])
+
+    def process(self, x):
+        history = np.concatenate((self.inputs, x))
+        self.inputs = history[-2:]
+        y = self.b[0] * x + self.b[1] * history[1:-1] + self.b[2] * history[:-2]
+        for i, pole in enumerate(self.poles):
+            y, self.states[i] = _pole_scan(y, pole, self.states[i])
+        return y.real
+
+class DSPChain:
+    """In-process replacement for the FFmpeg filter graph.
+
+    FFmpeg only decodes to mono float32 at the target rate; this applies the
+    high-pass, EQ, compressor, loudness leveller, volume and limiter of
+    get_8bit_optimized_filters and emits s8 PCM. Filter and envelope state
+    carries over between chunks, and update() changes volume, EQ or
+    normalization from the next chunk on without restarting FFmpeg.
+
+    The dynamics stages work on ~1 ms blocks: the envelope follows the block
+    peak (or mean square for the leveller) and the gain is interpolated
+    between block centres.
+    """
+
+    def __init__(self, config):
+        self.rate = config['sample_rate']
+        self.block = max(1, self.rate // 1000)
+        self.lock = threading.Lock()
+        self.modified = False
+
+        self.volume = config['volume']
+        self.normalize = config['normalize']
+        self.highpass = Biquad.highpass(20, self.rate)
+        self.set_eq(config['eq_preset'])
+
+        block_time = self.block / self.rate
+        self.attack = 1 - np.exp(-block_time / 0.003)
+        self.decay = 1 - np.exp(-block_time / 0.05)
+        self.release = 1 - np.exp(-block_time / 0.010)
+        self.level_rate = 1 - np.exp(-block_time / 3.0)
+        self.curve_in = np.array([p[0] for p in COMPAND_POINTS], dtype=np.float64)
+        self.curve_out = np.array([p[1] for p in COMPAND_POINTS], dtype=np.float64)
+
+        self.envelope = 0.0
+        self.loudness = 10 ** (-14 / 10)  # Mean square at the -14 dB target
+        self.limiter_gain = 1.0
+        self.gains = {}
+
+    def set_eq(self, preset):
+        bands = PSYCHOACOUSTIC_EQ if preset == 'psychoacoustic' else []
+        # Bands at or above Nyquist cannot be realised at low output rates
+        self.eq = [Biquad.peaking(freq, gain, width, self.rate)
+                   for freq, gain, width in bands if freq + width / 2 < self.rate / 2]
+        self.eq_preset = preset
+
+    def update(self, volume=None, eq_preset=None, normalize=None):
+        """Change settings from the next chunk on (thread-safe)"""
+        with self.lock:
+            if volume is not None:
+                self.volume = volume
+            if eq_preset is not None and eq_preset != self.eq_preset:
+                self.set_eq(eq_preset)
+            if normalize is not None:
+                self.normalize = normalize
+            self.modified = True
+
+    def _block_values(self, x, reduce):
+        usable = len(x) - len(x) % self.block
+        values = reduce(x[:usable].reshape(-1, self.block), axis=1)
+        if usable < len(x):
+            values = np.append(values, reduce(x[usable:]))
+        return values
+
+    def _apply_gain(self, x, name, gains):
+        """Interpolate per-block gains across samples, starting from the previous chunk's last gain"""
+        previous = self.gains.get(name, gains[0])
+        self.gains[name] = gains[-1]
+        centres = np.arange(len(gains)) * self.block + self.block / 2
+        return x * np.interp(np.arange(len(x)), np.concatenate(([-self.block / 2], centres)),
+                             np.concatenate(([previous], gains)))
+
+    def _compress(self, x):
+        peaks = self._block_values(np.abs(x), np.max)
+        envelope = np.empty_like(peaks)
+        env = self.envelope
+        for i, peak in enumerate(peaks):
+            env += (peak - env) * (self.attack if peak > env else self.decay)
+            envelope[i] = env
+        self.envelope = env
+
+        level_db = 20 * np.log10(np.maximum(envelope, 1e-4))
+        gain_db = np.interp(level_db, self.curve_in, self.curve_out) - level_db + COMPAND_GAIN_DB
+        return self._apply_gain(x, 'compand', 10 ** (gain_db / 20))
+
+    def _level(self, x):
+        powers = self._block_values(x * x, np.mean)
+        loudness = np.empty_like(powers)
+        estimate = self.loudness
+        for i, power in enumerate(powers):
+            # Skip silence so quiet passages do not pump the gain up
+            if power > 1e-6:
+                estimate += (power - estimate) * self.level_rate
+            loudness[i] = estimate
+        self.loudness = estimate
+
+        gain_db = np.clip(-14 - 10 * np.log10(loudness), -12, 12)
+        return self._apply_gain(x, 'loudnorm', 10 ** (gain_db / 20))
+
+    def _limit(self, x, limit=0.95):
+        needed = limit / np.maximum(self._block_values(np.abs(x), np.max), 1e-9)
+        gains = np.empty_like(needed)
+        gain = self.limiter_gain
+        for i, target in enumerate(needed):
+            # Instant attack within the block, exponential release
+            gain = min(target, gain + (1.0 - gain) * self.release)
+            gains[i] = gain
+        self.limiter_gain = gain
+        return np.clip(x * np.repeat(gains, self.block)[:len(x)], -limit, limit)
+
+    def process(self, data):
+        """float32 PCM bytes in, s8 PCM bytes out"""
+        x = np.frombuffer(data, dtype=np.float32, count=len(data) // 4).astype(np.float64)
+        if not len(x):
+            return b''
+
+        with self.lock:
+            x = self.highpass.process(x)
+            for band in self.eq:
+                x = band.process(x)
+            x = self._compress(x)
+            if self.normalize:
+                x = self._level(x)
+            x = self._limit(x * self.volume)
+
+        return np.rint(x * 127).astype(np.int8).tobytes()
+
+class PCMChunker:
+    """Cuts a pipe into fixed-size chunks using a preallocated ring of slots.
+
+    Data is read with readinto() straight into the slot it will be served from,
+    and each chunk is handed out as a memoryview of that slot. A view stays
+    valid for the next ``slots - 1`` chunks, so ``slots`` must cover every
+    chunk a consumer may still be holding. Reads may run up to ``read_span``
+    bytes past the current chunk, using extra slots reserved for that.
+
+    With first_size, the first chunk is that much shorter: writing starts
+    part-way into the first slot, so later chunks stay slot-aligned.
+    """
+
+    def __init__(self, stream, chunk_size, slots=34, read_span=65536, first_size=None):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.read_span = max(chunk_size, read_span - read_span % chunk_size)
+        self.ring = bytearray(chunk_size * slots + self.read_span)
+        self.view = memoryview(self.ring)
+        self.start = 0  # Offset of the chunk being assembled
+        if first_size:
+            self.start = chunk_size - min(first_size, chunk_size)
+        self.write = self.start  # Offset where the next read lands
+
+    def fill(self):
+        """Read once into free ring space; returns 0 at EOF.
+
+        Call pop() until it returns None before filling again.
+        """
+        end = min(len(self.ring), self.start + self.read_span)
+        n = self.stream.readinto(self.view[self.write:end])
+        if n:
+            self.write += n
+        return n or 0
+
+    def _take(self, length):
+        chunk = self.view[self.start:self.start + length]
+        self.start += length
+        if self.start == len(self.ring):
+            # Reads never cross the end of the ring, so this is a chunk boundary
+            self.start = self.write = 0
+        return chunk
+
+    def pop(self):
+        """The next full chunk, or None until enough data has been read"""
+        length = self.chunk_size - self.start % self.chunk_size
+        if self.write - self.start < length:
+            return None
+        return self._take(length)
+
+    def remainder(self):
+        """Whatever is left after the last full chunk at EOF, or None"""
+        if self.write == self.start:
+            return None
+        return self._take(self.write - self.start)
+
+class YtDlpExtractor:
+    """Default metadata extractor backed by yt_dlp.
+
+    YoutubeDL instances are not thread-safe but are costly to build, so each
+    resolver worker thread keeps its own pair and reuses them.
+    """
+
+    SEARCH_OPTS = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': True,
+        'playlist_items': '1:20',
+        'ignoreerrors': True
+    }
+    STREAM_OPTS = {
+        'format': 'bestaudio[ext=m4a]/bestaudio/best',
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': False,
+        'skip_download': True
+    }
+    PLAYLIST_OPTS = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',
+        'ignoreerrors': True
+    }
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def _ydl(self, name, opts):
+        ydl = getattr(self.local, name, None)
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL(opts)
+            setattr(self.local, name, ydl)
+        return ydl
+
+    @staticmethod
+    def _entries(info):
+        results = []
+        for entry in info.get('entries') or []:
+            if entry:
+                results.append({
+                    'id': entry.get('id'),
+                    'title': entry.get('title', 'Unknown'),
+                    'artist': entry.get('uploader', 'Unknown'),
+                    'duration': entry.get('duration', 0),
+                    'thumbnail': entry.get('thumbnail'),
+                    'view_count': entry.get('view_count', 0)
+                })
+        return results
+
+    def search(self, query):
+        info = self._ydl('search_ydl', self.SEARCH_OPTS).extract_info(f"ytsearch20:{query}", download=False)
+        return self._entries(info)
+
+    def playlist(self, url):
+        """Title and tracks of a playlist, read flat: one request, no per-track extraction"""
+        if '://' not in url:
+            url = f"https://www.youtube.com/playlist?list={url}"
+        info = self._ydl('playlist_ydl', self.PLAYLIST_OPTS).extract_info(url, download=False)
+        if not info:
+            return None
+        return {
+            'title': info.get('title', 'Unknown'),
+            'tracks': [track for track in self._entries(info) if track['id']]
+        }
+
+    def stream_info(self, video_id):
+        info = self._ydl('stream_ydl', self.STREAM_OPTS).extract_info(
+            f"https://youtube.com/watch?v={video_id}", download=False
+        )
+        return {
+            'url': info['url'],
+            'title': info.get('title', 'Unknown'),
+            'artist': info.get('uploader', 'Unknown'),
+            'duration': info.get('duration', 0)
+        }
+
+class MetadataResolver:
+    """Cached, deduplicated front for an extractor (yt_dlp or a stub).
+
+    Results live in SQLite with separate TTLs for searches and stream URLs.
+    Concurrent lookups of the same key share one extraction (single flight),
+    extractions run on a bounded pool, and entries past their TTL but inside
+    the stale window are returned at once while a refresh runs behind them.
+    Batch lookups (playlist imports, queue restores) queue on a pool of their
+    own, so they never hold up a track being started.
+    """
+
+    def __init__(self, extractor, db_path, max_workers=4, batch_workers=8,
+                 search_ttl=86400, search_stale=7 * 86400,
+                 stream_ttl=3600, stream_stale=4 * 3600,
+                 playlist_ttl=3600, playlist_stale=86400):
+        self.extractor = extractor
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='resolver')
+        self.batch_executor = ThreadPoolExecutor(max_workers=batch_workers, thread_name_prefix='resolver-batch')
+        self.policies = {
+            'search': (extractor.search, search_ttl, search_stale),
+            'stream': (extractor.stream_info, stream_ttl, stream_stale)
+        }
+        if hasattr(extractor, 'playlist'):
+            self.policies['playlist'] = (extractor.playlist, playlist_ttl, playlist_stale)
+        self.inflight = {}  # (kind, key) -> Future
+        self.lock = threading.Lock()
+
+        self.db_lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        with self.db_lock, self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS resolved ('
+                'kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, fetched REAL NOT NULL, '
+                'PRIMARY KEY (kind, key))'
+            )
+            for kind, (_, ttl, stale) in self.policies.items():
+                self.db.execute('DELETE FROM resolved WHERE kind = ? AND fetched < ?',
+                                (kind, time.time() - ttl - stale))
+
+    def _load(self, kind, key):
+        with self.db_lock:
+            row = self.db.execute('SELECT value, fetched FROM resolved WHERE kind = ? AND key = ?',
+                                  (kind, key)).fetchone()
+        if not row:
+            return None
+        return json.loads(row[0]), time.time() - row[1]
+
+    def _store(self, kind, key, value):
+        with self.db_lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO resolved (kind, key, value, fetched) VALUES (?, ?, ?, ?)',
+                            (kind, key, json.dumps(value), time.time()))
+
+    def _fetch(self, kind, key):
+        try:
+            value = self.policies[kind][0](key)
+            if value is not None:
+                self._store(kind, key, value)
+            return value
+        except Exception as e:
+            logger.error(f"Failed to resolve {kind} {key!r}: {e}")
+            return None
+        finally:
+            with self.lock:
+                self.inflight.pop((kind, key), None)
+
+    def _fetch_queued(self, kind, key):
+        """Batch extraction, unless a direct lookup took the key over while it waited"""
+        with self.lock:
+            current = self.inflight.get((kind, key))
+        if current is not None and not current.batch:
+            return current.result()
+        if current is None:
+            cached = self._load(kind, key)
+            if cached is not None and cached[1] < self.policies[kind][1]:
+                return cached[0]
+        return self._fetch(kind, key)
+
+    def _fetch_once(self, kind, key, batch=False):
+        """Future for an extraction, joining one already in flight for the same key.
+
+        A direct lookup of a key still queued behind a batch runs at once on
+        the main pool; the queued task then returns what it found.
+        """
+        with self.lock:
+            future = self.inflight.get((kind, key))
+            if future is None or (future.batch and not batch and not future.running()):
+                if batch:
+                    future = self.batch_executor.submit(self._fetch_queued, kind, key)
+                else:
+                    future = self.executor.submit(self._fetch, kind, key)
+                future.batch = batch
+                self.inflight[(kind, key)] = future
+            return future
+
+    def lookup(self, kind, key, batch=False):
+        """Future resolving to the value for key, None if extraction failed"""
+        _, ttl, stale = self.policies[kind]
+        cached = self._load(kind, key)
+        if cached is not None:
+            value, age = cached
+            if age < ttl + stale:
+                if age >= ttl:
+                    self._fetch_once(kind, key, batch)  # Revalidate in the background
+                future = Future()
+                future.set_result(value)
+                return future
+        return self._fetch_once(kind, key, batch)
+
+    def search(self, query):
+        # Searches differing only in case or spacing return the same results
+        return self.lookup('search', ' '.join(query.lower().split())).result() or []
+
+    def stream_info(self, video_id):
+        return self.lookup('stream', video_id).result()
+
+AUDIO_EXTENSIONS = ('.mp3', '.flac', '.ogg', '.opus', '.m4a', '.aac', '.wav', '.wma',
+                    '.aif', '.aiff', '.webm', '.mka')
+
+def search_terms(text):
+    """Lower-case word tokens with accents folded, for indexing and queries alike"""
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return re.findall(r'[^\W_]+', ''.join(c for c in decomposed if not unicodedata.combining(c)))
+
+class TrackIndex:
+    """In-memory inverted index over the titles, artists and albums of a track list.
+
+    Postings map each term to {track position: field weight}. A query term
+    matches exactly, as a prefix of vocabulary terms (a bisect over the sorted
+    vocabulary) or, when neither finds anything, within one edit: every term
+    is also filed under each string left by deleting one of its characters,
+    so candidates come from a few dictionary probes instead of a vocabulary scan.
+    """
+
+    FIELD_WEIGHTS = {'title': 1.0, 'artist': 0.8, 'album': 0.5}
+    PREFIX_WEIGHT = 0.7
+    FUZZY_WEIGHT = 0.5
+    PREFIX_LIMIT = 64  # Vocabulary terms a short prefix may expand to
+    FUZZY_MIN_LENGTH = 4
+
+    def __init__(self, tracks):
+        self.tracks = tracks
+        postings = collections.defaultdict(dict)
+        for position, track in enumerate(tracks):
+            for field, weight in self.FIELD_WEIGHTS.items():
+                for term in search_terms(track.get(field) or ''):
+                    if postings[term].get(position, 0) < weight:
+                        postings[term][position] = weight
+        self.postings = dict(postings)
+        self.vocabulary = sorted(self.postings)
+
+        deletes = collections.defaultdict(list)
+        for term in self.vocabulary:
+            if len(term) >= self.FUZZY_MIN_LENGTH:
+                for variant in self._deletes(term):
+                    deletes[variant].append(term)
+        self.deletes = dict(deletes)
+
+    @staticmethod
+    def _deletes(term):
+        return {term[:i] + term[i + 1:] for i in range(len(term))}
+
+    def _fuzzy_terms(self, term):
+        """Vocabulary terms one insertion, deletion, substitution or transposition away"""
+        found = set(self.deletes.get(term, ()))
+        for variant in self._deletes(term):
+            if variant in self.postings:
+                found.add(variant)
+            found.update(self.deletes.get(variant, ()))
+        found.discard(term)
+        return found
+
+    def _matches(self, term):
+        """{track position: score} for one query term"""
+        hits = dict(self.postings.get(term, {}))
+        start = bisect.bisect_right(self.vocabulary, term)
+        for candidate in itertools.islice(self.vocabulary, start, start + self.PREFIX_LIMIT):
+            if not candidate.startswith(term):
+                break
+            for position, weight in self.postings[candidate].items():
+                hits[position] = max(hits.get(position, 0), weight * self.PREFIX_WEIGHT)
+        if not hits and len(term) >= self.FUZZY_MIN_LENGTH:
+            for candidate in self._fuzzy_terms(term):
+                for position, weight in self.postings[candidate].items():
+                    hits[position] = max(hits.get(position, 0), weight * self.FUZZY_WEIGHT)
+        return hits
+
+    def search(self, query, limit=20):
+        """Tracks ranked by how many query terms they match, then by score"""
+        scores = {}
+        for term in search_terms(query):
+            for position, score in self._matches(term).items():
+                matched, total = scores.get(position, (0, 0.0))
+                scores[position] = (matched + 1, total + score)
+        best = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1][0], -item[1][1], item[0]))
+        return [self.tracks[position] for position, _ in best]
+
+class LocalLibrary:
+    """Catalog of the audio files under a directory, searchable and streamable offline.
+
+    Tags and durations are read with FFmpeg (already needed for transcoding)
+    on a thread pool. The catalog lives in SQLite, so a rescan only probes
+    files whose size or mtime changed. Track ids are 'local-' plus a hash of
+    path, size and mtime: an edited file gets a new id and never plays PCM
+    cached from its old contents.
+    """
+
+    ID_PREFIX = 'local-'
+
+    def __init__(self, root, db_path, probe_workers=None):
+        self.root = os.path.abspath(root)
+        self.db_path = db_path
+        self.probe_workers = probe_workers or min(16, (os.cpu_count() or 1) * 2)
+        self.db_lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        with self.db_lock, self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS tracks ('
+                'path TEXT PRIMARY KEY, id TEXT NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL, '
+                'title TEXT NOT NULL, artist TEXT NOT NULL, album TEXT NOT NULL, duration REAL NOT NULL)'
+            )
+        self.by_id = {}
+        self.index = TrackIndex([])
+        self.load()
+
+    def owns(self, video_id):
+        return isinstance(video_id, str) and video_id.startswith(self.ID_PREFIX)
+
+    @staticmethod
+    def probe(path):
+        """(title, artist, album, duration) from FFmpeg's dump of the file, falling back to its name"""
+        tags = {}
+        duration = 0.0
+        try:
+            result = subprocess.run(['ffmpeg', '-hide_banner', '-nostdin', '-i', path],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=30)
+            for line in result.stderr.decode('utf-8', errors='replace').splitlines():
+                match = re.match(r'\s+Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)', line)
+                if match:
+                    hours, minutes, seconds = match.groups()
+                    duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+                    continue
+                # Global metadata comes first, so it wins over the stream's
+                match = re.match(r'\s+(title|artist|album_artist|album)\s*: (.+)$', line, re.IGNORECASE)
+                if match:
+                    tags.setdefault(match.group(1).lower(), match.group(2).strip())
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.warning(f"Could not probe {path}: {e}")
+
+        stem = os.path.splitext(os.path.basename(path))[0]
+        artist, _, title = stem.partition(' - ')
+        if not title:
+            artist, title = '', stem
+        return (tags.get('title') or title.strip(),
+                tags.get('artist') or tags.get('album_artist') or artist.strip() or 'Unknown',
+                tags.get('album', ''),
+                duration)
+
+    def _probe_row(self, path, stamp):
+        size, mtime = stamp
+        track_id = self.ID_PREFIX + hashlib.sha1(f"{path}|{size}|{mtime}".encode('utf-8')).hexdigest()[:16]
+        return (path, track_id, size, mtime) + self.probe(path)
+
+    def scan(self):
+        """Bring the catalog in line with the directory; returns (probed, removed) file counts"""
+        with self.db_lock:
+            known = {row[0]: (row[1], row[2]) for row in self.db.execute('SELECT path, size, mtime FROM tracks')}
+
+        found = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    found[path] = (stat.st_size, stat.st_mtime_ns)
+
+        changed = [path for path, stamp in found.items() if known.get(path) != stamp]
+        removed = [path for path in known if path not in found]
+        with ThreadPoolExecutor(max_workers=self.probe_workers, thread_name_prefix='library-probe') as pool:
+            rows = list(pool.map(self._probe_row, changed, [found[path] for path in changed]))
+
+        with self.db_lock, self.db:
+            self.db.executemany('DELETE FROM tracks WHERE path = ?', [(path,) for path in removed])
+            self.db.executemany('INSERT OR REPLACE INTO tracks (path, id, size, mtime, title, artist, album, duration) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.load()
+        return len(changed), len(removed)
+
+    def load(self):
+        """Rebuild the id map and search index from the catalog"""
+        with self.db_lock:
+            rows = self.db.execute('SELECT id, path, title, artist, album, duration FROM tracks ORDER BY path').fetchall()
+        tracks = [{'id': track_id, 'path': path, 'title': title, 'artist': artist, 'album': album,
+                   'duration': duration} for track_id, path, title, artist, album, duration in rows]
+        self.index = TrackIndex(tracks)
+        self.by_id = {track['id']: track for track in tracks}
+
+    def search(self, query, limit=20):
+        """Matches in the same shape as YouTube results"""
+        return [{
+            'id': track['id'],
+            'title': track['title'],
+            'artist': track['artist'],
+            'album': track['album'],
+            'duration': track['duration'],
+            'thumbnail': None,
+            'view_count': None,
+            'source': 'local'
+        } for track in self.index.search(query, limit)]
+
+    def stream_info(self, track_id):
+        track = self.by_id.get(track_id)
+        if track is None:
+            return None
+        return {'url': track['path'], 'title': track['title'], 'artist': track['artist'],
+                'duration': track['duration']}
+
+    def stats(self):
+        return {'root': self.root, 'tracks': len(self.by_id), 'terms': len(self.index.vocabulary)}
+
+class LoudnessIndex:
+    """Integrated loudness, true peak and LRA of each track, measured once and kept in SQLite.
+
+    Measurements come from a background FFmpeg pass (loudnorm's analysis
+    mode) over the whole track, run at low priority one at a time, and only
+    while admission control has a transcode slot to spare for it. Streams of
+    a measured track replace the live loudnorm stage with a fixed gain; the
+    first stream of a new track uses loudnorm and queues the analysis.
+    Entries are per (video_id, variant): the variant names the filter stages
+    in front of loudnorm, which change what it measures.
+    """
+
+    def __init__(self, db_path, max_pending=32):
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='loudness')
+        self.pending = set()
+        self.failed = set()  # Not retried until restart
+        self.lock = threading.Lock()
+
+        self.db_lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        with self.db_lock, self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS loudness ('
+                'video_id TEXT NOT NULL, variant TEXT NOT NULL, integrated REAL NOT NULL, '
+                'true_peak REAL NOT NULL, lra REAL NOT NULL, threshold REAL NOT NULL, measured REAL NOT NULL, '
+                'PRIMARY KEY (video_id, variant))'
+            )
+
+    def get(self, video_id, variant):
+        """{'integrated', 'true_peak', 'lra', 'threshold'} or None if the track is not measured yet"""
+        with self.db_lock:
+            row = self.db.execute('SELECT integrated, true_peak, lra, threshold FROM loudness '
+                                  'WHERE video_id = ? AND variant = ?', (video_id, variant)).fetchone()
+        if not row:
+            return None
+        return dict(zip(('integrated', 'true_peak', 'lra', 'threshold'), row))
+
+    def request(self, video_id, variant, command, admission=None):
+        """Queue an analysis running command (FFmpeg printing loudnorm's JSON summary), once per track.
+
+        With an AdmissionController the analysis takes one of its transcode
+        slots when it runs, and is skipped if none is free; a later stream of
+        the track queues it again.
+        """
+        key = (video_id, variant)
+        with self.lock:
+            if key in self.pending or key in self.failed or len(self.pending) >= self.max_pending:
+                return
+            self.pending.add(key)
+        self.executor.submit(self._analyze, key, command, admission)
+
+    @staticmethod
+    def parse(output):
+        """Measurements from the JSON block loudnorm prints at the end of an analysis pass"""
+        match = re.search(r'\{[^{}]*"input_i"[^{}]*\}', output)
+        if not match:
+            return None
+        summary = json.loads(match.group(0))
+        # Silence reports -inf, which float() reads as well
+        return {
+            'integrated': float(summary['input_i']),
+            'true_peak': float(summary['input_tp']),
+            'lra': float(summary['input_lra']),
+            'threshold': float(summary['input_thresh'])
+        }
+
+    def _analyze(self, key, command, admission=None):
+        # Output goes nowhere, so the slot is all it costs; listeners come first
+        if admission is not None and not admission.try_acquire(0):
+            with self.lock:
+                self.pending.discard(key)
+            logger.info(f"Skipped loudness analysis of {key[0]}: no transcode capacity")
+            return
+
+        started = time.time()
+        measurement = None
+        try:
+            preexec_fn = (lambda: os.nice(10)) if hasattr(os, 'nice') else None
+            result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                    timeout=1800, preexec_fn=preexec_fn)
+            if result.returncode == 0:
+                measurement = self.parse(result.stderr.decode('utf-8', errors='replace'))
+        except (OSError, subprocess.TimeoutExpired, ValueError, KeyError) as e:
+            logger.warning(f"Loudness analysis of {key[0]} failed: {e}")
+        finally:
+            if admission is not None:
+                admission.release(0)
+
+        with self.lock:
+            self.pending.discard(key)
+            if measurement is None:
+                self.failed.add(key)
+                return
+        with self.db_lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO loudness (video_id, variant, integrated, true_peak, lra, '
+                            'threshold, measured) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            key + (measurement['integrated'], measurement['true_peak'], measurement['lra'],
+                                   measurement['threshold'], time.time()))
+        logger.info(f"Measured {key[0]}: {measurement['integrated']:.1f} LUFS, "
+                    f"{measurement['true_peak']:.1f} dBTP in {time.time() - started:.1f}s")
+
+    def stats(self):
+        with self.db_lock:
+            tracks = self.db.execute('SELECT COUNT(*) FROM loudness').fetchone()[0]
+        with self.lock:
+            return {'tracks': tracks, 'pending': len(self.pending), 'failed': len(self.failed)}
+
+def mark_stage(timings, started, stage):
+    """Record when a startup stage first completed, in ms after started"""
+    if stage not in timings:
+        timings[stage] = round((time.time() - started) * 1000, 1)
+
+class ClientPace:
+    """How fast a session's client takes its audio, from its recent deliveries.
+
+    Each delivery records when it went out, the seconds of audio it carried
+    and how many chunks were still queued behind it. Gaps between requests
+    longer than PAUSE_GAP are a paused player, not a slow one, and do not count.
+    """
+
+    WINDOW = 20.0
+    PAUSE_GAP = 5.0
+    MIN_SPAN = 10.0  # Seconds of requests needed before judging
+
+    def __init__(self):
+        self.deliveries = collections.deque()  # (time, audio seconds, chunks queued)
+        self.checked = 0.0
+        self.change = None  # Profile change last called for, see recommend_profile
+
+    def record(self, now, seconds, queued):
+        deliveries = self.deliveries
+        deliveries.append((now, seconds, queued))
+        while deliveries[0][0] < now - self.WINDOW:
+            deliveries.popleft()
+
+    def summary(self):
+        """Audio seconds taken per second, mean request interval and mean queue depth, or None if too early"""
+        active = audio = 0.0
+        gaps = 0  # Intervals that count towards active, pauses left out
+        previous = None
+        for at, seconds, _ in self.deliveries:
+            if previous is not None and at - previous <= self.PAUSE_GAP:
+                active += at - previous
+                audio += seconds
+                gaps += 1
+            previous = at
+        if active < self.MIN_SPAN:
+            return None
+        count = len(self.deliveries)
+        return {
+            'consumption': audio / active,
+            'interval': active / gaps,
+            'queued': sum(queued for _, _, queued in self.deliveries) / count
+        }
+
+class Session:
+    """State of one client stream.
+
+    Slots instead of a dict keep the per-session footprint small and catch
+    misspelt fields. is_active is a property so the owning SessionRegistry
+    can keep its state index and expiry schedule in step.
+    """
+
+    __slots__ = (
+        'session_id', 'video_id', 'audio_config', 'chunk_queue', '_is_active', 'error', 'ready',
+        'total_chunks_sent', 'start_time', 'last_activity', 'metadata', 'process', 'broadcast',
+        'metrics_id', 'cache_view', 'cache_offset', 'encoder', 'dsp', 'dropped_chunks',
+        'stalled_seconds', 'start_sample', 'position', 'skip_to', 'seek_epoch', 'next_seq',
+        'retained', 'lock', 'admission', 'task', 'registry', 'expiry_ticket', 'lead_in',
+        'lead_in_admission', 'timings', 'thread_id', 'pace'
+    )
+
+    def __init__(self, session_id, video_id, config, encoder=None, dsp=None, start_sample=0):
+        now = time.time()
+        self.session_id = session_id
+        self.video_id = video_id
+        self.audio_config = config
+        self.chunk_queue = queue.Queue(maxsize=30)
+        self._is_active = True
+        self.error = None
+        self.ready = threading.Event()
+        self.total_chunks_sent = 0
+        self.start_time = now
+        self.last_activity = now  # Last time the client fetched; drives idle expiry
+        self.metadata = None
+        self.process = None
+        self.broadcast = None
+        self.metrics_id = session_id
+        self.cache_view = None
+        self.cache_offset = 0
+        self.encoder = encoder
+        self.dsp = dsp
+        self.dropped_chunks = 0
+        self.stalled_seconds = 0.0
+        # Byte-accurate positions are in samples from the start of the track
+        self.start_sample = start_sample
+        self.position = start_sample  # First sample of the next chunk handed to the client
+        self.skip_to = 0  # Pending forward seek applied as chunks are delivered
+        self.seek_epoch = 0  # Bumped when a seek repositions the source
+        self.next_seq = 0  # Sequence number of the next delivered chunk
+        self.retained = collections.deque()  # (seq, chunk) not yet acknowledged
+        self.lock = threading.Lock()
+        self.admission = 0  # Footprint reserved with the AdmissionController
+        self.task = None
+        self.registry = None
+        self.expiry_ticket = None  # Ticket of this session's live entry in the expiry heap
+        self.lead_in = None  # Low-latency FFmpeg covering a fast start's first seconds
+        self.lead_in_admission = 0  # Footprint reserved for the lead-in until it exits
+        self.timings = {}  # Startup stage -> ms after start_time, see mark_stage
+        self.thread_id = None  # Thread producing this session's audio, for the profiler
+        self.pace = ClientPace()
+
+    @property
+    def is_active(self):
+        return self._is_active
+
+    @is_active.setter
+    def is_active(self, value):
+        changed = value != self._is_active
+        self._is_active = value
+        if changed and self.registry:
+            self.registry.state_changed(self)
+
+    @property
+    def state(self):
+        return 'active' if self._is_active else 'ended'
+
+class SessionRegistry:
+    """Thread-safe store of live sessions with secondary indexes and idle expiry.
+
+    Sessions are indexed by video_id and by state. Idle expiry uses a heap
+    of (deadline, ticket, session_id): touching a session only updates its
+    last_activity, and reap() re-checks each due entry, rescheduling the
+    ones that were active in the meantime. A reap therefore costs
+    O(expired + rescheduled) rather than a scan of every session.
+    expiry(session) gives the idle seconds allowed, or None for no expiry.
+    """
+
+    def __init__(self, expiry):
+        self.expiry = expiry
+        self.lock = threading.RLock()
+        self.sessions = {}
+        self.by_video = collections.defaultdict(set)
+        self.by_state = collections.defaultdict(set)
+        self.heap = []
+        self.tickets = itertools.count()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+
+    def values(self):
+        """Snapshot of the registered sessions, safe to iterate while others change"""
+        with self.lock:
+            return list(self.sessions.values())
+
+    def for_video(self, video_id):
+        with self.lock:
+            return [self.sessions[sid] for sid in self.by_video.get(video_id, ())]
+
+    def in_state(self, state):
+        with self.lock:
+            return [self.sessions[sid] for sid in self.by_state.get(state, ())]
+
+    def counts(self):
+        with self.lock:
+            return {state: len(ids) for state, ids in self.by_state.items()}
+
+    def add(self, session):
+        """Register a session, replacing any previous one with the same id"""
+        with self.lock:
+            self._unindex(session.session_id)
+            self.sessions[session.session_id] = session
+            self.by_video[session.video_id].add(session.session_id)
+            self.by_state[session.state].add(session.session_id)
+            session.registry = self
+            self._schedule(session)
+
+    def pop(self, session_id):
+        with self.lock:
+            session = self._unindex(session_id)
+            if session:
+                session.registry = None
+            return session
+
+    def _unindex(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session:
+            self._discard(self.by_video, session.video_id, session_id)
+            # Both: is_active may have flipped without state_changed having run yet
+            for state in ('active', 'ended'):
+                self._discard(self.by_state, state, session_id)
+        return session
+
+    @staticmethod
+    def _discard(index, key, session_id):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(session_id)
+            if not ids:
+                del index[key]
+
+    def state_changed(self, session):
+        """Called by Session when is_active flips"""
+        with self.lock:
+            if self.sessions.get(session.session_id) is not session:
+                return
+            for state in ('active', 'ended'):
+                self._discard(self.by_state, state, session.session_id)
+            self.by_state[session.state].add(session.session_id)
+            self._schedule(session)
+
+    def _schedule(self, session):
+        ttl = self.expiry(session)
+        if ttl is None:
+            session.expiry_ticket = None
+            return
+        ticket = next(self.tickets)
+        session.expiry_ticket = ticket
+        heapq.heappush(self.heap, (session.last_activity + ttl, ticket, session.session_id))
+
+    def reap(self, now=None):
+        """Unregister and return every session idle past its expiry"""
+        now = time.time() if now is None else now
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, ticket, session_id = heapq.heappop(self.heap)
+                session = self.sessions.get(session_id)
+                if session is None or session.expiry_ticket != ticket:
+                    continue  # Removed or rescheduled since
+                ttl = self.expiry(session)
+                if ttl is None:
+                    session.expiry_ticket = None
+                elif session.last_activity + ttl <= now:
+                    self._unindex(session_id)
+                    session.registry = None
+                    expired.append(session)
+                else:
+                    self._schedule(session)
+        return expired
+
+class ServerBusy(Exception):
+    """No transcode capacity became free in time; retry_after is a hint in seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """Server-wide cap on concurrent FFmpeg transcodes and the memory their buffers reserve.
+
+    A transcode takes one of max_transcodes slots plus its worst-case buffer
+    footprint before FFmpeg starts, and gives both back when its worker ends.
+    Requests that do not fit wait in a priority queue (lower value first,
+    then arrival order) for up to queue_timeout seconds. With more than
+    max_waiting waiters, or after the timeout, acquire() raises ServerBusy.
+    """
+
+    PRIORITY_ACTIVE = 0  # A listener that is already playing (seek or resume)
+    PRIORITY_NEW = 1  # A new /start_stream
+    PRIORITY_PREFETCH = 2  # Speculative warm-up; only ever uses try_acquire
+
+    def __init__(self, max_transcodes=None, max_buffered_bytes=256 * 1024 ** 2,
+                 queue_timeout=5.0, max_waiting=16):
+        self.max_transcodes = max_transcodes or max(2, os.cpu_count() or 2)
+        self.max_buffered_bytes = max_buffered_bytes
+        self.queue_timeout = queue_timeout
+        self.max_waiting = max_waiting
+        self.cond = threading.Condition()
+        self.active = 0
+        self.reserved = 0
+        self.waiting = []  # Heap of (priority, ticket)
+        self.tickets = itertools.count()
+        self.admitted = 0
+        self.rejected = 0
+        self.preempted = 0
+
+    def _fits(self, cost):
+        return self.active < self.max_transcodes and self.reserved + cost <= self.max_buffered_bytes
+
+    def _grant(self, cost):
+        self.active += 1
+        self.reserved += cost
+        self.admitted += 1
+
+    def cost_of(self, footprint):
+        # A transcode bigger than the whole budget is still admitted on its own
+        return min(footprint, self.max_buffered_bytes)
+
+    def try_acquire(self, footprint):
+        """Take capacity only if it is free right now and nobody is queued for it"""
+        cost = self.cost_of(footprint)
+        with self.cond:
+            if self.waiting or not self._fits(cost):
+                return False
+            self._grant(cost)
+            return True
+
+    def acquire(self, footprint, priority=PRIORITY_NEW):
+        """Wait for capacity in priority order, or raise ServerBusy"""
+        cost = self.cost_of(footprint)
+        retry_after = max(1, int(round(self.queue_timeout)))
+
+        with self.cond:
+            if not self.waiting and self._fits(cost):
+                self._grant(cost)
+                return
+            if len(self.waiting) >= self.max_waiting:
+                self.rejected += 1
+                raise ServerBusy("Too many streams waiting to start", retry_after)
+
+            entry = (priority, next(self.tickets))
+            heapq.heappush(self.waiting, entry)
+            deadline = time.time() + self.queue_timeout
+            try:
+                while not (self.waiting[0] == entry and self._fits(cost)):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise ServerBusy("No transcode capacity available", retry_after)
+                    self.cond.wait(remaining)
+                self._grant(cost)
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                # The next waiter in line may fit now
+                self.cond.notify_all()
+
+    def release(self, footprint):
+        with self.cond:
+            self.active -= 1
+            self.reserved -= self.cost_of(footprint)
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'transcodes': self.active,
+                'max_transcodes': self.max_transcodes,
+                'transcode_utilization': round(self.active / self.max_transcodes, 3),
+                'reserved_bytes': self.reserved,
+                'max_buffered_bytes': self.max_buffered_bytes,
+                'memory_utilization': round(self.reserved / self.max_buffered_bytes, 3),
+                'waiting': len(self.waiting),
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'preempted_prefetches': self.preempted
+            }
+
+class OptimizedChunkedMusicServer:
+    def __init__(self, cache_root=None, extractor=None):
+        self.active_streams = SessionRegistry(self.session_ttl)
+
+        # Set when sessions are driven by the asyncio core instead of threads
+        self.async_core = None
+
+        # Worker processes prefix their index so the front end can route session ids
+        self.session_prefix = ''
+
+        # /profile samples a session's producer thread on request; off unless --profiling
+        self.profiling_enabled = False
+
+        # Shared transcodes keyed by (video_id, normalized config)
+        self.broadcast_enabled = True
+        self.broadcasts = {}
+        self.broadcast_lock = threading.Lock()
+
+        # Warm-up of upcoming tracks: at most prefetch_limit per request, dropped after prefetch_ttl
+        self.prefetch_limit = 3
+        self.prefetch_ttl = 300
+
+        # Tracks one /resolve_batch request may look up (a playlist import is cut to this)
+        self.resolve_batch_limit = 500
+
+        self.default_chunk_size = 8192
+        self.buffer_target = 10
+
+        # Lossless streams wait for their listener; give up on one that stops fetching for this long
+        self.listener_timeout = 300
+
+        # Caps on concurrent FFmpeg processes and on the memory their buffers reserve
+        self.admission = AdmissionController()
+
+        # Delivered chunks kept for clients that resume with ?from=, and how far
+        # past the buffered audio a seek may land without restarting FFmpeg
+        self.resume_window = 64
+        self.seek_ahead_seconds = 10
+
+        # Fast starts play a lead-in without loudnorm's look-ahead for this long,
+        # and open with a first chunk of first_chunk_ms of audio
+        self.fast_start_seconds = 5
+        self.first_chunk_ms = 100
+
+        # Transcoded PCM and resolved metadata kept across restarts
+        if cache_root is None:
+            cache_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+        self.pcm_cache = PCMCache(cache_root)
+        self.resolver = MetadataResolver(extractor or YtDlpExtractor(),
+                                         os.path.join(cache_root, "resolver.sqlite3"))
+        # Measured track loudness, which lets streams use a fixed gain instead of live loudnorm
+        self.loudness = LoudnessIndex(os.path.join(cache_root, "loudness.sqlite3"))
+
+        # Local files (--library) and which sources a search covers by default:
+        # 'all' puts library matches before YouTube results, 'local' and 'remote' use one alone
+        self.library = None
+        self.search_source = 'all'
+
+        # Audio quality monitoring
+        self.quality_metrics = {}
+
+        # Visualization frame tables, shared by streams with the same (bands, sample rate)
+        self.analyzers = {}
+
+        # A client taking less than this much audio per second is falling behind;
+        # adaptive sessions then step down the profile ladder, but not below adaptive_min_rate
+        self.adaptive_min_consumption = 0.9
+        self.adaptive_min_rate = 16000
+
+        # Cleanup old sessions periodically
+        self.cleanup_thread = threading.Thread(target=self._cleanup_loop, daemon=True)
+        self.cleanup_thread.start()
+
+    def _cleanup_loop(self):
+        """Periodically clean up inactive sessions"""
+        while True:
+            time.sleep(10)  # Reaping only touches due sessions, so it can run often
+            current_time = time.time()
+
+            for session in self.active_streams.reap(current_time):
+                self._teardown(session)
+                logger.info(f"Cleaned up inactive session: {session.session_id}")
+
+            self._expire_prefetches(current_time)
+            self.pcm_cache.flush()
+
+    def session_ttl(self, session):
+        """Idle seconds before a session is reaped, or None to keep it while it streams"""
+        if not session.is_active:
+            return 300
+        if session.audio_config['backpressure'] == 'lossless':
+            # A vanished client would otherwise hold its FFmpeg (or a shared one) forever
+            return self.listener_timeout
+        return None
+
+    def validate_audio_config(self, config):
+        # Accept any sample rate >= 8000
+        requested_rate = int(config.get('sample_rate', 22050))
+        # Optionally, check if it's in a supported list
+        if requested_rate not in PROFILE_SAMPLE_RATES:
+            requested_rate = 22050  # fallback
+
+        return {
+            'sample_rate': requested_rate,
+            'channels': 1,
+            'bit_depth': 8,
+            'chunk_size': min(32768, max(1024, int(config.get('chunk_size', self.default_chunk_size)))),
+            'format': 'dfpwm' if config.get('format') == 'dfpwm' else 'pcm',
+            'normalize': config.get('normalize', True),
+            'volume': min(0.9, max(0.1, float(config.get('volume', 0.7)))),  # Lower default for 8-bit
+            'enhance_8bit': config.get('enhance_8bit', True),
+            'dither_method': config.get('dither_method', 'triangular_hp'),
+            'eq_preset': config.get('eq_preset', 'psychoacoustic'),
+            # 'numpy' runs the filter chain in-process (DSPChain) so it can be retuned live
+            'dsp_engine': 'numpy' if config.get('dsp_engine') == 'numpy' else 'ffmpeg',
+            # What the producer does when the listener falls behind (see enqueue_chunk)
+            'backpressure': config['backpressure'] if config.get('backpressure') in BACKPRESSURE_POLICIES
+                            else 'lossless',
+            # Trade probing and the first seconds of loudnorm for a quicker first chunk
+            'fast_start': bool(config.get('fast_start', False)),
+            # Spectrum bands of the visualization frame in front of every chunk (0: no frames)
+            'visualization': SpectrumAnalyzer.band_count(config.get('visualization', 0)),
+            # Let the server move the stream to a lighter profile when the client falls behind
+            'adaptive': bool(config.get('adaptive', False))
+        }
+
+    def search_youtube(self, query):
+        """Search YouTube with caching"""
+        return self.resolver.search(query)
+
+    def search(self, query, source=None):
+        """Library matches and/or YouTube results, depending on source"""
+        source = source or self.search_source
+        results = []
+        if source != 'remote' and self.library is not None:
+            results += self.library.search(query)
+        if source != 'local':
+            results += self.search_youtube(query)
+        return results
+
+    def attach_library(self, root, db_path=None, scan=True):
+        """Serve the audio files under root; workers open the front end's catalog without scanning"""
+        library = LocalLibrary(root, db_path or os.path.join(self.pcm_cache.cache_dir, "library.sqlite3"))
+        if scan:
+            started = time.time()
+            probed, removed = library.scan()
+            logger.info(f"Library {library.root}: {len(library.by_id)} tracks "
+                        f"({probed} probed, {removed} removed) in {time.time() - started:.1f}s")
+        self.library = library
+
+    def lookup_stream(self, video_id, batch=False):
+        """Future for a track's stream info; library tracks resolve at once, without the network"""
+        if self.library is not None and self.library.owns(video_id):
+            future = Future()
+            future.set_result(self.library.stream_info(video_id))
+            return future
+        return self.resolver.lookup('stream', video_id, batch)
+
+    def resolve_batch(self, video_ids):
+        """Yield (video_id, stream info or None) for each track as it resolves, cached ones first"""
+        futures = {self.lookup_stream(video_id, batch=True): video_id for video_id in video_ids}
+        for future in as_completed(futures):
+            info = future.result()
+            BATCH_RESOLVES.inc(1, 'failed' if info is None else 'resolved')
+            yield futures[future], info
+
+    def import_playlist(self, url):
+        """Title and flat track list of a playlist, or None if it could not be read"""
+        if 'playlist' not in self.resolver.policies:
+            return None
+        return self.resolver.lookup('playlist', url).result()
+
+    def get_stream_info(self, video_id):
+        """Get stream URL and metadata"""
+        started = time.time()
+        try:
+            return self.lookup_stream(video_id).result()
+        finally:
+            RESOLVE_SECONDS.observe(time.time() - started)
+
+    def conditioning_filters(self, config):
+        """The stages in front of loudness normalization, shared with the loudness analysis"""
+        filters = []
+
+        # Convert to mono if not already
+        filters.append('aformat=channel_layouts=mono')
+
+        # High-pass filter to remove DC and subsonic content
+        filters.append('highpass=f=20')
+
+        # Psychoacoustic EQ curve for 8-bit - using individual equalizer filters
+        if config.get('eq_preset') == 'psychoacoustic':
+            for freq, gain, width in PSYCHOACOUSTIC_EQ:
+                filters.append(f'equalizer=f={freq}:t=h:g={gain}:w={width}')
+
+        # Simple compression using compand
+        points = '|'.join(f'{i}/{o}' for i, o in COMPAND_POINTS)
+        filters.append(f'compand=attacks=0.003:decays=0.05:points={points}:soft-knee=6:gain={COMPAND_GAIN_DB}')
+        return filters
+
+    def get_8bit_optimized_filters(self, config, low_latency=False, loudness=None):
+        """Generate filters optimized for 8-bit playback - using only common filters.
+
+        low_latency leaves out loudnorm, whose look-ahead holds back the first
+        seconds of output; compand still evens out the level. loudness (from
+        the LoudnessIndex) replaces loudnorm with a fixed gain folded into the
+        volume stage.
+        """
+        filters = self.conditioning_filters(config)
+        volume = config['volume']
+
+        # Loudness normalization
+        if config['normalize'] and loudness is not None:
+            volume *= 10 ** (self.normalization_gain_db(loudness) / 20)
+        elif config['normalize'] and not low_latency:
+            filters.append('loudnorm=I=-14:TP=-1:LRA=7')
+
+        # Volume adjustment
+        filters.append(f'volume={volume:.4g}')
+
+        # Limiter to prevent clipping
+        filters.append('alimiter=limit=0.95:attack=1:release=10')
+
+        # Resample to target rate
+        filters.append(f'aresample={config["sample_rate"]}')
+
+        # Final format conversion with dithering
+        # filters.append('aformat=sample_fmts=s8')
+
+        return ','.join(filters)
+
+    def calculate_audio_metrics(self, chunk_data, session_id):
+        """Calculate metrics for audio quality monitoring"""
+        try:
+            metrics = self.quality_metrics.get(session_id)
+            if metrics is None:
+                metrics = self.quality_metrics.setdefault(session_id, AudioMetrics())
+            return metrics.record(chunk_data)
+        except Exception as e:
+            logger.error(f"Error calculating audio metrics: {e}")
+            return None
+
+    def broadcast_key(self, video_id, config):
+        """Key identifying transcodes whose output is byte-identical"""
+        # fast_start only changes how a session starts, not what a shared transcode produces
+        return (video_id, tuple(sorted((k, v) for k, v in config.items() if k != 'fast_start')))
+
+    def vis_frame_bytes(self, config):
+        """Size of the visualization frame in front of each chunk: RMS, peak, then one byte per band"""
+        return 2 + config['visualization'] if config['visualization'] else 0
+
+    def wire_chunk(self, pcm, encoder, config):
+        """What a PCM chunk is sent as: DFPWM or s8 bytes, behind its visualization frame if requested"""
+        data = encoder.encode(pcm) if encoder else pcm
+        if not config['visualization']:
+            return data
+        key = (config['visualization'], config['sample_rate'])
+        analyzer = self.analyzers.get(key)
+        if analyzer is None:
+            analyzer = self.analyzers.setdefault(key, SpectrumAnalyzer(*key))
+        return analyzer.frame(pcm) + data
+
+    def make_encoder(self, config):
+        """Per-stream encoder applied after FFmpeg, or None for raw s8 PCM"""
+        return DFPWMEncoder() if config['format'] == 'dfpwm' else None
+
+    def new_session(self, video_id, config, start_sample=0, session_id=None):
+        """Build the state for a session"""
+        return Session(session_id or f"{self.session_prefix}{uuid.uuid4()}", video_id, config,
+                       encoder=self.make_encoder(config),
+                       dsp=DSPChain(config) if config['dsp_engine'] == 'numpy' else None,
+                       start_sample=start_sample)
+
+    def attach_cached(self, session):
+        """Point a session at a cached transcode if one exists"""
+        cached = self.pcm_cache.open(PCMCache.make_key(session.video_id, session.audio_config))
+        if not cached:
+            return False
+
+        # Replay straight from disk, no FFmpeg needed
+        session.cache_view, entry = cached
+        session.cache_offset = min(session.start_sample, len(session.cache_view))
+        session.metadata = entry['metadata']
+        session.ready.set()
+        mark_stage(session.timings, session.start_time, 'ready')
+        self.active_streams.add(session)
+        logger.info(f"Serving session {session.session_id} from PCM cache")
+        return True
+
+    def output_chunk_bytes(self, config):
+        """Size of one chunk as queued for the client"""
+        return config['chunk_size'] // 8 if config['format'] == 'dfpwm' else config['chunk_size']
+
+    def wire_chunk_bytes(self, config):
+        """Size of one chunk as sent: its audio plus any visualization frame"""
+        return self.output_chunk_bytes(config) + self.vis_frame_bytes(config)
+
+    def transcode_footprint(self, config, shared=False):
+        """Worst-case bytes a transcode holds in its chunk ring and queued output"""
+        read_size = config['chunk_size'] * (4 if config['dsp_engine'] == 'numpy' else 1)
+        # BroadcastChannel capacity for shared transcodes, chunk_queue maxsize otherwise
+        retained = 256 if shared else 30
+        # A session's own ring also covers the /chunks batch being assembled (stream_worker)
+        ring = read_size * (retained + (0 if shared else MAX_BATCH_CHUNKS) + 4) + 65536
+        # Encoded or DSP output is a copy; plain PCM chunks are views into the ring
+        copied = config['format'] == 'dfpwm' or config['dsp_engine'] == 'numpy'
+        return ring + (retained * self.output_chunk_bytes(config) if copied else 0)
+
+    def admit(self, session, shared=False, priority=AdmissionController.PRIORITY_NEW):
+        """Reserve transcode capacity for a session, waiting or raising ServerBusy"""
+        footprint = self.transcode_footprint(session.audio_config, shared)
+        if not self.admission.try_acquire(footprint):
+            # Unclaimed prefetches are the first thing to give way to a listener
+            self._preempt_prefetch()
+            self.admission.acquire(footprint, priority)
+        session.admission = footprint
+
+    def release_admission(self, holder):
+        """Return the capacity a Session holds (idempotent)"""
+        footprint, holder.admission = holder.admission, 0
+        if footprint:
+            self.admission.release(footprint)
+
+    def admit_lead_in(self, session):
+        """Reserve a second transcode for a fast start's lead-in, only if one is free right now.
+
+        A busy server starts the session on its full chain alone: a slower
+        first chunk beats queueing, or running more FFmpegs than admitted.
+        """
+        footprint = self.transcode_footprint(session.audio_config)
+        if not self.admission.try_acquire(footprint):
+            return False
+        session.lead_in_admission = footprint
+        return True
+
+    def release_lead_in(self, session):
+        """Return the lead-in's capacity once it has exited (idempotent)"""
+        footprint, session.lead_in_admission = session.lead_in_admission, 0
+        if footprint:
+            self.admission.release(footprint)
+
+    def buffered_bytes(self):
+        """Bytes currently queued for listeners or held in shared rings"""
+        total = 0
+        for session in self.active_streams.values():
+            if session.broadcast is None and session.cache_view is None:
+                total += session.chunk_queue.qsize() * self.output_chunk_bytes(session.audio_config)
+        with self.broadcast_lock:
+            channels = list(self.broadcasts.values())
+        for channel in channels:
+            total += sum(len(chunk) for chunk in list(channel.chunks))
+        return total
+
+    def create_stream_session(self, video_id, audio_config, broadcast=None, join='start', start_seconds=0):
+        """Create a new streaming session"""
+        config = self.validate_audio_config(audio_config)
+        start_sample = max(0, int(round(float(start_seconds) * config['sample_rate'])))
+        session = self.new_session(video_id, config, start_sample=start_sample)
+
+        if broadcast is None:
+            broadcast = self.broadcast_enabled
+        if session.dsp or start_sample:
+            # Live volume/EQ changes are per listener, and shared transcodes start at zero
+            broadcast = False
+
+        self._launch(session, broadcast, join)
+        return session.session_id, config
+
+    def _launch(self, session, broadcast, join='start', priority=AdmissionController.PRIORITY_NEW):
+        """Serve a new session from the cache, a shared transcode or its own worker.
+
+        Only paths that start FFmpeg go through admission control, so may raise
+        ServerBusy; a session that already holds admission keeps it.
+        """
+        if self.attach_cached(session):
+            self.release_admission(session)
+            return
+
+        broadcast = broadcast and not self.async_core
+        if broadcast and self._join_broadcast(session, join, create=False):
+            return
+        # A warm shared transcode is the quickest start there is, but a new one
+        # would pace itself for every listener rather than start small
+        broadcast = broadcast and not session.audio_config['fast_start']
+
+        if not session.admission:
+            self.admit(session, shared=broadcast, priority=priority)
+        mark_stage(session.timings, session.start_time, 'admitted')
+
+        if self.async_core:
+            self.async_core.launch(session)
+            return
+
+        if broadcast and self._join_broadcast(session, join):
+            return
+
+        self.active_streams.add(session)
+
+        thread = threading.Thread(
+            target=self.stream_worker,
+            args=(session,),
+            daemon=True
+        )
+        thread.start()
+
+    def _join_broadcast(self, session, join, create=True):
+        """Attach a session to the shared transcode for its track, starting one if create is set"""
+        session_id = session.session_id
+        key = self.broadcast_key(session.video_id, session.audio_config)
+
+        with self.broadcast_lock:
+            channel = self.broadcasts.get(key)
+            if channel and not channel.is_active:
+                channel = None
+
+            if channel and join == 'start' and not channel.has_start():
+                # The beginning has already left the ring; give this listener its own transcode
+                return None
+
+            started = channel is None
+            if started:
+                if not create:
+                    return None
+                channel = BroadcastChannel(key, session.video_id, session.audio_config)
+                # The capacity admitted for this session now belongs to the channel
+                channel.admission, session.admission = session.admission, 0
+                self.broadcasts[key] = channel
+
+            channel.attach(session_id, join)
+            mark_stage(session.timings, session.start_time, 'joined')
+            session.broadcast = channel
+            session.metrics_id = channel.channel_id
+            self.active_streams.add(session)
+
+            claimed_prefetch = channel.prefetch
+            channel.prefetch = False
+
+        if started:
+            self._start_broadcast(channel)
+        else:
+            # Someone else started it first; capacity admitted for this session is not needed
+            self.release_admission(session)
+            if claimed_prefetch:
+                self._restore_priority(channel.process)
+            logger.info(f"Session {session_id} joined shared stream for {session.video_id} "
+                        f"({len(channel.listeners)} listeners)")
+
+        return channel
+
+    def _start_broadcast(self, channel):
+        thread = threading.Thread(
+            target=self.broadcast_worker,
+            args=(channel,),
+            daemon=True
+        )
+        thread.start()
+
+    def prefetch(self, video_ids, audio_config):
+        """Warm up the next tracks in a client's queue.
+
+        Each id gets its stream URL resolved and, when shared transcodes are
+        available, a low-priority channel that buffers its first chunks until
+        a matching /start_stream joins it. Returns a status per video id.
+        """
+        config = self.validate_audio_config(audio_config)
+        results = {}
+
+        for video_id in video_ids[:self.prefetch_limit]:
+            if self.pcm_cache.contains(PCMCache.make_key(video_id, config)):
+                results[video_id] = 'cached'
+                continue
+
+            if self.async_core or not self.broadcast_enabled:
+                # No shared channel to park output in, so just warm the stream URL
+                self.resolver.lookup('stream', video_id)
+                results[video_id] = 'resolving'
+                continue
+
+            key = self.broadcast_key(video_id, config)
+            footprint = self.transcode_footprint(config, shared=True)
+            with self.broadcast_lock:
+                channel = self.broadcasts.get(key)
+                if channel and channel.is_active:
+                    results[video_id] = 'warm'
+                    continue
+                if not self.admission.try_acquire(footprint):
+                    # Warm-ups only use idle capacity
+                    self.resolver.lookup('stream', video_id)
+                    results[video_id] = 'busy'
+                    continue
+                channel = BroadcastChannel(key, video_id, config, prefetch=True)
+                channel.admission = footprint
+                self.broadcasts[key] = channel
+
+            self._start_broadcast(channel)
+            results[video_id] = 'prefetching'
+            logger.info(f"Prefetching {video_id}")
+
+        return results
+
+    def _expire_prefetches(self, current_time):
+        """Stop prefetched channels nobody joined within prefetch_ttl"""
+        expired = []
+        with self.broadcast_lock:
+            for key, channel in list(self.broadcasts.items()):
+                if channel.prefetch and current_time - channel.created > self.prefetch_ttl:
+                    channel.is_active = False
+                    del self.broadcasts[key]
+                    expired.append(channel)
+
+        for channel in expired:
+            self._drop_prefetch(channel)
+
+    def _preempt_prefetch(self):
+        """Stop the oldest unclaimed prefetch so a listener can have its capacity"""
+        with self.broadcast_lock:
+            candidates = [c for c in self.broadcasts.values() if c.prefetch and c.is_active]
+            if not candidates:
+                return False
+            channel = min(candidates, key=lambda c: c.created)
+            channel.is_active = False
+            del self.broadcasts[channel.key]
+
+        self.admission.preempted += 1
+        self._drop_prefetch(channel)
+        return True
+
+    def _drop_prefetch(self, channel):
+        # The broadcast worker returns the channel's admission when it exits
+        self._stop_process(channel.process)
+        self.quality_metrics.pop(channel.channel_id, None)
+        logger.info(f"Dropped unused prefetch of {channel.video_id}")
+
+    def _restore_priority(self, process):
+        """Undo the prefetch niceness once a listener depends on the process"""
+        if process and hasattr(os, 'setpriority'):
+            try:
+                os.setpriority(os.PRIO_PROCESS, process.pid, 0)
+            except OSError:
+                # Unprivileged processes may not lower niceness; it only delays catch-up
+                logger.debug(f"Could not restore FFmpeg priority for pid {process.pid}")
+
+    def _leave_broadcast(self, session):
+        """Detach a session from its shared transcode, stopping it with the last listener"""
+        channel = session.broadcast
+        if not channel:
+            return
+
+        with self.broadcast_lock:
+            remaining = channel.detach(session.session_id)
+            if remaining == 0:
+                channel.is_active = False
+                if self.broadcasts.get(channel.key) is channel:
+                    del self.broadcasts[channel.key]
+
+        if remaining == 0:
+            self._stop_process(channel.process)
+            self.quality_metrics.pop(channel.channel_id, None)
+
+    @staticmethod
+    def normalization_gain_db(loudness):
+        """Fixed gain taking a measured track to -14 LUFS, bounded like DSPChain's leveller; alimiter catches peaks"""
+        return min(12.0, max(-12.0, -14 - loudness['integrated']))
+
+    def track_loudness(self, video_id, stream_url, config):
+        """Measured loudness for a transcode that normalizes, or None after queueing its analysis"""
+        if not config['normalize'] or config.get('dsp_engine') == 'numpy':
+            return None
+        loudness = self.loudness.get(video_id, config['eq_preset'])
+        if loudness is None:
+            self.loudness.request(video_id, config['eq_preset'], self.analysis_command(stream_url, config),
+                                  self.admission)
+        return loudness
+
+    def analysis_command(self, stream_url, config):
+        """FFmpeg pass measuring the whole track where loudnorm sits in the chain, without output"""
+        filters = self.conditioning_filters(config) + ['loudnorm=I=-14:TP=-1:LRA=7:print_format=json']
+        return self.input_args(stream_url) + ['-nostdin', '-hide_banner', '-i', stream_url,
+                                              '-af', ','.join(filters), '-f', 'null', '-']
+
+    @staticmethod
+    def input_args(stream_url):
+        args = ['ffmpeg']
+        if '://' in stream_url:
+            # Ride out dropped connections; library files are plain paths
+            args += [
+                '-reconnect', '1',
+                '-reconnect_streamed', '1',
+                '-reconnect_delay_max', '5',
+            ]
+        return args
+
+    def ffmpeg_command(self, stream_url, config, start_seconds=0, lead_in=0, loudness=None):
+        """FFmpeg invocation producing raw s8 PCM on stdout (float32 for the numpy engine).
+
+        lead_in gives the low-latency command for a fast start's first
+        seconds: the filter chain without loudnorm, cut after that many seconds.
+        """
+        input_args = self.input_args(stream_url)
+        output_args = []
+        if config.get('fast_start'):
+            # Stream parameters are in the container header; don't read seconds of audio to guess them
+            input_args += ['-probesize', '65536', '-analyzeduration', '200000']
+            # Hand each packet to the pipe instead of filling the output buffer first
+            output_args += ['-flush_packets', '1']
+        if lead_in:
+            output_args += ['-t', f'{lead_in:.3f}']
+        if start_seconds:
+            # Input seeking: the demuxer jumps instead of decoding up to the position
+            input_args += ['-ss', f'{start_seconds:.6f}']
+        input_args += ['-i', stream_url]
+
+        if config.get('dsp_engine') == 'numpy':
+            # Decode only; DSPChain does the filtering
+            return input_args + output_args + [
+                '-ac', '1',
+                '-ar', str(config['sample_rate']),
+                '-f', 'f32le',
+                '-acodec', 'pcm_f32le',
+                '-'
+            ]
+
+        # Use optimized 8-bit filter chain
+        filter_str = self.get_8bit_optimized_filters(config, low_latency=bool(lead_in), loudness=loudness)
+
+        return input_args + output_args + [
+            '-af', filter_str,
+            '-f', 's8',
+            '-acodec', 'pcm_s8',
+            '-ac', '1',
+            '-'
+        ]
+
+    def needs_lead_in(self, config, loudness=None):
+        """Whether a fast start should open with a low-latency transcode (only live loudnorm needs one)"""
+        return (config['fast_start'] and config['normalize'] and config['dsp_engine'] == 'ffmpeg'
+                and loudness is None)
+
+    def first_chunk_bytes(self, config):
+        """Output bytes of a fast start's short first chunk (whole DFPWM bytes, at most chunk_size)"""
+        samples = config['sample_rate'] * self.first_chunk_ms // 1000
+        return min(config['chunk_size'], max(8, samples - samples % 8))
+
+    def _start_ffmpeg(self, stream_url, config, label, low_priority=False, start_seconds=0, lead_in=0,
+                      loudness=None):
+        """Spawn FFmpeg for the 8-bit filter chain and watch its stderr"""
+        cmd = self.ffmpeg_command(stream_url, config, start_seconds, lead_in, loudness)
+        logger.info(f"Starting FFmpeg with command: {' '.join(cmd[:10])}...")  # Log first part of command
+
+        preexec_fn = None
+        if low_priority and hasattr(os, 'nice'):
+            preexec_fn = lambda: os.nice(10)
+
+        started = time.time()
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=0,
+            preexec_fn=preexec_fn
+        )
+        SPAWN_SECONDS.observe(time.time() - started)
+
+        # Monitor stderr in separate thread for errors
+        def stderr_reader():
+            for line in process.stderr:
+                decoded_line = line.decode('utf-8', errors='ignore').strip()
+                if decoded_line:
+                    if 'error' in decoded_line.lower():
+                        FFMPEG_ERRORS.inc()
+                        logger.warning(f"FFmpeg error in {label}: {decoded_line}")
+                    else:
+                        logger.debug(f"FFmpeg output: {decoded_line}")
+
+        stderr_thread = threading.Thread(target=stderr_reader, daemon=True)
+        stderr_thread.start()
+
+        return process
+
+    def _iter_chunks(self, process, chunk_size, is_active, slots=34, first_size=None):
+        """Yield chunk_size views of FFmpeg output, then whatever remains at EOF.
+
+        Views come from a PCMChunker ring with ``slots`` entries and are only
+        valid until the ring wraps, so slots must exceed what callers retain.
+        """
+        chunker = PCMChunker(process.stdout, chunk_size, slots, first_size=first_size)
+        consecutive_errors = 0
+
+        while is_active():
+            try:
+                if not chunker.fill():
+                    if process.poll() is not None:
+                        break  # EOF: stdout fully drained
+                    consecutive_errors += 1
+                    if consecutive_errors > 5:
+                        break
+                    time.sleep(0.1)
+                    continue
+
+                consecutive_errors = 0
+                while True:
+                    chunk_data = chunker.pop()
+                    if chunk_data is None:
+                        break
+                    yield chunk_data
+
+            except Exception as e:
+                logger.error(f"Error reading stream data: {e}")
+                consecutive_errors += 1
+                if consecutive_errors > 10:
+                    break
+                time.sleep(0.1)
+
+        if is_active():
+            chunk_data = chunker.remainder()
+            if chunk_data is not None:
+                yield chunk_data
+
+    def _lead_in_chunks(self, lead_in, process, chunk_size, is_active, slots, first_size, on_output, on_lead_in_end):
+        """Chunks of a low-latency lead-in, then of the full chain from where it stopped.
+
+        Both processes start at the same position, so the full-chain output is
+        skipped by exactly as many bytes as the lead-in played. Every byte of
+        the full chain, skipped or not, goes to on_output for the cache;
+        on_lead_in_end runs once the lead-in's output is drained.
+        """
+        played = 0
+        for chunk_data in self._iter_chunks(lead_in, chunk_size, is_active, slots, first_size):
+            played += len(chunk_data)
+            yield chunk_data
+        on_lead_in_end()
+
+        for chunk_data in self._iter_chunks(process, chunk_size, is_active, slots):
+            on_output(chunk_data)
+            cut = min(played, len(chunk_data))
+            played -= cut
+            if cut < len(chunk_data):
+                yield chunk_data[cut:]
+
+    def finish_cache(self, writer, returncode, completed, metadata):
+        """Publish a cache file only for transcodes that ran to a clean end"""
+        if completed and returncode == 0:
+            # Stream URLs expire, so only the descriptive fields are worth keeping
+            writer.commit({k: v for k, v in metadata.items() if k != 'url'})
+        else:
+            writer.abort()
+
+    def _stop_process(self, process):
+        """Terminate an FFmpeg process, killing it if it does not exit"""
+        if process and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except:
+                process.kill()
+
+    def check_metrics(self, chunk_data, chunks_processed, metrics_id, label):
+        metrics = self.calculate_audio_metrics(chunk_data, metrics_id)
+        # Only warn every 10th chunk to keep the log readable
+        if metrics and chunks_processed % 10 == 0 and metrics['clipping_ratio'] > 0.01:
+            logger.warning(f"High clipping detected in {label}: {metrics['clipping_ratio']:.2%}")
+
+    def broadcast_worker(self, channel):
+        """Producer thread feeding one shared transcode to all of its listeners"""
+        label = f"shared stream {channel.channel_id}"
+        channel.thread_id = threading.get_ident()
+
+        try:
+            stream_info = self.get_stream_info(channel.video_id)
+            if not stream_info:
+                raise Exception("Failed to get stream URL")
+
+            channel.metadata = stream_info
+            mark_stage(channel.timings, channel.created, 'resolved')
+            loudness = self.track_loudness(channel.video_id, stream_info['url'], channel.config)
+            process = self._start_ffmpeg(stream_info['url'], channel.config, label, low_priority=channel.prefetch,
+                                         loudness=loudness)
+            channel.process = process
+            mark_stage(channel.timings, channel.created, 'spawned')
+            if not channel.is_active:
+                # Every listener left while the stream URL was resolving
+                self._stop_process(process)
+
+            writer = self.pcm_cache.writer(PCMCache.make_key(channel.video_id, channel.config))
+            encoder = self.make_encoder(channel.config)
+            chunks_processed = 0
+            # The ring has to outlive every chunk the channel still retains
+            chunks = self._iter_chunks(process, channel.config['chunk_size'], lambda: channel.is_active,
+                                       slots=channel.capacity + 2)
+            for chunk_data in chunks:
+                writer.write(chunk_data)
+                self.check_metrics(chunk_data, chunks_processed, channel.channel_id, label)
+                channel.publish(self.wire_chunk(chunk_data, encoder, channel.config))
+                chunks_processed += 1
+
+                if chunks_processed == 1:
+                    channel.ready.set()
+                    mark_stage(channel.timings, channel.created, 'ready')
+                    logger.info(f"First chunk ready for {label}")
+
+            self.finish_cache(writer, process.poll(), channel.is_active, stream_info)
+            self._stop_process(process)
+
+        except Exception as e:
+            logger.error(f"Broadcast worker error for {label}: {e}")
+            channel.error = str(e)
+        finally:
+            channel.finish()
+            if channel.admission:
+                self.admission.release(channel.admission)
+                channel.admission = 0
+            with self.broadcast_lock:
+                if self.broadcasts.get(channel.key) is channel:
+                    del self.broadcasts[channel.key]
+            # Listeners keep draining the ring, but no new chunks will arrive
+            for listener_id in list(channel.listeners):
+                listener = self.active_streams.get(listener_id)
+                if listener:
+                    listener.is_active = False
+                    listener.error = channel.error
+            logger.info(f"Broadcast worker ended for {label}")
+
+    def stream_worker(self, session):
+        """Worker thread for streaming audio with 8-bit optimizations"""
+        session_id = session.session_id
+        video_id = session.video_id
+        config = session.audio_config
+        session.thread_id = threading.get_ident()
+
+        try:
+            # Get stream info
+            stream_info = self.get_stream_info(video_id)
+            if not stream_info:
+                raise Exception("Failed to get stream URL")
+
+            session.metadata = stream_info
+            stream_url = stream_info['url']
+            mark_stage(session.timings, session.start_time, 'resolved')
+
+            label = f"session {session_id}"
+            start_seconds = session.start_sample / config['sample_rate']
+            loudness = self.track_loudness(video_id, stream_url, config)
+            if self.needs_lead_in(config, loudness) and self.admit_lead_in(session):
+                # Started first: it is what the listener hears first
+                session.lead_in = self._start_ffmpeg(stream_url, config, f"{label} lead-in",
+                                                     start_seconds=start_seconds,
+                                                     lead_in=self.fast_start_seconds)
+            process = self._start_ffmpeg(stream_url, config, label, start_seconds=start_seconds,
+                                         loudness=loudness)
+            session.process = process
+            mark_stage(session.timings, session.start_time, 'spawned')
+
+            # Only a transcode of the whole track is worth caching
+            writer = None if start_seconds else self.pcm_cache.writer(PCMCache.make_key(video_id, config))
+            dsp = session.dsp
+            first_chunk_sent = False
+            chunks_processed = 0
+
+            # Queued chunks, a /chunks batch being assembled (views until framed),
+            # plus the one being served and the one being filled
+            read_size = config['chunk_size'] * (4 if dsp else 1)
+            slots = session.chunk_queue.maxsize + MAX_BATCH_CHUNKS + 4
+            first_size = self.first_chunk_bytes(config) * (4 if dsp else 1) if config['fast_start'] else None
+            if session.lead_in:
+                # The lead-in is not what the cache key describes; the full chain feeds the writer
+                chunks = self._lead_in_chunks(session.lead_in, process, read_size, lambda: session.is_active,
+                                              slots, first_size, writer.write if writer else lambda data: None,
+                                              lambda: self.release_lead_in(session))
+                tee = None
+            else:
+                chunks = self._iter_chunks(process, read_size, lambda: session.is_active, slots, first_size)
+                tee = writer
+            for chunk_data in chunks:
+                if not chunks_processed:
+                    mark_stage(session.timings, session.start_time, 'first_output')
+                if dsp:
+                    chunk_data = dsp.process(chunk_data)
+                if tee:
+                    tee.write(chunk_data)
+                self.check_metrics(chunk_data, chunks_processed, session_id, f"session {session_id}")
+                chunk_data = self.wire_chunk(chunk_data, session.encoder, config)
+
+                self.enqueue_chunk(session, chunk_data)
+                session.total_chunks_sent += 1
+                chunks_processed += 1
+
+                if not first_chunk_sent:
+                    session.ready.set()
+                    first_chunk_sent = True
+                    mark_stage(session.timings, session.start_time, 'ready')
+                    logger.info(f"First chunk ready for session {session_id}")
+
+            # Output retuned mid-stream no longer matches the cache key
+            if writer:
+                self.finish_cache(writer, process.poll(), session.is_active and not (dsp and dsp.modified),
+                                  stream_info)
+
+            # Clean up process
+            self._stop_process(process)
+            self._stop_process(session.lead_in)
+
+        except Exception as e:
+            logger.error(f"Stream worker error for session {session_id}: {e}")
+            session.error = str(e)
+        finally:
+            session.is_active = False
+            self.release_lead_in(session)
+            self.release_admission(session)
+            # Signal end of stream
+            try:
+                session.chunk_queue.put(None, timeout=0.1)
+            except:
+                pass
+            session.ready.set()
+            logger.info(f"Stream worker ended for session {session_id}")
+
+    def enqueue_chunk(self, session, chunk_data):
+        """Hand a chunk to the session's queue according to its backpressure policy.
+
+        "lossless" blocks until there is room. The worker then stops reading
+        FFmpeg's stdout, the pipe fills and FFmpeg itself stalls, so nothing
+        is lost and no transcode work is wasted. "drop-oldest" discards the
+        oldest queued chunk to make room and "skip-to-live" discards the
+        whole backlog; both give the listener half a second first.
+        """
+        chunk_queue = session.chunk_queue
+        policy = session.audio_config['backpressure']
+
+        if policy == 'lossless':
+            while session.is_active:
+                waited = time.time()
+                try:
+                    chunk_queue.put(chunk_data, timeout=0.5)
+                    return
+                except queue.Full:
+                    session.stalled_seconds += time.time() - waited
+            return
+
+        try:
+            chunk_queue.put(chunk_data, timeout=0.5)
+            return
+        except queue.Full:
+            pass
+
+        # Client is slow, skip chunks to catch up
+        logger.debug(f"Buffer full for session {session.session_id}, applying {policy}")
+        while True:
+            try:
+                chunk_queue.get_nowait()
+                session.dropped_chunks += 1
+                DROPPED_CHUNKS.inc(1, policy)
+            except queue.Empty:
+                pass
+            if policy == 'drop-oldest' or chunk_queue.empty():
+                try:
+                    chunk_queue.put_nowait(chunk_data)
+                    return
+                except queue.Full:
+                    pass
+
+    def session_lag(self, session):
+        """How far a listener trails the producer and what it cost"""
+        chunks = self.session_buffered(session)
+        config = session.audio_config
+        channel = session.broadcast
+        if channel:
+            dropped, stalled = channel.dropped.get(session.session_id, 0), channel.stalled
+        else:
+            dropped, stalled = session.dropped_chunks, session.stalled_seconds
+
+        return {
+            'policy': config['backpressure'],
+            'chunks': chunks,
+            'seconds': round(chunks * config['chunk_size'] / config['sample_rate'], 2),
+            'dropped_chunks': dropped,
+            'producer_stalled_seconds': round(stalled, 2)
+        }
+
+    def deliver(self, session, chunks, epoch, retain=False):
+        """Number fetched chunks and advance the session position; returns (first seq, chunks).
+
+        Chunks before a pending forward seek are dropped or trimmed to the
+        exact sample. Chunks fetched before a seek that repositioned the
+        source (epoch changed) are discarded. With retain, copies are kept
+        until the client acknowledges them with ?from=.
+        """
+        per_byte = 8 if session.audio_config['format'] == 'dfpwm' else 1
+        header = self.vis_frame_bytes(session.audio_config)
+        # Outside the lock, which session_buffered may need for itself
+        buffered = self.session_buffered(session)
+
+        with session.lock:
+            delivered = []
+            if epoch == session.seek_epoch:
+                for chunk in chunks:
+                    audio = len(chunk) - header
+                    cut = min(max(0, (session.skip_to - session.position) // per_byte), audio)
+                    session.position += audio * per_byte
+                    if cut < audio:
+                        # A trimmed chunk keeps its visualization frame
+                        delivered.append(bytes(chunk[:header]) + chunk[header + cut:] if cut and header
+                                         else chunk[cut:])
+
+            first = session.next_seq
+            session.next_seq += len(delivered)
+            audio = sum(len(chunk) - header for chunk in delivered) * per_byte
+            session.pace.record(time.time(), audio / session.audio_config['sample_rate'], buffered)
+            if delivered and 'first_delivery' not in session.timings:
+                mark_stage(session.timings, session.start_time, 'first_delivery')
+                report = self.startup_report(session)
+                FIRST_CHUNK_SECONDS.observe(time.time() - session.start_time, report['source'])
+                logger.info(f"Startup of session {session.session_id}: {report}")
+            if retain:
+                retained = session.retained
+                retained.extend((first + i, bytes(chunk)) for i, chunk in enumerate(delivered))
+                while len(retained) > self.resume_window:
+                    retained.popleft()
+            return first, delivered
+
+    def startup_report(self, session):
+        """Where a session's audio comes from and how long each startup stage took"""
+        channel = session.broadcast
+        if session.cache_view is not None:
+            source = 'cache'
+        elif channel:
+            source = 'shared'
+        else:
+            source = 'transcode'
+
+        report = {
+            'source': source,
+            'fast_start': session.audio_config['fast_start'],
+            'lead_in': session.lead_in is not None,
+            'stages_ms': dict(session.timings)
+        }
+        if channel:
+            # The shared transcode's own stages, timed from when it was started
+            report['shared_stages_ms'] = dict(channel.timings)
+        return report
+
+    def resume_chunks(self, session, from_seq):
+        """Acknowledge chunks before from_seq and return the retained ones from there on.
+
+        Returns [] when the client is up to date, or None if some of the
+        chunks it is missing are no longer retained.
+        """
+        with session.lock:
+            retained = session.retained
+            while retained and retained[0][0] < from_seq:
+                retained.popleft()
+            if from_seq >= session.next_seq:
+                return []
+            if not retained or retained[0][0] != from_seq:
+                return None
+            return [chunk for _, chunk in retained]
+
+    def seek_session(self, session, seconds):
+        """Move a session to a new position, restarting FFmpeg only when the audio is not at hand.
+
+        Cached sessions move their read offset and shared listeners their
+        cursor into the ring. A session with its own transcode skips forward
+        through its queue when the target is buffered or at most
+        seek_ahead_seconds past it. Anything else gets a fresh transcode
+        with FFmpeg input seeking under the same session id.
+        """
+        config = session.audio_config
+        target = max(0, int(round(float(seconds) * config['sample_rate'])))
+        chunk_size = config['chunk_size']
+        view = session.cache_view
+        channel = session.broadcast
+        mode = 'restarted'
+
+        with session.lock:
+            session.retained.clear()
+
+            if view is not None:
+                session.cache_offset = min(target, len(view))
+                session.position = session.skip_to = session.cache_offset
+                session.encoder = self.make_encoder(config)
+                session.seek_epoch += 1
+                mode = 'moved'
+
+            elif channel:
+                index = target // chunk_size
+                with channel.cond:
+                    if (session.session_id in channel.listeners
+                            and channel.base_index <= index <= channel.head_index + channel.lead):
+                        channel.listeners[session.session_id] = index
+                        channel.cond.notify_all()
+                        mode = 'moved'
+                if mode == 'moved':
+                    # The ring holds whole chunks; trim the first one on delivery
+                    session.position = index * chunk_size
+                    session.skip_to = target
+                    session.seek_epoch += 1
+
+            elif session.is_active or session.chunk_queue.qsize():
+                buffered_end = session.position + self.session_buffered(session) * chunk_size
+                if session.position <= target <= buffered_end + self.seek_ahead_seconds * config['sample_rate']:
+                    session.skip_to = target
+                    mode = 'moved'
+
+        if mode == 'restarted':
+            session = self._restart_session(session, target)
+
+        logger.info(f"Seek in session {session.session_id} to {target / config['sample_rate']:.2f}s ({mode})")
+        return {
+            'mode': mode,
+            'next_chunk': session.next_seq,
+            'position_seconds': round(target / config['sample_rate'], 3)
+        }
+
+    def _restart_session(self, session, start_sample, config=None, fresh=None):
+        """Replace a session with a fresh transcode from start_sample, keeping its id and sequence.
+
+        fresh is the replacement if the caller has already built (and admitted) it.
+        """
+        session_id = session.session_id
+        stale = self.active_streams.pop(session_id)
+        if stale:
+            # FFmpeg blocked writing to a full pipe takes seconds to stop; the listener should not wait
+            threading.Thread(target=self._teardown, args=(stale,), daemon=True).start()
+
+        if fresh is None:
+            fresh = self.new_session(session.video_id, config or session.audio_config,
+                                     start_sample=start_sample, session_id=session_id)
+        fresh.next_seq = session.next_seq
+        fresh.total_chunks_sent = session.total_chunks_sent
+        # A replacement is never shared, so it can start anywhere; it also jumps the admission queue
+        self._launch(fresh, broadcast=False, priority=AdmissionController.PRIORITY_ACTIVE)
+        return fresh
+
+    def recommend_profile(self, config, pace):
+        """Lighter profile for a client that is falling behind, or None.
+
+        If chunks were queued while it fell behind, the client is the
+        bottleneck: one that polls more than four times a second gets
+        chunks twice the size, fewer requests being the cheaper fix;
+        otherwise it gets the next lower sample rate. If nothing was queued,
+        the transcode is the bottleneck, and a lower rate lightens it.
+        """
+        if pace is None or pace['consumption'] >= self.adaptive_min_consumption:
+            return None
+
+        reason = 'client' if pace['queued'] >= 2 else 'server'
+        rate, chunk_size = config['sample_rate'], config['chunk_size']
+        if reason == 'client' and pace['interval'] < 0.25 and chunk_size < 32768:
+            chunk_size = min(32768, chunk_size * 2)
+        else:
+            lower = [r for r in PROFILE_SAMPLE_RATES if self.adaptive_min_rate <= r < rate]
+            if not lower:
+                return None
+            rate = max(lower)
+        return {'sample_rate': rate, 'chunk_size': chunk_size, 'reason': reason}
+
+    def profile_change(self, session_id):
+        """The session serving session_id and the profile change its client's pace calls for"""
+        session = self.active_streams.get(session_id)
+        if session is None:
+            return None, None
+        pace = session.pace
+        now = time.time()
+        if now - pace.checked >= 1.0:
+            pace.checked = now
+            pace.change = self.recommend_profile(session.audio_config, pace.summary())
+        return session, pace.change
+
+    def switch_profile(self, session, change):
+        """Restart a session's transcode in another profile from its next undelivered sample.
+
+        Chunks already delivered keep the old profile; the fresh session picks
+        up at the next sequence number. Returns it, or None if the session
+        keeps its profile: it replays from the cache, or there is no capacity
+        for the new transcode right now. The change is then only a recommendation.
+        """
+        if session.cache_view is not None:
+            return None  # A cached replay costs no transcode, so a lighter one saves nothing
+
+        config = session.audio_config
+        with session.lock:
+            start_sample = session.position * change['sample_rate'] // config['sample_rate']
+        new_config = dict(config, sample_rate=change['sample_rate'], chunk_size=change['chunk_size'])
+        fresh = self.new_session(session.video_id, new_config,
+                                 start_sample=start_sample, session_id=session.session_id)
+        # Capacity first, without queueing for it: until the old transcode
+        # is torn down, a busy server can still leave the stream as it is
+        if not self.pcm_cache.contains(PCMCache.make_key(session.video_id, new_config)):
+            footprint = self.transcode_footprint(new_config)
+            if not self.admission.try_acquire(footprint):
+                logger.info(f"No capacity to switch profile of session {session.session_id}; keeping it")
+                return None
+            fresh.admission = footprint
+        self._restart_session(session, start_sample, fresh=fresh)
+        PROFILE_SWITCHES.inc(1, change['reason'])
+        logger.info(f"Session {session.session_id} switched to {change['sample_rate']} Hz, "
+                    f"{change['chunk_size']}-byte chunks ({change['reason']} behind)")
+        return fresh
+
+    def adapt_profile(self, session_id):
+        """Check the client's pace after a delivery; returns the profile headers for the response"""
+        session, change = self.profile_change(session_id)
+        if session is None:
+            return {}
+        config = session.audio_config
+        switched = bool(change) and config['adaptive'] and self.switch_profile(session, change) is not None
+        return self.profile_headers(config, change, switched)
+
+    @staticmethod
+    def profile_headers(config, change, switched):
+        """Profile of the chunks in a response, plus the one the next response switches to or would suit better"""
+        headers = {
+            'X-Profile-Sample-Rate': str(config['sample_rate']),
+            'X-Profile-Chunk-Size': str(config['chunk_size'])
+        }
+        if change:
+            headers['X-Profile-Next' if switched else 'X-Profile-Recommended'] = (
+                f"sample_rate={change['sample_rate']}; chunk_size={change['chunk_size']}; reason={change['reason']}")
+        return headers
+
+    def get_next_chunk(self, session_id):
+        """Get next audio chunk for session"""
+        session = self.active_streams.get(session_id)
+        if not session:
+            return None
+
+        session.last_activity = time.time()
+
+        if session.cache_view is not None:
+            return self._get_cached_chunk(session)
+
+        channel = session.broadcast
+        if channel:
+            return self._get_broadcast_chunk(session, channel)
+
+        # Wait for stream to be ready
+        if not session.ready.wait(timeout=15):
+            logger.warning(f"Stream timeout for session {session_id}")
+            return None
+
+        try:
+            chunk = session.chunk_queue.get(timeout=2.0)
+            return chunk
+        except queue.Empty:
+            # Check if stream is still active
+            if session.is_active:
+                return b''  # Return empty chunk to keep connection alive
+            return None
+
+    def _get_cached_chunk(self, session):
+        """Slice the next chunk out of a memory-mapped cached transcode"""
+        # _teardown may close the map from another thread, and a seek moves the offset
+        with session.lock:
+            view = session.cache_view
+            offset = session.cache_offset
+            chunk = None if view.closed else view[offset:offset + session.audio_config['chunk_size']]
+            if chunk:
+                session.cache_offset = offset + len(chunk)
+        if not chunk:
+            session.is_active = False
+            return None
+
+        self.check_metrics(chunk, session.total_chunks_sent, session.session_id,
+                            f"session {session.session_id}")
+        session.total_chunks_sent += 1
+        return self.wire_chunk(chunk, session.encoder, session.audio_config)
+
+    def _get_broadcast_chunk(self, session, channel, timeout=2.0):
+        """Read the next chunk at this session's cursor in a shared transcode"""
+        session_id = session.session_id
+
+        if not channel.ready.wait(timeout=15):
+            logger.warning(f"Stream timeout for session {session_id}")
+            return None
+
+        chunk = channel.read(session_id, timeout=timeout)
+        if chunk:
+            session.total_chunks_sent += 1
+        elif chunk is None:
+            session.is_active = False
+        return chunk
+
+    def _poll_chunk(self, session):
+        """Next chunk without blocking: b'' if nothing is buffered, None at end of stream"""
+        if session.cache_view is not None:
+            return self._get_cached_chunk(session)
+
+        channel = session.broadcast
+        if channel:
+            return self._get_broadcast_chunk(session, channel, timeout=0)
+
+        try:
+            chunk = session.chunk_queue.get_nowait()
+        except queue.Empty:
+            return b''
+        if chunk is None:
+            # Leave the end-of-stream marker for the next request
+            session.chunk_queue.put_nowait(None)
+        return chunk
+
+    def get_chunks(self, session_id, max_chunks, max_bytes):
+        """Long-poll for one chunk, then batch whatever else is already buffered.
+
+        Returns None at end of stream, or a list of chunks (empty on keep-alive).
+        """
+        session = self.active_streams.get(session_id)
+        first = self.get_next_chunk(session_id)
+        if first is None:
+            return None
+        if not first:
+            return []
+
+        chunks = [first]
+        total = len(first)
+        # Chunks are fixed-size, so stop before one would overflow the byte budget
+        wire_bytes = self.wire_chunk_bytes(session.audio_config) if session else 0
+        while session and len(chunks) < max_chunks:
+            if total + wire_bytes > max_bytes:
+                break
+            chunk = self._poll_chunk(session)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            total += len(chunk)
+        return chunks
+
+    def chunk_batch(self, session, from_seq, max_chunks, max_bytes):
+        """Resend unacknowledged chunks or fetch new ones; returns (status, first seq, chunks)"""
+        if from_seq is not None:
+            resent = self.resume_chunks(session, from_seq)
+            if resent is None:
+                return 410, None, None
+            if resent:
+                return 200, from_seq, resent
+
+        session_id = session.session_id
+        epoch = session.seek_epoch
+        started = time.time()
+        chunks = self.get_chunks(session_id, max_chunks, max_bytes)
+
+        current = self.active_streams.get(session_id)
+        if current is not session:
+            # Replaced by a seek while we waited: nothing fetched belongs to the new position
+            return (200, current.next_seq, []) if current else (204, None, None)
+        if chunks is None:
+            self.cleanup_session(session_id)
+            return 204, None, None
+
+        first, chunks = self.deliver(session, chunks, epoch, retain=from_seq is not None)
+        self.record_chunk_wait('chunks', started, chunks)
+        return 200, first, chunks
+
+    def push_to_socket(self, sock, session_id, credits=0, from_seq=None):
+        """Push a session's chunks over an upgraded blocking socket until either side closes.
+
+        A reader thread handles the client's control messages; this thread
+        waits for credit and then for chunks, the same long poll /chunk does.
+        """
+        push = PushStream(self, session_id, credits=credits)
+        send_lock = threading.Lock()
+
+        def send(frames):
+            if frames:
+                with send_lock:
+                    sock.sendall(b''.join(frames))
+
+        def read_control():
+            try:
+                while not push.closed:
+                    data = sock.recv(4096)
+                    if not data:
+                        break
+                    send(push.receive(data))
+            except OSError:
+                pass
+            finally:
+                push.closed = True
+                push.notify()
+
+        control = threading.Thread(target=read_control, daemon=True, name=f"ws-{session_id}")
+        control.start()
+        try:
+            if from_seq is not None:
+                send(push.resume(from_seq))
+            while not push.closed:
+                if not push.wait_ready(timeout=5):
+                    push.touch()
+                    continue
+
+                session = self.active_streams.get(session_id)
+                if session is None:
+                    send(push.close_frames({'type': 'end'}))
+                    break
+                epoch = session.seek_epoch
+                started = time.time()
+                chunk = self.get_next_chunk(session_id)
+
+                if chunk is None and self.active_streams.get(session_id) is session:
+                    self.cleanup_session(session_id)
+                    send(push.close_frames({'type': 'end', 'error': session.error}))
+                    break
+                first, chunks = self.deliver(session, [chunk] if chunk else [], epoch, retain=True)
+                if chunks:
+                    self.record_chunk_wait('ws', started, chunks)
+                    send(push.chunk_frames(first, chunks))
+
+                session, change = self.profile_change(session_id)
+                if change and session.audio_config['adaptive']:
+                    send(push.profile_frames(change, self.switch_profile(session, change)))
+                elif change:
+                    send(push.profile_frames(change))
+        except OSError:
+            pass
+        finally:
+            push.closed = True
+            # Wake the reader, and let a reply it is sending (to a stop, say) go out before the socket closes
+            try:
+                sock.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+            control.join(timeout=30)
+
+    def record_chunk_wait(self, route, started, chunks):
+        """Account a chunk request's wait, and whether it went out as an empty keep-alive"""
+        CHUNK_WAIT_SECONDS.observe(time.time() - started, route)
+        if not chunks:
+            KEEPALIVE_RESPONSES.inc(1, route)
+
+    def session_buffered(self, session):
+        """Chunks waiting to be fetched by a session"""
+        if session.cache_view is not None:
+            # No session.lock: deliver() asks while holding it, and a stale offset only misjudges by a chunk
+            try:
+                remaining = len(session.cache_view) - session.cache_offset
+            except ValueError:
+                remaining = 0  # Closed by _teardown
+            return -(-remaining // session.audio_config['chunk_size'])
+
+        channel = session.broadcast
+        if channel:
+            return channel.pending(session.session_id)
+        return session.chunk_queue.qsize()
+
+    def gauge_samples(self):
+        """Point-in-time gauges for /metrics, computed at scrape time rather than on the hot path"""
+        # Cached sessions have the rest of the track at hand, which says nothing about queueing
+        depths = [self.session_buffered(session) for session in self.active_streams.values()
+                  if session.is_active and session.cache_view is None]
+        admission = self.admission.stats()
+        return [
+            ('music_sessions', 'Registered sessions by state',
+             [({'state': state}, count) for state, count in sorted(self.active_streams.counts().items())]),
+            ('music_queued_chunks', 'Chunks buffered ahead of listeners, summed over streaming sessions',
+             [({}, sum(depths))]),
+            ('music_queue_depth_max', 'Deepest buffer of any streaming session, in chunks',
+             [({}, max(depths, default=0))]),
+            ('music_sessions_starved', 'Streaming sessions with nothing buffered', [({}, depths.count(0))]),
+            ('music_shared_transcodes', 'Running shared transcodes', [({}, len(self.broadcasts))]),
+            ('music_transcodes', 'Transcodes holding admission capacity', [({}, admission['transcodes'])]),
+            ('music_admission_waiting', 'Starts queued for transcode capacity', [({}, admission['waiting'])]),
+            ('music_buffered_bytes', 'Bytes queued for listeners or held in shared rings',
+             [({}, self.buffered_bytes())])
+        ]
+
+    def profile_session(self, session, seconds, interval):
+        """Sample the stack of the thread producing a session's audio, or None if it has none"""
+        channel = session.broadcast
+        thread_id = channel.thread_id if channel else session.thread_id
+        if thread_id is None or not session.is_active:
+            return None
+        return SamplingProfiler(thread_id, interval).run(seconds)
+
+    def tune_session(self, session, changes):
+        """Apply volume/EQ/normalize changes to a numpy-engine session from its next chunk.
+
+        Returns the updated audio config, or None if the session's output is
+        fixed (FFmpeg filter graph, shared transcode or cache replay).
+        """
+        if not session.dsp:
+            return None
+
+        config = dict(session.audio_config)
+        if 'volume' in changes:
+            config['volume'] = min(0.9, max(0.1, float(changes['volume'])))
+        if 'eq_preset' in changes:
+            config['eq_preset'] = changes['eq_preset']
+        if 'normalize' in changes:
+            config['normalize'] = bool(changes['normalize'])
+
+        session.dsp.update(volume=config['volume'], eq_preset=config['eq_preset'],
+                              normalize=config['normalize'])
+        session.audio_config = config
+        return config
+
+    def cleanup_session(self, session_id):
+        """Clean up streaming session"""
+        session = self.active_streams.pop(session_id)
+        if session:
+            self._teardown(session)
+
+    def _teardown(self, session):
+        """Stop whatever feeds an unregistered session and release its resources"""
+        session_id = session.session_id
+        session.is_active = False
+        self._leave_broadcast(session)
+        if session.cache_view is not None:
+            # Not while a request is slicing a chunk out of it
+            with session.lock:
+                session.cache_view.close()
+        if session.task:
+            # Asyncio sessions are torn down by their own worker on its loop
+            session.task.cancel()
+        else:
+            for process in (session.process, session.lead_in):
+                if not process:
+                    continue
+                try:
+                    process.terminate()
+                    process.wait(timeout=2)
+                except:
+                    try:
+                        process.kill()
+                    except:
+                        pass
+
+        # Clean up quality metrics
+        self.quality_metrics.pop(session_id, None)
+
+        logger.info(f"Cleaned up session {session_id}")
+
+# Initialize server
+# Worker processes get their own cache partition through MUSIC_CACHE_ROOT
+music_server = OptimizedChunkedMusicServer(cache_root=os.environ.get('MUSIC_CACHE_ROOT'))
+
+# Set in scale-out mode (--workers), where sessions live in worker processes
+worker_pool = None
+
+@app.before_request
+def route_to_worker():
+    """In scale-out mode, hand session traffic to the worker process that owns it"""
+    if worker_pool is not None:
+        return worker_pool.route(request)
+
+# API Routes
+@app.route('/')
+def search_endpoint():
+    """Search for music"""
+    search_query = request.args.get('search')
+    if not search_query:
+        return jsonify({'error': 'No search query provided'}), 400
+
+    source = request.args.get('source')
+    if source not in (None, 'all', 'local', 'remote'):
+        return jsonify({'error': "source must be 'all', 'local' or 'remote'"}), 400
+
+    search_query = unquote(search_query)
+    results = music_server.search(search_query, source)
+    return jsonify(results)
+
+@app.route('/audio_capabilities')
+def audio_capabilities():
+    """Get server audio capabilities with 8-bit optimizations"""
+    return jsonify({
+        'supported_sample_rates': [32000, 22050, 16000, 11025, 8000],  # Lower rates for 8-bit
+        'supported_bit_depths': [8],
+        'supported_channels': [1],
+        'supported_formats': ['pcm', 'dfpwm'],
+        'features': [
+            'normalize',
+            'volume_control',
+            'compression',
+            'psychoacoustic_eq',
+            'quality_monitoring',
+            'dynamic_range_optimization',
+            'batched_chunks',
+            'dfpwm_encoding',
+            'prefetch',
+            'numpy_dsp',
+            'seek',
+            'resume',
+            'fast_start',
+            'local_library',
+            'visualization',
+            'websocket',
+            'adaptive_profile',
+            'resolve_batch'
+        ],
+        'dsp_engines': ['ffmpeg', 'numpy'],
+        'backpressure_policies': list(BACKPRESSURE_POLICIES),
+        'eq_presets': [
+            'psychoacoustic',
+            'flat',
+            'voice',
+            'music'
+        ],
+        'default_config': {
+            'sample_rate': 22050,  # Optimal for 8-bit
+            'channels': 1,
+            'bit_depth': 8,
+            'chunk_size': 8192,
+            'format': 'pcm',
+            'normalize': True,
+            'volume': 0.7,
+            'enhance_8bit': True,
+            'eq_preset': 'psychoacoustic',
+            'dsp_engine': 'ffmpeg',
+            'backpressure': 'lossless',
+            'fast_start': False,
+            'visualization': 0,
+            'adaptive': False
+        },
+        'visualization_bands': [SpectrumAnalyzer.MIN_BANDS, SpectrumAnalyzer.MAX_BANDS],
+        'max_buffer_size': 30,
+        'target_latency_ms': 200,
+        'version': '3.0'
+    })
+
+@app.route('/start_stream', methods=['POST'])
+def start_stream():
+    """Start a new streaming session"""
+    data = request.get_json() or {}
+    video_id = data.get('id') or request.args.get('id')
+
+    if not video_id:
+        return jsonify({'error': 'No video ID provided'}), 400
+
+    audio_config = data.get('audio_config', {})
+    broadcast = data.get('broadcast')  # None -> server default
+    join = data.get('join', 'start')  # 'start' or 'live' when joining a shared stream
+    next_ids = data.get('next_ids') or []  # Upcoming queue entries worth warming up
+    start_seconds = data.get('start_seconds', 0)  # Resume or start mid-track
+
+    try:
+        session_id, validated_config = music_server.create_stream_session(
+            video_id, audio_config, broadcast=broadcast, join=join, start_seconds=start_seconds
+        )
+        session = music_server.active_streams.get(session_id)
+        channel = session.broadcast
+        warm = session.cache_view is not None or (channel is not None and channel.ready.is_set())
+
+        if isinstance(next_ids, list) and next_ids:
+            music_server.prefetch([i for i in next_ids if i != video_id], audio_config)
+
+        return jsonify({
+            'session_id': session_id,
+            'chunk_endpoint': f'/chunk/{session_id}',
+            'audio_config': validated_config,
+            'status': 'started',
+            'shared': channel is not None,
+            'listeners': len(channel.listeners) if channel else 1,
+            'estimated_first_chunk_ms': 0 if warm else 1000
+        })
+    except ServerBusy as e:
+        logger.warning(f"Refused stream for {video_id}: {e}")
+        return busy_response(e)
+    except Exception as e:
+        logger.error(f"Failed to start stream: {e}")
+        return jsonify({'error': 'Failed to create stream session'}), 500
+
+@app.route('/chunk/<session_id>')
+def get_chunk(session_id):
+    """Get next audio chunk"""
+    session = music_server.active_streams.get(session_id)
+    if not session:
+        return Response('', status=204)
+
+    epoch = session.seek_epoch
+    started = time.time()
+    chunk = music_server.get_next_chunk(session_id)
+
+    if chunk is None and music_server.active_streams.get(session_id) is session:
+        music_server.cleanup_session(session_id)
+        return Response('', status=204)
+
+    first, chunks = music_server.deliver(session, [chunk] if chunk else [], epoch)
+    music_server.record_chunk_wait('chunk', started, chunks)
+    chunk = chunks[0] if chunks else b''
+
+    return Response(
+        bytes(chunk),
+        content_type='application/octet-stream',
+        headers={
+            'Cache-Control': 'no-cache, no-store, must-revalidate',
+            'X-Chunk-Size': str(len(chunk)),
+            'X-First-Chunk': str(first),
+            'X-Session-Active': 'true' if chunk else 'false',
+            **music_server.adapt_profile(session_id)
+        }
+    )
+
+@app.route('/prefetch', methods=['POST'])
+def prefetch():
+    """Warm up upcoming tracks so their first chunk is ready when they start"""
+    data = request.get_json() or {}
+    video_ids = data.get('ids') or []
+
+    if not isinstance(video_ids, list) or not video_ids:
+        return jsonify({'error': 'No video IDs provided'}), 400
+
+    results = music_server.prefetch(video_ids, data.get('audio_config', {}))
+    return jsonify({'prefetch': results, 'limit': music_server.prefetch_limit})
+
+@app.route('/resolve_batch', methods=['POST'])
+def resolve_batch():
+    """Resolve many tracks at once, streaming a JSON line per track as it resolves (NDJSON).
+
+    The body names the tracks as "ids", or as a "playlist" URL (or id) to
+    import. Lines arrive in completion order, each carrying the track's
+    index in the request; a playlist import opens with a line giving its
+    title, and the last line counts the tracks resolved and failed.
+    """
+    data = request.get_json(silent=True) or {}
+    video_ids = data.get('ids') or []
+    playlist_url = data.get('playlist')
+    if not isinstance(video_ids, list) or not all(isinstance(i, str) for i in video_ids):
+        return jsonify({'error': 'ids must be a list of video IDs'}), 400
+
+    head = []
+    if playlist_url:
+        if 'playlist' not in music_server.resolver.policies:
+            return jsonify({'error': 'Playlist import is not available with this extractor'}), 501
+        playlist = music_server.import_playlist(str(playlist_url).strip())
+        if playlist is None:
+            return jsonify({'error': 'Could not read playlist'}), 404
+        video_ids = [track['id'] for track in playlist['tracks']] + video_ids
+        head.append({'type': 'playlist', 'title': playlist['title']})
+
+    if not video_ids:
+        return jsonify({'error': 'No video IDs or playlist provided'}), 400
+    # Duplicates resolve once, at their first position
+    video_ids = list(dict.fromkeys(video_ids))[:music_server.resolve_batch_limit]
+    index = {video_id: i for i, video_id in enumerate(video_ids)}
+    for message in head:
+        message['count'] = len(video_ids)
+
+    def lines():
+        counts = {'resolved': 0, 'failed': 0}
+        for message in head:
+            yield json.dumps(message) + '\n'
+        # Under --workers each track resolves in its owner, whose resolver cache its streams read
+        source = worker_pool.resolve_batch if worker_pool is not None else music_server.resolve_batch
+        for video_id, info in source(video_ids):
+            if info is None:
+                counts['failed'] += 1
+                message = {'type': 'error', 'index': index[video_id], 'id': video_id, 'error': 'Could not resolve'}
+            else:
+                counts['resolved'] += 1
+                message = {'type': 'track', 'index': index[video_id], 'id': video_id, 'title': info.get('title'),
+                           'artist': info.get('artist'), 'duration': info.get('duration')}
+            yield json.dumps(message) + '\n'
+        yield json.dumps(dict(counts, type='done')) + '\n'
+
+    return Response(lines(), content_type='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Track-Count': str(len(video_ids))})
+
+def batch_limits(max_chunks, max_bytes):
+    """Clamp the /chunks query parameters"""
+    return min(MAX_BATCH_CHUNKS, max(1, max_chunks)), min(1048576, max(1024, max_bytes))
+
+def frame_chunks(chunks):
+    """Concatenate chunks, each prefixed with its length as a 4-byte big-endian integer"""
+    body = bytearray()
+    for chunk in chunks:
+        body += len(chunk).to_bytes(4, 'big')
+        body += chunk
+    return bytes(body)
+
+@app.route('/chunks/<session_id>')
+def get_chunks(session_id):
+    """Get up to max chunks / max_bytes of audio in one length-prefixed response.
+
+    Clients that pass ?from=<seq> (the sequence number of the next chunk they
+    expect, see X-First-Chunk) acknowledge everything before it and get any
+    later chunks a lost response carried sent again.
+    """
+    max_chunks, max_bytes = batch_limits(
+        request.args.get('max', 16, type=int),
+        request.args.get('max_bytes', 262144, type=int)
+    )
+    from_seq = request.args.get('from', type=int)
+
+    session = music_server.active_streams.get(session_id)
+    if not session:
+        if from_seq is not None:
+            # Let a resuming client know to start over at its own position
+            return jsonify({'error': 'Session not found'}), 404
+        return Response('', status=204)
+
+    status, first, chunks = music_server.chunk_batch(session, from_seq, max_chunks, max_bytes)
+    if status == 204:
+        return Response('', status=204)
+    if status == 410:
+        return jsonify({'error': 'Chunks no longer retained, restart at your position'}), 410
+
+    return Response(
+        frame_chunks(chunks),
+        content_type='application/octet-stream',
+        headers={
+            'Cache-Control': 'no-cache, no-store, must-revalidate',
+            'X-Chunk-Count': str(len(chunks)),
+            'X-First-Chunk': str(first),
+            'X-Session-Active': 'true' if chunks else 'false',
+            **music_server.adapt_profile(session_id)
+        }
+    )
+
+class UpgradedConnection(Response):
+    """Returned once a view has taken over the socket: tells the dev server not to write a response"""
+
+    def __call__(self, environ, start_response):
+        raise ConnectionError("Connection was upgraded")
+
+@app.route('/ws/<session_id>', websocket=True)
+def websocket_stream(session_id):
+    """Push a session's chunks over a WebSocket with credit-based flow control (see PushStream)"""
+    key = request.headers.get('Sec-WebSocket-Key')
+    if not key:
+        return jsonify({'error': 'Expected a WebSocket upgrade'}), 400
+    sock = request.environ.get('werkzeug.socket')
+    if sock is None:
+        return jsonify({'error': 'This server cannot upgrade connections, poll /chunks instead'}), 501
+    if session_id not in music_server.active_streams:
+        return jsonify({'error': 'Session not found'}), 404
+
+    sock.sendall(websocket_handshake(key))
+    music_server.push_to_socket(sock, session_id, request.args.get('credit', 0, type=int),
+                                request.args.get('from', type=int))
+    return UpgradedConnection()
+
+@app.route('/stop_stream/<session_id>', methods=['POST'])
+def stop_stream(session_id):
+    """Stop streaming session"""
+    music_server.cleanup_session(session_id)
+    return jsonify({'status': 'stopped'})
+
+@app.route('/seek/<session_id>', methods=['POST'])
+def seek(session_id):
+    """Jump to a position; reply carries the sequence number of the first chunk after the seek"""
+    session = music_server.active_streams.get(session_id)
+    if not session:
+        return jsonify({'error': 'Session not found'}), 404
+
+    data = request.get_json() or {}
+    try:
+        seconds = float(data.get('seconds', request.args.get('seconds')))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'No seek position provided'}), 400
+
+    try:
+        return jsonify(music_server.seek_session(session, seconds))
+    except ServerBusy as e:
+        return busy_response(e)
+
+def busy_response(error):
+    """503 telling the client when to try again"""
+    response = jsonify({'error': str(error), 'retry_after': error.retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+@app.route('/stream_config/<session_id>', methods=['POST'])
+def stream_config(session_id):
+    """Retune volume, EQ or normalization of a live numpy-engine stream"""
+    session = music_server.active_streams.get(session_id)
+    if not session:
+        return jsonify({'error': 'Session not found'}), 404
+
+    config = music_server.tune_session(session, request.json or {})
+    if config is None:
+        return jsonify({'error': 'Live changes need a stream started with dsp_engine=numpy'}), 409
+
+    return jsonify({'status': 'updated', 'audio_config': config})
+
+@app.route('/stream_info/<session_id>')
+def stream_info(session_id):
+    """Get streaming session info"""
+    session = music_server.active_streams.get(session_id)
+    if not session:
+        return jsonify({'error': 'Session not found'}), 404
+
+    channel = session.broadcast
+
+    return jsonify({
+        'session_id': session_id,
+        'is_active': session.is_active,
+        'is_ready': (channel.ready if channel else session.ready).is_set(),
+        'chunks_buffered': music_server.session_buffered(session),
+        'total_chunks_sent': session.total_chunks_sent,
+        'elapsed_seconds': round(time.time() - session.start_time, 2),
+        'audio_config': session.audio_config,
+        'metadata': channel.metadata if channel else session.metadata,
+        'shared': channel is not None,
+        'listeners': len(channel.listeners) if channel else 1,
+        'lag': music_server.session_lag(session),
+        'position_seconds': round(session.position / session.audio_config['sample_rate'], 3),
+        'next_chunk': session.next_seq,
+        'startup': music_server.startup_report(session),
+        'error': session.error
+    })
+
+@app.route('/stream_quality/<session_id>')
+def stream_quality(session_id):
+    """Get audio quality metrics for a session"""
+    session = music_server.active_streams.get(session_id)
+    metrics_id = session.metrics_id if session else session_id
+    metrics = music_server.quality_metrics.get(metrics_id)
+    avg_metrics = metrics.averages() if metrics else None
+
+    if not avg_metrics:
+        return jsonify({'error': 'No metrics available'}), 404
+
+    return jsonify({
+        'session_id': session_id,
+        'current_metrics': metrics.latest(),
+        'average_metrics': avg_metrics,
+        'quality_score': calculate_quality_score(avg_metrics)
     })
 
 def calculate_quality_score(metrics):
@@ -611,20 +3813,1206 @@ def calculate_quality_score(metrics):
 @app.route('/health')
 def health_check():
     """Health check endpoint"""
+    if worker_pool is not None:
+        return jsonify(worker_pool.health())
+
     return jsonify({
         'status': 'healthy',
         'active_streams': len(music_server.active_streams),
+        'sessions': music_server.active_streams.counts(),
+        'shared_transcodes': len(music_server.broadcasts),
+        'pcm_cache': music_server.pcm_cache.stats(),
+        'admission': dict(music_server.admission.stats(), buffered_bytes=music_server.buffered_bytes()),
+        'library': music_server.library.stats() if music_server.library else None,
+        'loudness': music_server.loudness.stats(),
         'server_time': time.time(),
         'version': '3.0'
     })
 
+@app.route('/metrics')
+def metrics():
+    """Counters, histograms and gauges in the Prometheus text exposition format"""
+    if worker_pool is not None:
+        body = worker_pool.metrics()
+    else:
+        body = METRICS.render(music_server.gauge_samples())
+    return Response(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/profile/<session_id>', methods=['POST'])
+def profile(session_id):
+    """Sample the session's producer thread for a few seconds and return folded stacks"""
+    if not music_server.profiling_enabled:
+        return jsonify({'error': 'Profiling is disabled; start the server with --profiling'}), 403
+
+    session = music_server.active_streams.get(session_id)
+    if not session:
+        return jsonify({'error': 'Session not found'}), 404
+
+    data = request.get_json(silent=True) or {}
+    seconds = min(30.0, max(0.1, float(data.get('seconds', 5))))
+    interval = min(0.1, max(0.001, float(data.get('interval_ms', 5)) / 1000))
+
+    profiler = music_server.profile_session(session, seconds, interval)
+    if profiler is None:
+        return jsonify({'error': 'Session has no running producer thread (cached or finished)'}), 409
+
+    return Response(profiler.folded(), content_type='text/plain; charset=utf-8', headers={
+        'X-Profile-Samples': str(profiler.samples),
+        # Asyncio sessions share the event loop thread, so its profile covers all of them
+        'X-Profile-Shared-Thread': 'true' if music_server.async_core or session.broadcast else 'false'
+    })
+
 @app.errorhandler(Exception)
 def handle_error(e):
     logger.error(f"Unhandled error: {e}")
     return jsonify({'error': 'Internal server error'}), 500
 
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+def websocket_accept(key):
+    """Sec-WebSocket-Accept value answering a client's Sec-WebSocket-Key"""
+    digest = hashlib.sha1((key + WEBSOCKET_GUID).encode('latin-1')).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+def websocket_handshake(key):
+    return ("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {websocket_accept(key)}\r\n\r\n").encode('latin-1')
+
+def websocket_frame(opcode, payload):
+    """One unfragmented, unmasked server frame"""
+    length = len(payload)
+    if length < 126:
+        head = bytes((0x80 | opcode, length))
+    elif length < 65536:
+        head = bytes((0x80 | opcode, 126)) + length.to_bytes(2, 'big')
+    else:
+        head = bytes((0x80 | opcode, 127)) + length.to_bytes(8, 'big')
+    return head + payload
+
+class WebSocketReader:
+    """Incremental parser of client frames: feed() bytes, get back complete (opcode, payload) messages"""
+
+    MAX_MESSAGE = 65536  # Clients only send small control messages
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.fragments = None  # [opcode, payload] of a message still arriving in pieces
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        messages = []
+        while len(buffer) >= 2:
+            final = buffer[0] & 0x80
+            opcode = buffer[0] & 0x0F
+            length = buffer[1] & 0x7F
+            pos = 2
+            if length == 126:
+                pos = 4
+            elif length == 127:
+                pos = 10
+            if len(buffer) < pos:
+                break
+            if pos > 2:
+                length = int.from_bytes(buffer[2:pos], 'big')
+            if length > self.MAX_MESSAGE:
+                raise ValueError("WebSocket message too large")
+            mask = None
+            if buffer[1] & 0x80:
+                mask = buffer[pos:pos + 4]
+                pos += 4
+            if len(buffer) < pos + length:
+                break
+
+            payload = bytes(buffer[pos:pos + length])
+            del buffer[:pos + length]
+            if mask:
+                key = np.resize(np.frombuffer(bytes(mask), dtype=np.uint8), length)
+                payload = (np.frombuffer(payload, dtype=np.uint8) ^ key).tobytes()
+
+            if opcode >= 0x8:
+                messages.append((opcode, payload))  # Control frames may arrive between fragments
+            elif opcode == 0x0 and self.fragments:
+                self.fragments[1] += payload
+                if final:
+                    messages.append((self.fragments[0], bytes(self.fragments[1])))
+                    self.fragments = None
+            elif not final:
+                self.fragments = [opcode, bytearray(payload)]
+            else:
+                messages.append((opcode, payload))
+        return messages
+
+class PushStream:
+    """Transport-independent state of one /ws/<session_id> connection.
+
+    The server sends each chunk as a binary message (4-byte big-endian
+    sequence number, then the chunk as /chunks would frame it) and only while
+    the client has credit: it grants N chunks up front (?credit=N) and more
+    with {"type": "credit", "chunks": N}, so at most its grant is ever in
+    flight. Text messages carry JSON control: pause, resume, volume, seek and
+    stop from the client; replies, end of stream and errors from the server.
+    """
+
+    MAX_CREDITS = 256
+
+    def __init__(self, server, session_id, wake=None, credits=0):
+        self.server = server
+        self.session_id = session_id
+        self.wake = wake  # Also called whenever credit, pause or closing changed (asyncio senders)
+        # The reader grants credit while the sender spends it; wait_ready() sleeps on it
+        self.cond = threading.Condition()
+        self.credits = min(self.MAX_CREDITS, max(0, credits))
+        self.paused = False
+        self.closed = False  # No more chunks go out
+        self.close_sent = False
+        self.close_lock = threading.Lock()
+        self.reader = WebSocketReader()
+        self.recommended = None  # Last profile recommendation sent
+
+    @staticmethod
+    def text(message):
+        return websocket_frame(0x1, json.dumps(message).encode('utf-8'))
+
+    def close_frames(self, message=None):
+        """Final frames: an optional last text message, then a normal close; nothing if already closing"""
+        self.closed = True
+        with self.close_lock:
+            if self.close_sent:
+                return []
+            self.close_sent = True
+        frames = [self.text(message)] if message else []
+        return frames + [websocket_frame(0x8, (1000).to_bytes(2, 'big'))]
+
+    def chunk_frames(self, first, chunks):
+        with self.cond:
+            self.credits -= len(chunks)
+        return [websocket_frame(0x2, (first + i).to_bytes(4, 'big') + chunk) for i, chunk in enumerate(chunks)]
+
+    def resume(self, from_seq):
+        """Frames resending what the client missed on a previous connection"""
+        session = self.server.active_streams.get(self.session_id)
+        resent = self.server.resume_chunks(session, from_seq) if session else []
+        if resent is None:
+            return self.close_frames({'type': 'error', 'status': 410,
+                                      'error': 'Chunks no longer retained, restart at your position'})
+        return self.chunk_frames(from_seq, resent)
+
+    def profile_frames(self, change, switched=None):
+        """Notice of a profile switch (switched: the session now serving the stream) or recommendation.
+
+        A switch notice goes out before the first chunk in the new profile;
+        a recommendation only when it differs from the last one sent.
+        """
+        if switched is not None:
+            self.recommended = None
+            return [self.text(dict(change, type='profile', switched=True, next_chunk=switched.next_seq))]
+        if change == self.recommended:
+            return []
+        self.recommended = change
+        return [self.text(dict(change, type='profile', switched=False))]
+
+    def ready(self):
+        """Whether the next chunk may go out"""
+        return not self.paused and self.credits > 0
+
+    def wait_ready(self, timeout):
+        """Block until the next chunk may go out or the stream closes; False if neither within timeout"""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.closed or self.ready(), timeout)
+
+    def notify(self):
+        """Wake the sender after credit, pause or closing changed"""
+        with self.cond:
+            self.cond.notify_all()
+        if self.wake:
+            self.wake()
+
+    def touch(self):
+        # A paused or starved listener is still there; keep the reaper away
+        session = self.server.active_streams.get(self.session_id)
+        if session:
+            session.last_activity = time.time()
+
+    def receive(self, data):
+        """Handle bytes from the client; returns frames to send back"""
+        replies = []
+        try:
+            messages = self.reader.feed(data)
+        except ValueError:
+            messages = []
+            replies += self.close_frames()
+        for opcode, payload in messages:
+            if opcode == 0x8:
+                replies += self.close_frames()
+            elif opcode == 0x9:
+                replies.append(websocket_frame(0xA, payload))
+            elif opcode == 0x1:
+                reply = self.control(payload)
+                if reply:
+                    replies += self.close_frames(reply) if self.closed else [self.text(reply)]
+        self.notify()
+        return replies
+
+    def control(self, payload):
+        """Apply one JSON control message; returns the reply, if any"""
+        try:
+            message = json.loads(payload)
+            kind = message.get('type')
+            server = self.server
+            if kind == 'credit':
+                granted = max(0, int(message.get('chunks', 0)))
+                with self.cond:
+                    self.credits = min(self.MAX_CREDITS, self.credits + granted)
+                return None
+            if kind == 'pause':
+                self.paused = True
+                return {'type': 'paused'}
+            if kind == 'resume':
+                self.paused = False
+                return {'type': 'resumed'}
+            if kind == 'stop':
+                self.closed = True
+                if self.session_id in server.active_streams:
+                    server.cleanup_session(self.session_id)
+                return {'type': 'stopped'}
+
+            session = server.active_streams.get(self.session_id)
+            if session is None:
+                return {'type': 'error', 'status': 404, 'error': 'Session not found'}
+            if kind == 'volume':
+                config = server.tune_session(session, {'volume': message['volume']})
+                if config is None:
+                    return {'type': 'error', 'status': 409,
+                            'error': 'Live changes need a stream started with dsp_engine=numpy'}
+                return {'type': 'config', 'audio_config': config}
+            if kind == 'seek':
+                return dict(server.seek_session(session, float(message['seconds'])), type='seek')
+            return {'type': 'error', 'status': 400, 'error': f"Unknown control message {kind!r}"}
+        except ServerBusy as e:
+            return {'type': 'error', 'status': 503, 'error': str(e), 'retry_after': e.retry_after}
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return {'type': 'error', 'status': 400, 'error': 'Malformed control message'}
+
+def call_wsgi(flask_app, method, target, headers, body):
+    """Run one request through a WSGI app, returning (status, headers, payload)"""
+    path, _, query = target.partition('?')
+    environ = EnvironBuilder(
+        path=unquote(path),
+        query_string=query,
+        method=method,
+        headers=headers,
+        data=body
+    ).get_environ()
+    app_iter, status, response_headers = run_wsgi_app(flask_app, environ, buffered=True)
+    try:
+        payload = b''.join(app_iter)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    return int(status.split(' ', 1)[0]), list(response_headers.items()), payload
+
+class AsyncStreamServer:
+    """Asyncio front end that serves chunks without parking a thread per request.
+
+    FFmpeg pipes are read with asyncio subprocesses and /chunk is answered from
+    coroutines on a single event loop. Every other route is dispatched to the
+    Flask app on a small executor, so the HTTP API is unchanged for clients.
+    """
+
+    def __init__(self, server, flask_app, max_workers=8):
+        self.server = server
+        self.app = flask_app
+        self.loop = None
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='async-wsgi')
+
+    def launch(self, session):
+        """Register a session and start its worker on the event loop (thread-safe)"""
+        session.chunk_queue = asyncio.Queue(maxsize=30)
+        session.ready = asyncio.Event()
+        self.server.active_streams.add(session)
+        session.task = asyncio.run_coroutine_threadsafe(self.stream_worker(session), self.loop)
+
+    async def stream_worker(self, session):
+        """Coroutine equivalent of OptimizedChunkedMusicServer.stream_worker"""
+        server = self.server
+        session_id = session.session_id
+        config = session.audio_config
+        chunk_queue = session.chunk_queue
+        label = f"session {session_id}"
+        # The event loop thread, shared with every other asyncio session
+        session.thread_id = threading.get_ident()
+        process = None
+        writer = None
+        stderr_tasks = []
+
+        try:
+            started = time.time()
+            stream_info = await asyncio.wrap_future(server.lookup_stream(session.video_id))
+            RESOLVE_SECONDS.observe(time.time() - started)
+            if not stream_info:
+                raise Exception("Failed to get stream URL")
+            session.metadata = stream_info
+            mark_stage(session.timings, session.start_time, 'resolved')
+
+            start_seconds = session.start_sample / config['sample_rate']
+            loudness = server.track_loudness(session.video_id, stream_info['url'], config)
+            if server.needs_lead_in(config, loudness) and server.admit_lead_in(session):
+                session.lead_in = await self._spawn(
+                    server.ffmpeg_command(stream_info['url'], config, start_seconds, server.fast_start_seconds),
+                    f"{label} lead-in", stderr_tasks)
+            process = await self._spawn(
+                server.ffmpeg_command(stream_info['url'], config, start_seconds, loudness=loudness),
+                label, stderr_tasks)
+            session.process = process
+            mark_stage(session.timings, session.start_time, 'spawned')
+
+            if not start_seconds:
+                writer = server.pcm_cache.writer(PCMCache.make_key(session.video_id, config))
+            dsp = session.dsp
+            chunk_size = config['chunk_size'] * (4 if dsp else 1)
+            first_size = server.first_chunk_bytes(config) * (4 if dsp else 1) if config['fast_start'] else None
+            chunks_processed = 0
+
+            if session.lead_in:
+                chunks = self._lead_in_chunks(session.lead_in, process, chunk_size, first_size,
+                                              writer.write if writer else lambda data: None,
+                                              lambda: server.release_lead_in(session))
+                tee = None
+            else:
+                chunks = self._read_chunks(process, chunk_size, first_size)
+                tee = writer
+
+            at_eof = True
+            async for chunk_data in chunks:
+                if not session.is_active:
+                    at_eof = False
+                    break
+                if not chunks_processed:
+                    mark_stage(session.timings, session.start_time, 'first_output')
+
+                if dsp:
+                    chunk_data = dsp.process(chunk_data)
+                if tee:
+                    tee.write(chunk_data)
+                server.check_metrics(chunk_data, chunks_processed, session_id, label)
+                chunk_data = server.wire_chunk(chunk_data, session.encoder, config)
+
+                await self.enqueue_chunk(session, chunk_data)
+                session.total_chunks_sent += 1
+                chunks_processed += 1
+
+                if not session.ready.is_set():
+                    session.ready.set()
+                    mark_stage(session.timings, session.start_time, 'ready')
+                    logger.info(f"First chunk ready for session {session_id}")
+
+            returncode = await process.wait() if at_eof else None
+            if writer:
+                server.finish_cache(writer, returncode, session.is_active and not (dsp and dsp.modified),
+                                    stream_info)
+                writer = None
+
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Stream worker error for session {session_id}: {e}")
+            session.error = str(e)
+        finally:
+            if writer:
+                writer.abort()
+            children = [child for child in (process, session.lead_in) if child]
+            for child in children:
+                if child.returncode is None:
+                    child.kill()
+            for task in stderr_tasks:
+                task.cancel()
+
+            session.is_active = False
+            server.release_lead_in(session)
+            server.release_admission(session)
+            # Signal end of stream
+            if not chunk_queue.full():
+                chunk_queue.put_nowait(None)
+            session.ready.set()
+            logger.info(f"Stream worker ended for session {session_id}")
+
+            for child in children:
+                # Nothing above may wait: a cancellation can reach this task again while it reaps
+                await asyncio.shield(self._reap(child))
+
+    @staticmethod
+    async def _reap(process):
+        """Wait for an FFmpeg to exit. wait() also waits for its pipes to close, and a full
+        queue may have left stdout reading paused, so drain that first."""
+        await process.stdout.read()
+        await process.wait()
+
+    async def _spawn(self, cmd, label, stderr_tasks):
+        logger.info(f"Starting FFmpeg with command: {' '.join(cmd[:10])}...")
+        started = time.time()
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        SPAWN_SECONDS.observe(time.time() - started)
+        stderr_tasks.append(asyncio.create_task(self._stderr_reader(process, label)))
+        return process
+
+    async def _read_chunks(self, process, chunk_size, first_size=None):
+        """Chunks of FFmpeg output (the first one first_size long), then the remainder at EOF"""
+        size = first_size or chunk_size
+        while True:
+            try:
+                yield await process.stdout.readexactly(size)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    yield e.partial
+                return
+            size = chunk_size
+
+    async def _lead_in_chunks(self, lead_in, process, chunk_size, first_size, on_output, on_lead_in_end):
+        """Coroutine equivalent of OptimizedChunkedMusicServer._lead_in_chunks"""
+        played = 0
+        async for chunk_data in self._read_chunks(lead_in, chunk_size, first_size):
+            played += len(chunk_data)
+            yield chunk_data
+        on_lead_in_end()
+
+        async for chunk_data in self._read_chunks(process, chunk_size):
+            on_output(chunk_data)
+            cut = min(played, len(chunk_data))
+            played -= cut
+            if cut < len(chunk_data):
+                yield chunk_data[cut:]
+
+    async def enqueue_chunk(self, session, chunk_data):
+        """Coroutine equivalent of OptimizedChunkedMusicServer.enqueue_chunk"""
+        chunk_queue = session.chunk_queue
+        policy = session.audio_config['backpressure']
+
+        if policy == 'lossless':
+            # Not awaiting stdout meanwhile lets the pipe push back on FFmpeg
+            while session.is_active:
+                waited = time.time()
+                try:
+                    await asyncio.wait_for(chunk_queue.put(chunk_data), timeout=0.5)
+                    return
+                except asyncio.TimeoutError:
+                    session.stalled_seconds += time.time() - waited
+            return
+
+        try:
+            await asyncio.wait_for(chunk_queue.put(chunk_data), timeout=0.5)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+        logger.debug(f"Buffer full for session {session.session_id}, applying {policy}")
+        while not chunk_queue.empty():
+            chunk_queue.get_nowait()
+            session.dropped_chunks += 1
+            DROPPED_CHUNKS.inc(1, policy)
+            if policy == 'drop-oldest':
+                break
+        chunk_queue.put_nowait(chunk_data)
+
+    async def _stderr_reader(self, process, label):
+        async for line in process.stderr:
+            decoded_line = line.decode('utf-8', errors='ignore').strip()
+            if decoded_line:
+                if 'error' in decoded_line.lower():
+                    FFMPEG_ERRORS.inc()
+                    logger.warning(f"FFmpeg error in {label}: {decoded_line}")
+                else:
+                    logger.debug(f"FFmpeg output: {decoded_line}")
+
+    async def next_chunk(self, session_id):
+        """Coroutine equivalent of OptimizedChunkedMusicServer.get_next_chunk"""
+        session = self.server.active_streams.get(session_id)
+        if not session:
+            return None
+
+        session.last_activity = time.time()
+
+        if session.cache_view is not None:
+            return self.server.get_next_chunk(session_id)
+
+        try:
+            await asyncio.wait_for(session.ready.wait(), timeout=15)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stream timeout for session {session_id}")
+            return None
+
+        try:
+            return await asyncio.wait_for(session.chunk_queue.get(), timeout=2.0)
+        except asyncio.TimeoutError:
+            # Check if stream is still active
+            if session.is_active:
+                return b''  # Return empty chunk to keep connection alive
+            return None
+
+    def _poll_chunk(self, session):
+        """Next chunk without waiting: b'' if nothing is queued, None at end of stream"""
+        if session.cache_view is not None:
+            return self.server.get_next_chunk(session.session_id)
+
+        try:
+            chunk = session.chunk_queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return b''
+        if chunk is None:
+            # Leave the end-of-stream marker for the next request
+            session.chunk_queue.put_nowait(None)
+        return chunk
+
+    async def chunk_batch(self, session, from_seq, max_chunks, max_bytes):
+        """Coroutine equivalent of OptimizedChunkedMusicServer.chunk_batch"""
+        server = self.server
+        if from_seq is not None:
+            resent = server.resume_chunks(session, from_seq)
+            if resent is None:
+                return 410, None, None
+            if resent:
+                return 200, from_seq, resent
+
+        session_id = session.session_id
+        epoch = session.seek_epoch
+        started = time.time()
+        first = await self.next_chunk(session_id)
+
+        current = server.active_streams.get(session_id)
+        if current is not session:
+            # Replaced by a seek while we waited: nothing fetched belongs to the new position
+            return (200, current.next_seq, []) if current else (204, None, None)
+        if first is None:
+            server.cleanup_session(session_id)
+            return 204, None, None
+
+        chunks = [first] if first else []
+        total = len(first)
+        wire_bytes = server.wire_chunk_bytes(session.audio_config)
+        while chunks and len(chunks) < max_chunks:
+            if total + wire_bytes > max_bytes:
+                break
+            chunk = self._poll_chunk(session)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            total += len(chunk)
+
+        first, chunks = server.deliver(session, chunks, epoch, retain=from_seq is not None)
+        server.record_chunk_wait('chunks', started, chunks)
+        return 200, first, chunks
+
+    async def handle_chunks(self, session_id, query):
+        params = parse_qs(query)
+        max_chunks, max_bytes = batch_limits(
+            int(params.get('max', ['16'])[0]),
+            int(params.get('max_bytes', ['262144'])[0])
+        )
+        from_seq = int(params['from'][0]) if 'from' in params else None
+
+        session = self.server.active_streams.get(session_id)
+        if not session:
+            if from_seq is not None:
+                return 404, [('Content-Type', 'application/json')], json.dumps({'error': 'Session not found'}).encode()
+            return 204, [], b''
+
+        status, first, chunks = await self.chunk_batch(session, from_seq, max_chunks, max_bytes)
+        if status == 204:
+            return 204, [], b''
+        if status == 410:
+            return 410, [('Content-Type', 'application/json')], json.dumps(
+                {'error': 'Chunks no longer retained, restart at your position'}).encode()
+
+        profile = await self.adapt_profile(session_id)
+        return 200, [
+            ('Content-Type', 'application/octet-stream'),
+            ('Cache-Control', 'no-cache, no-store, must-revalidate'),
+            ('X-Chunk-Count', str(len(chunks))),
+            ('X-First-Chunk', str(first)),
+            ('X-Session-Active', 'true' if chunks else 'false')
+        ] + list(profile.items()), frame_chunks(chunks)
+
+    async def handle_chunk(self, session_id):
+        session = self.server.active_streams.get(session_id)
+        if not session:
+            return 204, [], b''
+
+        epoch = session.seek_epoch
+        started = time.time()
+        chunk = await self.next_chunk(session_id)
+
+        if chunk is None and self.server.active_streams.get(session_id) is session:
+            self.server.cleanup_session(session_id)
+            return 204, [], b''
+
+        first, chunks = self.server.deliver(session, [chunk] if chunk else [], epoch)
+        self.server.record_chunk_wait('chunk', started, chunks)
+        chunk = chunks[0] if chunks else b''
+        profile = await self.adapt_profile(session_id)
+
+        return 200, [
+            ('Content-Type', 'application/octet-stream'),
+            ('Cache-Control', 'no-cache, no-store, must-revalidate'),
+            ('X-Chunk-Size', str(len(chunk))),
+            ('X-First-Chunk', str(first)),
+            ('X-Session-Active', 'true' if chunk else 'false')
+        ] + list(profile.items()), bytes(chunk)
+
+    async def adapt_profile(self, session_id):
+        """Coroutine equivalent of OptimizedChunkedMusicServer.adapt_profile"""
+        server = self.server
+        session, change = server.profile_change(session_id)
+        if session is None:
+            return {}
+        config = session.audio_config
+        switched = False
+        if change and config['adaptive']:
+            # The restart starts FFmpeg and tears the old one down, so keep it off the loop
+            switched = await self.loop.run_in_executor(self.executor, server.switch_profile,
+                                                       session, change) is not None
+        return server.profile_headers(config, change, switched)
+
+    async def handle_websocket(self, reader, writer, target, header_map):
+        """Coroutine equivalent of push_to_socket: no thread waits for credit or chunks"""
+        path, _, query = target.partition('?')
+        session_id = path[len('/ws/'):]
+        params = parse_qs(query)
+        server = self.server
+        if session_id not in server.active_streams:
+            body = json.dumps({'error': 'Session not found'}).encode()
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Type: application/json\r\n"
+                         b"Connection: close\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+            await writer.drain()
+            return
+
+        writer.write(websocket_handshake(header_map['sec-websocket-key']))
+        wake = asyncio.Event()
+        loop = self.loop
+        push = PushStream(server, session_id, lambda: loop.call_soon_threadsafe(wake.set),
+                          int(params.get('credit', ['0'])[0]))
+
+        busy = False
+
+        async def read_control():
+            nonlocal busy
+            try:
+                while not push.closed:
+                    data = await reader.read(4096)
+                    if not data:
+                        break
+                    busy = True
+                    # Seeks may restart FFmpeg and wait for admission, so keep them off the loop
+                    writer.write(b''.join(await loop.run_in_executor(self.executor, push.receive, data)))
+                    await writer.drain()
+                    busy = False
+            except ConnectionError:
+                pass
+            finally:
+                push.closed = True
+                wake.set()
+
+        control = asyncio.create_task(read_control())
+        try:
+            if 'from' in params:
+                writer.write(b''.join(push.resume(int(params['from'][0]))))
+            while not push.closed:
+                if not push.ready():
+                    wake.clear()
+                    try:
+                        await asyncio.wait_for(wake.wait(), timeout=5)
+                    except asyncio.TimeoutError:
+                        push.touch()
+                    continue
+
+                session = server.active_streams.get(session_id)
+                if session is None:
+                    writer.write(b''.join(push.close_frames({'type': 'end'})))
+                    break
+                epoch = session.seek_epoch
+                started = time.time()
+                chunk = await self.next_chunk(session_id)
+
+                if chunk is None and server.active_streams.get(session_id) is session:
+                    server.cleanup_session(session_id)
+                    writer.write(b''.join(push.close_frames({'type': 'end', 'error': session.error})))
+                    break
+                first, chunks = server.deliver(session, [chunk] if chunk else [], epoch, retain=True)
+                if chunks:
+                    server.record_chunk_wait('ws', started, chunks)
+                    writer.write(b''.join(push.chunk_frames(first, chunks)))
+                    await writer.drain()
+
+                session, change = server.profile_change(session_id)
+                if change and session.audio_config['adaptive']:
+                    fresh = await loop.run_in_executor(self.executor, server.switch_profile, session, change)
+                    writer.write(b''.join(push.profile_frames(change, fresh)))
+                elif change:
+                    writer.write(b''.join(push.profile_frames(change)))
+            await writer.drain()
+        finally:
+            push.closed = True
+            if busy:
+                await control  # Let a reply in the making (to a stop, say) go out first
+            else:
+                control.cancel()
+
+    async def dispatch(self, method, target, headers, body):
+        path, _, query = target.partition('?')
+        if method == 'GET' and path.startswith('/chunk/'):
+            return await self.handle_chunk(path[len('/chunk/'):])
+        if method == 'GET' and path.startswith('/chunks/'):
+            return await self.handle_chunks(path[len('/chunks/'):], query)
+        return await self.loop.run_in_executor(self.executor, call_wsgi, self.app, method, target, headers, body)
+
+    async def handle_connection(self, reader, writer):
+        """Minimal HTTP/1.1 server loop with keep-alive"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+
+                headers = []
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers.append((name.strip(), value.strip()))
+                header_map = {name.lower(): value for name, value in headers}
+                if (method == 'GET' and target.startswith('/ws/') and 'sec-websocket-key' in header_map
+                        and header_map.get('upgrade', '').lower() == 'websocket'):
+                    await self.handle_websocket(reader, writer, target, header_map)
+                    break
+
+                body = await reader.readexactly(int(header_map.get('content-length', 0) or 0))
+
+                try:
+                    status, response_headers, payload = await self.dispatch(method, target, headers, body)
+                except Exception as e:
+                    logger.error(f"Unhandled error: {e}")
+                    status, response_headers, payload = 500, [('Content-Type', 'application/json')], \
+                        b'{"error": "Internal server error"}'
+
+                keep_alive = version == 'HTTP/1.1' and header_map.get('connection', '').lower() != 'close'
+                response_headers = [(k, v) for k, v in response_headers
+                                    if k.lower() not in ('content-length', 'connection')]
+                response_headers.append(('Content-Length', str(len(payload))))
+                response_headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+
+                head = f"HTTP/1.1 {status} {HTTP_STATUS_CODES.get(status, '')}\r\n"
+                head += ''.join(f"{k}: {v}\r\n" for k, v in response_headers)
+                writer.write(head.encode('latin-1') + b'\r\n' + payload)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        self.loop = asyncio.get_running_loop()
+        self.server.async_core = self
+        http_server = await asyncio.start_server(self.handle_connection, host, port)
+        async with http_server:
+            await http_server.serve_forever()
+
+class WorkerConnection:
+    """Front-end side of one worker process: its request pipe, reply reader and reply slots.
+
+    Requests are (id, method, target, headers, body) tuples. The worker copies
+    each response body into a free slot of a shared memory segment and sends
+    back only its location; the reader copies it out and hands the slot back.
+    Bodies that are larger than a slot, or that arrive while every slot is in
+    use, come through the pipe instead.
+    """
+
+    def __init__(self, ctx, index, count, cache_root, slots, slot_size, profiling=False, library=None):
+        self.index = index
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        self.conn, child_conn = ctx.Pipe()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.ids = itertools.count()
+        self.alive = True
+
+        # The module-level server of the spawned process picks up its cache partition
+        previous = os.environ.get('MUSIC_CACHE_ROOT')
+        os.environ['MUSIC_CACHE_ROOT'] = os.path.join(cache_root, f"worker-{index}")
+        try:
+            self.process = ctx.Process(target=worker_main, name=f"music-worker-{index}", daemon=True,
+                                       args=(index, count, child_conn, self.shm.name, slots, slot_size,
+                                             profiling, library))
+            self.process.start()
+        finally:
+            if previous is None:
+                del os.environ['MUSIC_CACHE_ROOT']
+            else:
+                os.environ['MUSIC_CACHE_ROOT'] = previous
+        child_conn.close()
+
+        self.reader = threading.Thread(target=self._read_replies, daemon=True)
+        self.reader.start()
+
+    def _send(self, message):
+        with self.lock:
+            if not self.alive:
+                raise ServerBusy(f"Worker {self.index} is unavailable", 5)
+            self.conn.send(message)
+
+    def _read_replies(self):
+        while True:
+            try:
+                request_id, status, headers, slot, length, payload = self.conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if slot is not None:
+                offset = slot * self.slot_size
+                payload = bytes(self.shm.buf[offset:offset + length])
+                try:
+                    self._send((None, 'free', slot))
+                except (ServerBusy, OSError):
+                    pass
+
+            with self.lock:
+                future = self.pending.pop(request_id, None)
+            if future:
+                future.set_result((status, headers, payload))
+
+        with self.lock:
+            self.alive = False
+            pending, self.pending = self.pending, {}
+        logger.error(f"Worker {self.index} exited; its sessions are gone")
+        for future in pending.values():
+            future.set_exception(ServerBusy(f"Worker {self.index} is unavailable", 5))
+
+    def request(self, method, target, headers, body, timeout):
+        """Send a request and wait for its (status, headers, payload), raising ServerBusy on failure"""
+        future = Future()
+        with self.lock:
+            if not self.alive:
+                raise ServerBusy(f"Worker {self.index} is unavailable", 5)
+            request_id = next(self.ids)
+            self.pending[request_id] = future
+            self.conn.send((request_id, method, target, headers, body))
+
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            with self.lock:
+                self.pending.pop(request_id, None)
+            raise ServerBusy(f"Worker {self.index} did not answer in time", 5)
+
+    def close(self):
+        with self.lock:
+            self.alive = False
+            self.conn.close()
+        # Workers stop their sessions when the pipe closes
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.shm.close()
+        self.shm.unlink()
+
+class WorkerPool:
+    """Scale-out front end that spreads transcoding over worker processes.
+
+    Each worker is a spawned copy of this module with its own server and PCM
+    cache partition. Tracks are assigned by a stable hash of the video id, so
+    shared transcodes, prefetches and cache hits for a track stay in one
+    process. Workers prefix their index to the session ids they create
+    (w<index>-<uuid>), so later requests route without a lookup table. Routes
+    that do not involve a session (search, capabilities) stay in the front end.
+    """
+
+    SESSION_ROUTES = ('/chunk/', '/chunks/', '/stop_stream/', '/seek/', '/stream_config/',
+                      '/stream_info/', '/stream_quality/', '/profile/')
+
+    def __init__(self, count, cache_root, slots=16, slot_size=512 * 1024, request_timeout=60, profiling=False,
+                 library=None):
+        self.request_timeout = request_timeout
+        ctx = multiprocessing.get_context('spawn')
+        # Workers serve the front end's library catalog: (root, catalog path)
+        self.workers = [WorkerConnection(ctx, index, count, cache_root, slots, slot_size, profiling, library)
+                        for index in range(count)]
+        atexit.register(self.close)
+
+    def video_worker(self, video_id):
+        """Index of the worker that owns a track"""
+        digest = hashlib.sha1(str(video_id).encode('utf-8')).digest()
+        return int.from_bytes(digest[:4], 'big') % len(self.workers)
+
+    def session_worker(self, session_id):
+        """Index encoded in a session id, or None if it names no worker"""
+        prefix, _, rest = session_id.partition('-')
+        if rest and prefix[:1] == 'w' and prefix[1:].isdigit() and int(prefix[1:]) < len(self.workers):
+            return int(prefix[1:])
+        return None
+
+    def call(self, index, method, target, headers, body):
+        return self.workers[index].request(method, target, headers, body, self.request_timeout)
+
+    def forward(self, index, method, target, headers, body):
+        try:
+            status, headers, payload = self.call(index, method, target, headers, body)
+        except ServerBusy as e:
+            return busy_response(e)
+        return Response(payload, status=status, headers=headers)
+
+    def route(self, req):
+        """Response from the owning worker, or None to let the front end's own routes answer"""
+        path = req.path
+        if req.method == 'POST' and path == '/start_stream':
+            return self.start_stream(req)
+        if req.method == 'POST' and path == '/prefetch':
+            return self.prefetch_route(req)
+        if path.startswith('/ws/'):
+            # An upgraded socket cannot be handed to a worker over its pipe
+            return jsonify({'error': 'WebSocket streaming is not available with --workers, poll /chunks instead'}), 501
+        if path.startswith(self.SESSION_ROUTES):
+            index = self.session_worker(path.split('/')[2])
+            if index is not None:
+                target = path + ('?' + req.query_string.decode('latin-1') if req.query_string else '')
+                return self.forward(index, req.method, target, list(req.headers.items()), req.get_data())
+        # Unknown sessions get the same answer a single-process server gives
+        return None
+
+    def start_stream(self, req):
+        data = req.get_json(silent=True)
+        video_id = (data or {}).get('id') or req.args.get('id')
+        if data is None or not video_id:
+            return None
+
+        # Upcoming tracks may belong to other workers, so warm them from here
+        next_ids = data.pop('next_ids', None) or []
+        target = req.full_path.rstrip('?')
+        response = self.forward(self.video_worker(video_id), 'POST', target,
+                                [('Content-Type', 'application/json')], json.dumps(data).encode('utf-8'))
+
+        if response.status_code == 200 and isinstance(next_ids, list) and next_ids:
+            self.prefetch([i for i in next_ids if i != video_id], data.get('audio_config', {}))
+        return response
+
+    def prefetch_route(self, req):
+        data = req.get_json(silent=True) or {}
+        video_ids = data.get('ids') or []
+        if not isinstance(video_ids, list) or not video_ids:
+            return None
+
+        results = self.prefetch(video_ids, data.get('audio_config', {}))
+        return jsonify({'prefetch': results, 'limit': music_server.prefetch_limit})
+
+    def prefetch(self, video_ids, audio_config):
+        """Hand each track to its owner, keeping the single-process per-request limit"""
+        groups = collections.defaultdict(list)
+        for video_id in video_ids[:music_server.prefetch_limit]:
+            groups[self.video_worker(video_id)].append(video_id)
+
+        results = {}
+        for index, ids in groups.items():
+            body = json.dumps({'ids': ids, 'audio_config': audio_config}).encode('utf-8')
+            try:
+                status, _, payload = self.call(index, 'POST', '/prefetch',
+                                               [('Content-Type', 'application/json')], body)
+            except ServerBusy:
+                status = None
+            if status == 200:
+                results.update(json.loads(payload)['prefetch'])
+            else:
+                results.update((video_id, 'busy') for video_id in ids)
+        return results
+
+    def resolve_batch(self, video_ids):
+        """Yield (video_id, summary or None) as each owner's share of the tracks resolves.
+
+        A summary holds only the title, artist and duration the worker reports;
+        the stream info itself stays cached in the worker that will play it.
+        """
+        groups = collections.defaultdict(list)
+        for video_id in video_ids:
+            groups[self.video_worker(video_id)].append(video_id)
+
+        def resolve(index, ids):
+            body = json.dumps({'ids': ids}).encode('utf-8')
+            try:
+                status, _, payload = self.call(index, 'POST', '/resolve_batch',
+                                               [('Content-Type', 'application/json')], body)
+            except ServerBusy:
+                status = None
+            found = {}
+            if status == 200:
+                for line in payload.decode('utf-8').splitlines():
+                    message = json.loads(line)
+                    if message['type'] == 'track':
+                        found[message['id']] = {key: message[key] for key in ('title', 'artist', 'duration')}
+            return [(video_id, found.get(video_id)) for video_id in ids]
+
+        with ThreadPoolExecutor(max_workers=len(groups) or 1) as executor:
+            futures = [executor.submit(resolve, index, ids) for index, ids in groups.items()]
+            for future in as_completed(futures):
+                yield from future.result()
+
+    def health(self):
+        workers = []
+        for worker in self.workers:
+            entry = {'index': worker.index, 'pid': worker.process.pid, 'alive': worker.alive}
+            try:
+                status, _, payload = worker.request('GET', '/health', [], b'', 5)
+                entry.update(json.loads(payload))
+            except ServerBusy as e:
+                entry['error'] = str(e)
+            workers.append(entry)
+
+        return {
+            'status': 'healthy' if all(worker.alive for worker in self.workers) else 'degraded',
+            'active_streams': sum(entry.get('active_streams', 0) for entry in workers),
+            'workers': workers,
+            'server_time': time.time(),
+            'version': '3.0'
+        }
+
+    def metrics(self):
+        """Every worker's /metrics merged into one exposition, samples labelled by worker"""
+        families = {}  # name -> [help and type lines, samples], in first-seen order
+        sources = [('front', METRICS.render())]
+        for worker in self.workers:
+            try:
+                _, _, payload = worker.request('GET', '/metrics', [], b'', 5)
+                sources.append((str(worker.index), payload.decode('utf-8')))
+            except ServerBusy:
+                pass
+
+        for label, text in sources:
+            family = None
+            for line in text.splitlines():
+                if line.startswith('# '):
+                    name = line.split(' ', 3)[2]
+                    family = families.setdefault(name, [[], []])
+                    if len(family[0]) < 2:
+                        family[0].append(line)
+                elif line and family is not None:
+                    # Insert the worker label ahead of any the sample already has
+                    brace, space = line.find('{'), line.find(' ')
+                    if 0 <= brace < space:
+                        line = f'{line[:brace + 1]}worker="{label}",{line[brace + 1:]}'
+                    else:
+                        line = f'{line[:space]}{{worker="{label}"}}{line[space:]}'
+                    family[1].append(line)
+
+        return ''.join('\n'.join(header + samples) + '\n' for header, samples in families.values())
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+def worker_main(index, count, conn, shm_name, slots, slot_size, profiling=False, library=None):
+    """Entry point of a worker process: serve forwarded requests with this process's server"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    server = music_server
+    server.session_prefix = f"w{index}-"
+    server.profiling_enabled = profiling
+    if library:
+        server.attach_library(*library, scan=False)
+    # Each worker gets its share of the machine-wide budgets
+    server.admission = AdmissionController(
+        max_transcodes=max(2, (os.cpu_count() or 2) // count),
+        max_buffered_bytes=server.admission.max_buffered_bytes // count
+    )
+    server.pcm_cache.max_bytes //= count
+
+    free_slots = queue.SimpleQueue()
+    for slot in range(slots):
+        free_slots.put(slot)
+    send_lock = threading.Lock()
+    # Chunk requests long-poll, so allow about as many in flight as a threaded Flask would
+    executor = ThreadPoolExecutor(max_workers=256, thread_name_prefix=f"worker-{index}")
+
+    def handle(request_id, method, target, headers, body):
+        try:
+            status, headers, payload = call_wsgi(app, method, target, headers, body)
+        except Exception as e:
+            logger.error(f"Worker {index} failed on {method} {target}: {e}")
+            status, headers, payload = 500, [('Content-Type', 'application/json')], \
+                b'{"error": "Internal server error"}'
+
+        slot = None
+        if 0 < len(payload) <= slot_size:
+            try:
+                slot = free_slots.get_nowait()
+            except queue.Empty:
+                pass
+
+        if slot is None:
+            reply = (request_id, status, headers, None, len(payload), payload)
+        else:
+            offset = slot * slot_size
+            shm.buf[offset:offset + len(payload)] = payload
+            reply = (request_id, status, headers, slot, len(payload), None)
+        try:
+            with send_lock:
+                conn.send(reply)
+        except OSError:
+            pass
+
+    logger.info(f"Worker {index} serving (pid {os.getpid()})")
+    while True:
+        try:
+            request_id, method, *args = conn.recv()
+        except (EOFError, OSError):
+            break
+        if request_id is None:
+            free_slots.put(args[0])  # ('free', slot): the front end copied the reply out
+        else:
+            executor.submit(handle, request_id, method, *args)
+
+    # Front end went away: stop FFmpeg for every session this worker still runs
+    for session in server.active_streams.values():
+        server.cleanup_session(session.session_id)
+    executor.shutdown(wait=False)
+    shm.close()
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Optimized Music Streaming Server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="Serve streams from an asyncio event loop instead of a thread per session")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Transcoding worker processes behind this front end (0: one per CPU)")
+    parser.add_argument('--library', metavar='DIR',
+                        help="Scan DIR for audio files and serve them as local tracks")
+    parser.add_argument('--search', choices=['all', 'local', 'remote'], default='all',
+                        help="Default search sources: library then YouTube, or either alone")
+    parser.add_argument('--profiling', action='store_true',
+                        help="Allow POST /profile/<session_id> to sample a session's producer thread")
+    args = parser.parse_args()
+    if args.workers != 1 and args.use_async:
+        parser.error("--workers and --async cannot be combined")
+
     print("Starting Optimized Music Streaming Server v3.0...")
     print("8-bit audio optimizations enabled")
-    print("Server running on http://0.0.0.0:5000")
-    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
\ No newline at end of file
+    print(f"Server running on http://{args.host}:{args.port}")
+    music_server.profiling_enabled = args.profiling
+    music_server.search_source = args.search
+    if args.library:
+        music_server.attach_library(args.library)
+    if args.workers != 1:
+        worker_count = args.workers or os.cpu_count() or 1
+        library = (music_server.library.root, music_server.library.db_path) if music_server.library else None
+        worker_pool = WorkerPool(worker_count, music_server.pcm_cache.cache_dir, profiling=args.profiling,
+                                 library=library)
+        print(f"Scale-out mode: {worker_count} worker processes")
+    if args.use_async:
+        print("Asyncio streaming core enabled")
+        asyncio.run(AsyncStreamServer(music_server, app).serve(args.host, args.port))
+    else:
+        app.run(host=args.host, port=args.port, debug=False, threaded=True)
\ No newline at end of file
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# server builds its module-level music server on import; keep its caches out of the tree
+os.environ.setdefault('MUSIC_CACHE_ROOT', tempfile.mkdtemp(prefix='music-test-cache-'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,144 @@
+"""Lossless backpressure: a slow consumer stalls the producer but never loses bytes."""
+import os
+import threading
+import time
+
+from server import BroadcastChannel, Session, music_server
+
+
+class FakePipe:
+    """stdout of a process that has `data` to write, at most `read_size` bytes per read"""
+
+    def __init__(self, data, read_size=5000):
+        self.data = memoryview(data)
+        self.read_size = read_size
+        self.pos = 0
+
+    def readinto(self, buf):
+        n = min(len(buf), self.read_size, len(self.data) - self.pos)
+        buf[:n] = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+class FakeProcess:
+    def __init__(self, data):
+        self.stdout = FakePipe(data)
+
+    def poll(self):
+        return 0 if self.stdout.pos == len(self.stdout.data) else None
+
+
+def lossless_config():
+    return music_server.validate_audio_config({'chunk_size': 4096, 'backpressure': 'lossless'})
+
+
+def test_session_queue_loses_nothing_to_slow_consumer():
+    data = os.urandom(4096 * 120 + 123)
+    session = Session('s', 'v', lossless_config())
+    process = FakeProcess(data)
+
+    def produce():
+        for chunk in music_server._iter_chunks(process, 4096, lambda: session.is_active):
+            music_server.enqueue_chunk(session, chunk)
+        session.chunk_queue.put(None)
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+
+    received = bytearray()
+    while True:
+        chunk = session.chunk_queue.get(timeout=10)
+        if chunk is None:
+            break
+        if not received:
+            time.sleep(0.6)  # Long enough for the producer to find the queue full and wait
+        received += chunk
+        time.sleep(0.002)
+    producer.join(5)
+
+    assert bytes(received) == data
+    assert session.dropped_chunks == 0
+    assert session.stalled_seconds > 0
+
+
+def test_full_batch_survives_producer_running_ahead(monkeypatch):
+    """A /chunks batch holds views into the worker's ring until framed; the ring must outlast it"""
+    data = os.urandom(1024 * 400 + 77)
+    process = FakeProcess(data)
+    process.stdout.read_size = 65536  # A full pipe's worth per read, as FFmpeg delivers it
+    monkeypatch.setattr(music_server, 'get_stream_info', lambda video_id: {'url': 'fake://', 'title': 'Fake'})
+    monkeypatch.setattr(music_server, 'track_loudness', lambda video_id, url, config: None)
+    monkeypatch.setattr(music_server, 'needs_lead_in', lambda config, loudness=None: False)
+    monkeypatch.setattr(music_server, '_start_ffmpeg', lambda *args, **kwargs: process)
+
+    config = music_server.validate_audio_config({'chunk_size': 1024, 'backpressure': 'lossless'})
+    session = music_server.new_session('batch-test', config, start_sample=1)  # Mid-track: not cached
+    music_server.active_streams.add(session)
+    worker = threading.Thread(target=music_server.stream_worker, args=(session,), daemon=True)
+    worker.start()
+
+    received = bytearray()
+    try:
+        while True:
+            # Let the producer fill the queue, so the batch comes out full and it refills behind it
+            deadline = time.time() + 5
+            while not session.chunk_queue.full() and worker.is_alive() and time.time() < deadline:
+                time.sleep(0.005)
+            chunks = music_server.get_chunks(session.session_id, 64, 1 << 20)
+            if chunks is None:
+                break
+            time.sleep(0.05)  # The producer keeps reading before the batch is framed
+            received += b''.join(bytes(chunk) for chunk in chunks)
+    finally:
+        music_server.active_streams.pop(session.session_id)
+        worker.join(5)
+
+    assert bytes(received) == data
+
+
+def test_sole_lossless_listener_paces_broadcast():
+    channel = BroadcastChannel('k', 'v', lossless_config(), capacity=16, lead=4)
+    channel.attach('slow')
+    chunks = [os.urandom(64) for _ in range(60)]
+
+    def produce():
+        for chunk in chunks:
+            channel.publish(chunk)
+        channel.finish()
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+
+    received = []
+    while True:
+        chunk = channel.read('slow', timeout=5)
+        if chunk is None:
+            break
+        received.append(chunk)
+        time.sleep(0.005)
+    producer.join(5)
+
+    assert received == chunks
+    assert channel.dropped.get('slow', 0) == 0
+    assert channel.stalled > 0
+
+
+def test_stalled_listener_does_not_hold_up_shared_broadcast():
+    channel = BroadcastChannel('k', 'v', lossless_config(), capacity=16, lead=4)
+    channel.attach('fast')
+    channel.attach('stalled')  # Never reads, like a client that went away
+    chunks = [bytes([i]) * 8 for i in range(60)]
+
+    producer = threading.Thread(target=lambda: [channel.publish(chunk) for chunk in chunks])
+    producer.start()
+    received = [channel.read('fast', timeout=5) for _ in chunks]
+    producer.join(5)
+
+    assert received == chunks
+    assert not producer.is_alive()
+
+    # Off the ring now, the stalled listener rejoins at the live edge
+    channel.finish()
+    assert channel.read('stalled') == chunks[-1]
+    assert channel.dropped['stalled'] == len(chunks) - 1
@@ -0,0 +1,42 @@
+"""Replays of a cached transcode are delivered without FFmpeg, and without deadlocking."""
+import threading
+
+from server import PCMCache, app, music_server
+
+
+def unframe(data):
+    """Chunks of a /chunks body: each a 4-byte big-endian length, then the chunk"""
+    chunks, pos = [], 0
+    while pos < len(data):
+        length = int.from_bytes(data[pos:pos + 4], 'big')
+        chunks.append(data[pos + 4:pos + 4 + length])
+        pos += 4 + length
+    return chunks
+
+
+def test_cached_replay_is_delivered_in_full():
+    config = music_server.validate_audio_config({'chunk_size': 1024})
+    pcm = bytes(range(256)) * 40 + b'\x05' * 300  # Ends on a partial chunk
+    writer = music_server.pcm_cache.writer(PCMCache.make_key('cached-replay', config))
+    writer.write(pcm)
+    writer.commit({'title': 'Cached'})
+
+    client = app.test_client()
+    started = client.post('/start_stream', json={'id': 'cached-replay', 'audio_config': {'chunk_size': 1024}})
+    assert started.status_code == 200
+    session_id = started.get_json()['session_id']
+
+    received = []
+
+    def fetch():
+        while True:
+            response = client.get(f'/chunks/{session_id}?max=4')
+            if response.status_code != 200:
+                break
+            received.extend(unframe(response.data))
+
+    fetcher = threading.Thread(target=fetch, daemon=True)
+    fetcher.start()
+    fetcher.join(timeout=10)
+    assert not fetcher.is_alive(), "delivery from the cache never returned"
+    assert b''.join(received) == pcm
@@ -0,0 +1,69 @@
+"""DFPWMEncoder round trip through a reference DFPWM1a decoder (the cc.audio.dfpwm algorithm)."""
+import numpy as np
+
+from server import DFPWMEncoder
+
+PREC = 10
+
+
+def reference_decode(data):
+    """Bit-by-bit DFPWM1a decoder: predictor, antijerk and low-pass stages as in cc.audio.dfpwm"""
+    charge, strength, previous_bit, low_pass = 0, 0, False, 0
+    output = []
+    for byte in data:
+        for shift in range(8):
+            bit = bool(byte >> shift & 1)
+            target = 127 if bit else -128
+            next_charge = charge + ((strength * (target - charge) + (1 << (PREC - 1))) >> PREC)
+            if next_charge == charge and next_charge != target:
+                next_charge += 1 if bit else -1
+
+            z = (1 << PREC) - 1 if bit == previous_bit else 0
+            next_strength = strength
+            if next_strength != z:
+                next_strength += 1 if bit == previous_bit else -1
+            next_strength = max(next_strength, 2 << (PREC - 8))
+
+            blended = next_charge if bit == previous_bit else (next_charge + charge + 1) >> 1
+            low_pass += ((blended - low_pass) * 140 + 128) >> 8
+            charge, strength, previous_bit = next_charge, next_strength, bit
+            output.append(low_pass)
+    return np.array(output)
+
+
+def tone(seconds=0.5, rate=48000):
+    t = np.arange(int(seconds * rate)) / rate
+    signal = 70 * np.sin(2 * np.pi * 220 * t) + 30 * np.sin(2 * np.pi * 660 * t)
+    return np.round(signal).astype(np.int8)
+
+
+def test_round_trip_error_is_bounded():
+    pcm = tone()
+    encoded = DFPWMEncoder().encode(pcm.tobytes())
+    assert len(encoded) == len(pcm) // 8
+
+    decoded = reference_decode(encoded)
+    # The decoder's low-pass delays its output by about a sample; compare against the
+    # best-aligned shift after the first few ms, which the predictor spends ramping up
+    skip = 480
+    errors = []
+    for delay in range(4):
+        diff = decoded[skip + delay:] - pcm[skip:len(pcm) - delay].astype(int)
+        errors.append(np.sqrt(np.mean(diff ** 2)))
+    rms_error = min(errors)
+    rms_signal = np.sqrt(np.mean(pcm[skip:].astype(float) ** 2))
+
+    # About 25 dB in practice; 8x fewer bits than s8 PCM cost some, not all, of the signal
+    assert 20 * np.log10(rms_signal / rms_error) > 20
+
+
+def test_chunked_encoding_matches_one_pass():
+    pcm = tone().tobytes()
+    encoder = DFPWMEncoder()
+    chunked = b''.join(encoder.encode(pcm[i:i + 4096]) for i in range(0, len(pcm), 4096))
+    assert chunked == DFPWMEncoder().encode(pcm)
+
+
+def test_silence_decodes_near_zero():
+    decoded = reference_decode(DFPWMEncoder().encode(bytes(4096)))
+    assert np.abs(decoded[256:]).max() <= 2
@@ -0,0 +1,64 @@
+"""Adaptive profile switches never cost a listener the stream it already has."""
+import pytest
+
+from server import AdmissionController, ClientPace, music_server
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(music_server, 'admission', AdmissionController(max_transcodes=1))
+    monkeypatch.setattr(music_server, 'stream_worker', lambda session: None)
+    config = music_server.validate_audio_config({})
+    session = music_server.new_session('switch-test', config, session_id='switch-test')
+    music_server.active_streams.add(session)
+    yield music_server, session
+    music_server.active_streams.pop(session.session_id)
+    music_server.release_admission(session)
+
+
+def lighter(config):
+    """The change the server calls for when the transcode cannot keep up"""
+    change = music_server.recommend_profile(config, {'consumption': 0.5, 'interval': 1.0, 'queued': 0})
+    assert change['reason'] == 'server' and change['sample_rate'] < config['sample_rate']
+    return change
+
+
+def test_busy_server_keeps_the_current_session(server):
+    server, session = server
+    server.admit(session)
+
+    assert server.switch_profile(session, lighter(session.audio_config)) is None
+    assert server.active_streams.get(session.session_id) is session
+    assert server.admission.active == 1
+
+
+def test_cached_replay_is_not_switched(server):
+    server, session = server
+    session.cache_view = b'\0' * 64
+
+    assert server.switch_profile(session, lighter(session.audio_config)) is None
+    assert server.active_streams.get(session.session_id) is session
+    session.cache_view = None
+
+
+def test_switch_admits_the_replacement_before_teardown(server):
+    server, session = server
+    next_seq = session.next_seq = 7
+
+    fresh = server.switch_profile(session, lighter(session.audio_config))
+    assert fresh is not None and fresh.admission
+    assert server.active_streams.get(session.session_id) is fresh
+    assert fresh.next_seq == next_seq
+    assert server.admission.active == 1
+    server.active_streams.pop(fresh.session_id)
+    server.release_admission(fresh)
+
+
+def test_pause_does_not_shrink_request_interval():
+    pace = ClientPace()
+    for at in [0, 1, 2, 3, 4, 5, 13, 14, 15, 16, 17, 18]:  # Paused for 8 s in the middle
+        pace.record(at, 1.0, 0)
+
+    summary = pace.summary()
+    assert summary['interval'] == pytest.approx(1.0)
+    assert summary['consumption'] == pytest.approx(1.0)
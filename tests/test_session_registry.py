@@ -0,0 +1,95 @@
+"""SessionRegistry under concurrent create/touch/expire/remove."""
+import random
+import threading
+import time
+
+from server import Session, SessionRegistry
+
+
+def expiry(session):
+    return 0.01 if not session.is_active else 0.05
+
+
+def check_consistent(registry):
+    with registry.lock:
+        sessions = registry.sessions
+        assert {sid for ids in registry.by_video.values() for sid in ids} == set(sessions)
+        assert {sid for ids in registry.by_state.values() for sid in ids} == set(sessions)
+        for state, ids in registry.by_state.items():
+            assert ids and all(sessions[sid].state == state for sid in ids)
+        for video_id, ids in registry.by_video.items():
+            assert ids and all(sessions[sid].video_id == video_id for sid in ids)
+
+        live = [(ticket, sid) for _, ticket, sid in registry.heap
+                if sid in sessions and sessions[sid].expiry_ticket == ticket]
+        assert len(live) == len(set(live))
+        for session in sessions.values():
+            assert session.registry is registry
+            assert session.expiry_ticket is not None
+            assert (session.expiry_ticket, session.session_id) in live
+
+
+def test_concurrent_create_touch_expire_remove():
+    registry = SessionRegistry(expiry)
+    created, popped, reaped = [], [], []
+    record = threading.Lock()
+    stop = threading.Event()
+    errors = []
+
+    def worker(seed):
+        rng = random.Random(seed)
+        mine = []
+        try:
+            for i in range(1500):
+                op = rng.random()
+                if op < 0.3 or not mine:
+                    session = Session(f"{seed}-{i}", f"video-{rng.randrange(8)}", {})
+                    registry.add(session)
+                    mine.append(session)
+                    with record:
+                        created.append(session)
+                elif op < 0.6:
+                    rng.choice(mine).last_activity = time.time()
+                elif op < 0.8:
+                    session = rng.choice(mine)
+                    session.is_active = not session.is_active
+                else:
+                    session = registry.pop(rng.choice(mine).session_id)
+                    if session:
+                        with record:
+                            popped.append(session)
+        except Exception as e:  # pragma: no cover - reported below
+            errors.append(e)
+
+    def reaper():
+        while not stop.is_set():
+            expired = registry.reap()
+            with record:
+                reaped.extend(expired)
+            time.sleep(0.001)
+
+    reaper_thread = threading.Thread(target=reaper)
+    reaper_thread.start()
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(8)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join(30)
+    stop.set()
+    reaper_thread.join(5)
+
+    assert not errors
+    check_consistent(registry)
+    assert reaped, "the reaper should have expired some sessions"
+
+    # Every session ended up in exactly one place
+    remaining = list(registry.sessions.values())
+    ids = [s.session_id for s in popped + reaped + remaining]
+    assert len(ids) == len(set(ids)) == len(created)
+    assert all(s.registry is None for s in popped + reaped)
+
+    # Far in the future, everything left expires and the indexes empty out
+    reaped_later = registry.reap(now=time.time() + 60)
+    assert len(reaped_later) == len(remaining)
+    assert len(registry) == 0 and not registry.by_video and not registry.by_state
+    check_consistent(registry)